@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Benchmark the parsers and number crunchers in phylo_tools against seeded
+synthetic inputs (see syntheticData.py).  Each case runs in its own child
+process so peak memory (max rss) is measured per case.  Wall time, throughput
+(MB of input per second) and peak memory are written to a JSON file and can be
+compared against a stored baseline; any case slower than threshold times its
+baseline time, or failing where the baseline ran, is reported as a regression
+and the script exits with status 1.
+
+Each case names the interpreter it runs under: the python 3 modules run under
+-p (default: the interpreter running this script) and the modules that are
+still python 2 only (sampleAncestorPosterior, ancestorMixer, blastTools,
+parseDSSP) run under -2 (default: python2).
+"""
+__author__ = "Michael J. Harms"
+__date__ = "261017"
+__usage__ = "runBenchmarks.py [-s small,medium,large] [-c case1,case2...] [-r repeats] [-o output.json] [-b baseline.json] [-t threshold] [-p python3] [-2 python2] [-d data_dir] [-S seed] [-l]"
+
+import sys, os, json, time, subprocess, platform
+
+import syntheticData
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+MODULE_DIRS = [REPO_DIR,
+               os.path.join(REPO_DIR,"structural-anc"),
+               os.path.join(REPO_DIR,"structural-anc","anc")]
+
+class BenchmarkError(Exception):
+    """
+    Error class.
+    """
+
+    pass
+
+# ---------------------------------------------------------------------------
+# Benchmark cases.  Each takes the path to its input and does the work being
+# timed; imports happen inside so import time is not counted.
+# ---------------------------------------------------------------------------
+
+def benchFastaFile(input_file):
+
+    import phyloBase
+    phyloBase.FastaFile(input_file)
+
+def benchAlignment(input_file):
+
+    import phyloBase
+    a = phyloBase.Alignment(phyloBase.FastaFile(input_file).sequences)
+    a.nonGapColumns()
+
+def benchValidateFasta(input_file):
+
+    import phyloBase
+    phyloBase.validateFastaFile(input_file,strict=False)
+
+def benchNewickTree(input_file):
+
+    import phyloBase
+    t = phyloBase.NewickTree(input_file)
+    t.writeNewick()
+
+def benchConsensus(input_file):
+
+    import fastaConsensus
+    fastaConsensus.createConsensus(input_file)
+
+def benchSamplePosterior(input_file):
+
+    import sampleAncestorPosterior
+    anc_data = sampleAncestorPosterior.readDatFile(input_file)
+    for i in range(10):
+        sampleAncestorPosterior.samplePosterior(anc_data)
+
+def benchAncestorMixer(input_file):
+
+    import ancestorMixer
+    p = ancestorMixer.PhymlOutput()
+    classes = [d[6:] for d in os.listdir(input_file) if d.startswith("class_")]
+    p.class_fx = dict([(c,1.0/len(classes)) for c in classes])
+
+    current_dir = os.getcwd()
+    os.chdir(input_file)
+    try:
+        p.readAllAncestors()
+    finally:
+        os.chdir(current_dir)
+    p.createAmbiguousMixture()
+
+def benchParseBlastXML(input_file):
+
+    import blastTools
+    blastTools.parseBlastXML(input_file)
+
+def benchParseDSSP(input_file):
+
+    import parseDSSP
+    parseDSSP.readFile(input_file)
+
+# name: (input type, interpreter, function)
+CASES = {"phyloBase.FastaFile":("fasta","python3",benchFastaFile),
+         "phyloBase.Alignment":("fasta","python3",benchAlignment),
+         "phyloBase.validateFastaFile":("fasta","python3",benchValidateFasta),
+         "phyloBase.NewickTree":("tree","python3",benchNewickTree),
+         "fastaConsensus.createConsensus":("fasta","python3",benchConsensus),
+         "sampleAncestorPosterior":("dat","python2",benchSamplePosterior),
+         "ancestorMixer":("mixer","python2",benchAncestorMixer),
+         "blastTools.parseBlastXML":("blast","python2",benchParseBlastXML),
+         "parseDSSP.readFile":("dssp","python2",benchParseDSSP)}
+
+def inputSize(path):
+    """
+    Size of an input in bytes (summed over all files for a directory input).
+    """
+
+    if os.path.isdir(path):
+        total = 0
+        for root, dirs, files in os.walk(path):
+            total += sum([os.path.getsize(os.path.join(root,f)) for f in files])
+        return total
+
+    return os.path.getsize(path)
+
+def runOne(case,input_file,repeats=1):
+    """
+    Child-process entry point: run case on input_file repeats times and print
+    a JSON record with the best wall time (or the error) to stdout.
+    """
+
+    for d in MODULE_DIRS:
+        if d not in sys.path:
+            sys.path.insert(0,d)
+
+    function = CASES[case][2]
+
+    times = []
+    try:
+        for i in range(repeats):
+            start = time.time()
+            function(input_file)
+            times.append(time.time() - start)
+        out = {"status":"ok","wall_time":min(times)}
+    except Exception as e:
+        out = {"status":"error","error":"%s: %s" % (e.__class__.__name__,e)}
+    except SystemExit as e:
+        out = {"status":"error","error":"SystemExit: %s" % e}
+
+    print(json.dumps(out))
+
+def maxRSS(rusage):
+    """
+    Convert ru_maxrss to megabytes (kilobytes on Linux, bytes on macOS).
+    """
+
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss/1048576.0
+
+    return rusage.ru_maxrss/1024.0
+
+def runCase(case,size,data_dir,repeats=1,python=sys.executable,seed=0):
+    """
+    Generate (if needed) the input for case at the given size, run the case in
+    a child process and return a dictionary of results.
+    """
+
+    input_type = CASES[case][0]
+    input_file = syntheticData.generateInput(input_type,size,data_dir,seed)
+    input_bytes = inputSize(input_file)
+
+    cmd = [python,os.path.abspath(__file__),"--run-one",case,input_file,
+           str(repeats)]
+    proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+                            cwd=BENCHMARK_DIR)
+
+    # Read output before waiting so a chatty child cannot block on a full pipe
+    stdout = proc.stdout.read()
+    stderr = proc.stderr.read()
+    pid, status, rusage = os.wait4(proc.pid,0)
+    proc.returncode = status
+    proc.stdout.close()
+    proc.stderr.close()
+
+    result = {"case":case,
+              "size":size,
+              "interpreter":CASES[case][1],
+              "input_type":input_type,
+              "input_bytes":input_bytes,
+              "peak_memory_mb":maxRSS(rusage)}
+
+    lines = stdout.decode().strip().split("\n")
+    try:
+        result.update(json.loads(lines[-1]))
+    except ValueError:
+        result["status"] = "error"
+        result["error"] = stderr.decode().strip().split("\n")[-1]
+
+    if result["status"] == "ok":
+        wall_time = max(result["wall_time"],1e-9)
+        result["throughput_mb_s"] = input_bytes/1048576.0/wall_time
+
+    return result
+
+def compareToBaseline(results,baseline,threshold=1.10):
+    """
+    Compare results against baseline results.  Returns a list of report lines
+    and the number of regressions: cases whose wall time grew by more than
+    threshold, plus cases that ran in the baseline but fail now.
+    """
+
+    old = dict([((r["case"],r["size"]),r) for r in baseline["results"]])
+
+    report = []
+    regressions = 0
+    for r in results:
+        key = (r["case"],r["size"])
+        if key not in old:
+            continue
+
+        if r["status"] != "ok" or old[key]["status"] != "ok":
+            if old[key]["status"] == "ok":
+                flag = "REGRESSION (now fails: %s)" % r["error"]
+                regressions += 1
+            elif r["status"] == "ok":
+                flag = "fixed (failed in baseline)"
+            else:
+                flag = "fails in both"
+            report.append("%-32s%-8s%10s%10s%11s%11s  %s" %
+                          (r["case"],r["size"],"","","","",flag))
+            continue
+
+        time_ratio = r["wall_time"]/max(old[key]["wall_time"],1e-9)
+        mem_ratio = r["peak_memory_mb"]/max(old[key]["peak_memory_mb"],1e-9)
+
+        flag = ""
+        if time_ratio > threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        elif time_ratio < 1.0/threshold:
+            flag = "faster"
+
+        report.append("%-32s%-8s%10.3f%10.3f%10.2fx%10.2fx  %s" %
+                      (r["case"],r["size"],old[key]["wall_time"],r["wall_time"],
+                       time_ratio,mem_ratio,flag))
+
+    return report, regressions
+
+def main(argv=None):
+    """
+    Main function to parse command line.
+    """
+
+    if argv == None:
+        argv = sys.argv[1:]
+
+    # Child process mode
+    if len(argv) > 0 and argv[0] == "--run-one":
+        try:
+            runOne(argv[1],argv[2],int(argv[3]))
+        except IndexError:
+            err = "--run-one requires case, input file and repeats\n"
+            raise BenchmarkError(err)
+        return
+
+    sizes = ["small","medium"]
+    cases = sorted(CASES.keys())
+    repeats = 3
+    out_file = "benchmark_results.json"
+    baseline_file = None
+    threshold = 1.10
+    pythons = {"python3":sys.executable,"python2":"python2"}
+    data_dir = os.path.join(BENCHMARK_DIR,"data")
+    seed = 0
+
+    options = {"-s":"sizes","-c":"cases","-r":"repeats","-o":"out_file",
+               "-b":"baseline_file","-t":"threshold","-p":"python3","-2":"python2",
+               "-d":"data_dir","-S":"seed"}
+    values = {}
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a == "-l":
+            for c in sorted(CASES.keys()):
+                print("%-32s%-8s%s" % (c,CASES[c][0],CASES[c][1]))
+            return
+        elif a in options:
+            try:
+                values[options[a]] = argv[i+1]
+            except IndexError:
+                err = "Option %s requires a value.\n\n%s\n\n" % (a,__usage__)
+                raise BenchmarkError(err)
+            i += 2
+        else:
+            err = "Argument %s not recognized!\n\n%s\n\n" % (a,__usage__)
+            raise BenchmarkError(err)
+
+    if "sizes" in values:
+        sizes = values["sizes"].split(",")
+    if "cases" in values:
+        cases = values["cases"].split(",")
+    if "repeats" in values:
+        repeats = int(values["repeats"])
+    if "threshold" in values:
+        threshold = float(values["threshold"])
+    if "seed" in values:
+        seed = int(values["seed"])
+    out_file = values.get("out_file",out_file)
+    baseline_file = values.get("baseline_file",baseline_file)
+    for interpreter in pythons:
+        pythons[interpreter] = values.get(interpreter,pythons[interpreter])
+    data_dir = values.get("data_dir",data_dir)
+
+    for s in sizes:
+        if s not in syntheticData.SIZES["fasta"]:
+            err = "Size %s not recognized.  Must be one of %s\n" % \
+                  (s,",".join(syntheticData.SIZES["fasta"].keys()))
+            raise BenchmarkError(err)
+    for c in cases:
+        if c not in CASES:
+            err = "Case %s not recognized.  Use -l to list cases.\n" % c
+            raise BenchmarkError(err)
+
+    # Make sure every interpreter the chosen cases need actually runs
+    python_versions = {}
+    for interpreter in sorted(set([CASES[c][1] for c in cases])):
+        python = pythons[interpreter]
+        try:
+            version = subprocess.check_output([python,"-c",
+                      "import sys; print(sys.version.split()[0])"])
+        except (OSError,subprocess.CalledProcessError):
+            err = "Could not run %s interpreter %s.  Point %s at one or\n" % \
+                  (interpreter,python,{"python3":"-p","python2":"-2"}[interpreter])
+            err += "leave out the %s cases with -c (see -l).\n" % interpreter
+            raise BenchmarkError(err)
+        python_versions[interpreter] = version.decode().strip()
+
+    results = []
+    for s in sizes:
+        for c in cases:
+            r = runCase(c,s,data_dir,repeats,pythons[CASES[c][1]],seed)
+            results.append(r)
+
+            if r["status"] == "ok":
+                print("%-32s%-8s%10.3f s%10.2f MB/s%10.1f MB" %
+                      (c,s,r["wall_time"],r["throughput_mb_s"],
+                       r["peak_memory_mb"]))
+            else:
+                print("%-32s%-8s  %s" % (c,s,r["error"]))
+            sys.stdout.flush()
+
+    out = {"date":time.strftime("%Y-%m-%d %H:%M:%S"),
+           "python":python_versions,
+           "platform":platform.platform(),
+           "repeats":repeats,
+           "seed":seed,
+           "results":results}
+
+    f = open(out_file,'w')
+    json.dump(out,f,indent=2,sort_keys=True)
+    f.close()
+
+    if baseline_file != None:
+        f = open(baseline_file,'r')
+        baseline = json.load(f)
+        f.close()
+
+        report, regressions = compareToBaseline(results,baseline,threshold)
+
+        print("\n%-32s%-8s%10s%10s%11s%11s" % ("case","size","old (s)","new (s)",
+                                             "time","memory"))
+        for r in report:
+            print(r)
+
+        if regressions > 0:
+            print("\n%i case(s) slower than %.2fx baseline or newly failing" % \
+                  (regressions,threshold))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
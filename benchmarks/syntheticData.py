@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Seeded generators for synthetic benchmark inputs: fasta alignments, codeml/
+lazarus node .dat files (and phyml-ss class directories built from them),
+Newick trees, BLAST XML and DSSP files.  The same name, size and seed always
+give byte-identical files.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "261017"
+__usage__ = "imported by runBenchmarks.py"
+
+import os, random
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# Parameters for each input type at each benchmark size
+SIZES = {"fasta":{"small":(1000,300),
+                  "medium":(10000,1000),
+                  "large":(50000,1000)},
+         "dat":{"small":300,
+                "medium":3000,
+                "large":30000},
+         "mixer":{"small":(300,2),
+                  "medium":(1000,5),
+                  "large":(3000,10)},
+         "tree":{"small":1000,
+                 "medium":10000,
+                 "large":100000},
+         "blast":{"small":(10,50),
+                  "medium":(50,500),
+                  "large":(200,1000)},
+         "dssp":{"small":300,
+                 "medium":3000,
+                 "large":30000}}
+
+def writeFastaAlignment(out_file,num_seq,length,seed=0,gap_fraction=0.1):
+    """
+    Write a fasta alignment of num_seq random protein sequences of the given
+    length.  Sequences are point-mutated copies of a single ancestor, so
+    columns have realistic (non-uniform) composition.
+    """
+
+    rng = random.Random(seed)
+    ancestor = [rng.choice(AMINO_ACIDS) for i in range(length)]
+
+    with open(out_file,'w') as f:
+        for i in range(num_seq):
+            seq = ancestor[:]
+            for j in range(length):
+                r = rng.random()
+                if r < gap_fraction:
+                    seq[j] = "-"
+                elif r < 0.4:
+                    seq[j] = rng.choice(AMINO_ACIDS)
+
+            seq = "".join(seq)
+            f.write(">XX%s\n" % str(i).zfill(8))
+            for j in range(0,length,60):
+                f.write("%s\n" % seq[j:j+60])
+
+def writeNodeDatFile(out_file,num_sites,seed=0):
+    """
+    Write a codeml/lazarus style node .dat file: one line per site holding the
+    site number followed by amino acid/posterior probability pairs, sorted
+    from most to least probable.
+    """
+
+    rng = random.Random(seed)
+
+    with open(out_file,'w') as f:
+        for i in range(num_sites):
+            weights = [rng.random()**8 for a in AMINO_ACIDS]
+            total = sum(weights)
+            pp = sorted([(w/total,a) for w, a in zip(weights,AMINO_ACIDS)],
+                        reverse=True)
+            f.write("%i %s\n" % (i + 1," ".join(["%s %.3f" % (a,p)
+                                                for p, a in pp])))
+
+def writeMixerDirectory(out_dir,num_sites,num_nodes,seed=0):
+    """
+    Write the class_XX/nodeN.dat layout read by ancestorMixer.PhymlOutput for
+    all six EX/EHO structural classes.
+    """
+
+    classes = ["be","bh","bo","ee","eh","eo"]
+    for i, c in enumerate(classes):
+        class_dir = os.path.join(out_dir,"class_%s" % c)
+        if not os.path.exists(class_dir):
+            os.makedirs(class_dir)
+        for n in range(num_nodes):
+            writeNodeDatFile(os.path.join(class_dir,"node%i.dat" % (n + 1)),
+                             num_sites,seed=seed + 1000*i + n)
+
+def writeNewickTree(out_file,num_tips,seed=0):
+    """
+    Write a random bifurcating Newick tree with labelled tips, support values
+    on internal nodes and branch lengths everywhere.
+    """
+
+    rng = random.Random(seed)
+
+    nodes = ["XX%s:%.6f" % (str(i).zfill(8),rng.random()) for i in range(num_tips)]
+    while len(nodes) > 1:
+        a = nodes.pop(rng.randrange(len(nodes)))
+        b = nodes.pop(rng.randrange(len(nodes)))
+        nodes.append("(%s,%s)%i:%.6f" % (a,b,rng.randint(0,100),rng.random()))
+
+    with open(out_file,'w') as f:
+        f.write("%s;\n" % nodes[0])
+
+def writeBlastXML(out_file,num_queries,hits_per_query,seed=0):
+    """
+    Write BLAST XML output (-outfmt 5 layout) with num_queries iterations of
+    hits_per_query hits, each with one HSP.
+    """
+
+    rng = random.Random(seed)
+
+    with open(out_file,'w') as f:
+        f.write('<?xml version="1.0"?>\n<BlastOutput>\n')
+        f.write("  <BlastOutput_program>blastp</BlastOutput_program>\n")
+        f.write("  <BlastOutput_iterations>\n")
+        for q in range(num_queries):
+            f.write("    <Iteration>\n")
+            f.write("      <Iteration_iter-num>%i</Iteration_iter-num>\n" % (q + 1))
+            f.write("      <Iteration_hits>\n")
+            for h in range(hits_per_query):
+                gi = rng.randint(1,999999999)
+                f.write("        <Hit>\n")
+                f.write("          <Hit_num>%i</Hit_num>\n" % (h + 1))
+                f.write("          <Hit_id>gi|%i|ref|XP_%i.1|</Hit_id>\n" % (gi,gi))
+                f.write("          <Hit_def>hypothetical protein %i [Homo sapiens]</Hit_def>\n" % gi)
+                f.write("          <Hit_accession>XP_%i</Hit_accession>\n" % gi)
+                f.write("          <Hit_hsps>\n            <Hsp>\n")
+                f.write("              <Hsp_bit-score>%.2f</Hsp_bit-score>\n" % (rng.random()*500))
+                f.write("              <Hsp_evalue>%.3e</Hsp_evalue>\n" % (10**(-rng.random()*100)))
+                f.write("            </Hsp>\n          </Hit_hsps>\n")
+                f.write("        </Hit>\n")
+            f.write("      </Iteration_hits>\n")
+            f.write("    </Iteration>\n")
+        f.write("  </BlastOutput_iterations>\n</BlastOutput>\n")
+
+def writeDSSPFile(out_file,num_residues,seed=0):
+    """
+    Write a DSSP file with two chains (A and B) of num_residues residues each,
+    in the fixed-column layout read by parseDSSP.readFile.
+    """
+
+    rng = random.Random(seed)
+    sequence = [rng.choice(AMINO_ACIDS) for i in range(num_residues)]
+    structure = [rng.choice("HHHEEE  TSGB") for i in range(num_residues)]
+
+    with open(out_file,'w') as f:
+        f.write("==== Secondary Structure Definition by the program DSSP ====\n")
+        f.write("  #  RESIDUE AA STRUCTURE BP1 BP2  ACC\n")
+        counter = 1
+        for chain in "AB":
+            for i in range(num_residues):
+                line = [" "]*40
+                line[0:5] = "%5i" % counter
+                line[5:10] = "%5i" % (i + 1)
+                line[11] = chain
+                line[13] = sequence[i]
+                line[16] = structure[i]
+                line[34:38] = "%4i" % rng.randint(0,200)
+                f.write("%s\n" % "".join(line))
+                counter += 1
+
+# Generator and file name for each input type
+GENERATORS = {"fasta":(writeFastaAlignment,"alignment_%s.fasta"),
+              "dat":(writeNodeDatFile,"node_%s.dat"),
+              "mixer":(writeMixerDirectory,"mixer_%s"),
+              "tree":(writeNewickTree,"tree_%s.newick"),
+              "blast":(writeBlastXML,"blast_%s.xml"),
+              "dssp":(writeDSSPFile,"structure_%s.dssp")}
+
+def generateInput(input_type,size,data_dir,seed=0):
+    """
+    Return the path to the input_type file of the given size and seed in
+    data_dir, generating it first if it does not already exist.  The seed is
+    part of the file name, so each seed gets its own cached file.
+    """
+
+    generator, name = GENERATORS[input_type]
+    path = os.path.join(data_dir,name % ("%s_seed%i" % (size,seed)))
+
+    if not os.path.exists(path):
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+
+        args = SIZES[input_type][size]
+        if not isinstance(args,tuple):
+            args = (args,)
+        generator(path,*args,seed=seed)
+
+    return path
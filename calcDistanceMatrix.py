@@ -1,13 +1,39 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
+Calculate all pairwise distances between the sequences in an alignment (fasta
+or phyloBase binary alignment).  Sites where either sequence has a gap or
+missing character are dropped pair by pair (pairwise deletion).  Distances
+are p-distance (-m p), Poisson corrected (-m poisson) or Kimura's protein
+correction (-m kimura, the default).  Pairs with no comparable sites, or
+whose correction is undefined, are NaN.
 
+-x counts identities with matrix products instead: blocks of rows are
+one-hot encoded and identical/compared site counts for every pair in a tile
+come from two float32 matrix multiplications, so the O(n^2 L) work runs in
+BLAS.  Block size and how many encoded blocks are held at once follow a
+memory budget (-M, in megabytes; 1024 by default).  BLAS itself uses all
+cores; -t runs that many tiles at once, for single-threaded BLAS builds.
+Results are written straight into the memory-mapped output.
+
+The matrix is written to out_root.npy as a condensed float32 array (the upper
+triangle, row by row, as used by scipy.spatial.distance) that can be opened
+with np.load(...,mmap_mode="r"), with sequence names in out_root_names.txt.
+Unless -n is given, a square PHYLIP distance matrix is also written to
+out_root.dist, with 10 character names (whole names with -r) that must not
+collide.  Undefined distances cannot be written to PHYLIP; -u value writes
+value in their place, otherwise they are an error.
 """
 __author__ = "Michael J. Harms"
-__usage__ = "calcDistanceMatrix.py fasta_file"
+__usage__ = "calcDistanceMatrix.py alignment_file [-m p|poisson|kimura] [-o out_root] [-b block_size] [-n] [-r] [-u missing_value] [-x [-t num_threads] [-M max_memory_mb]]"
 __date__ = "091221"
 
-import sys, phyloBase
+import sys, os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import phyloBase, fasta2phylip
 
 class CalcDistanceMatrixError(Exception):
     """
@@ -16,73 +42,389 @@ class CalcDistanceMatrixError(Exception):
     
     pass
 
+# Characters that are not compared
+MISSING_CHARACTERS = "-?X"
+
+METHODS = ["p","poisson","kimura"]
+
+# Default memory budget (bytes) for the matrix product mode, and the working
+# memory per pair of a tile (float32 products plus float64 distances)
+BLAS_MEMORY = 1073741824
+TILE_BYTES_PER_PAIR = 48
+
+def loadAlignment(alignment_file):
+    """
+    Load a fasta file or a phyloBase binary alignment (memory-mapped).
+    """
+
+    with open(alignment_file,'rb') as f:
+        magic = f.read(len(phyloBase.BINARY_MAGIC))
+
+    if magic == phyloBase.BINARY_MAGIC:
+        return phyloBase.loadBinaryAlignment(alignment_file)
+
+    fasta = phyloBase.FastaFile(alignment_file,strict=False)
+    try:
+        return phyloBase.Alignment(fasta.sequences)
+    except phyloBase.PhyloBaseError:
+        err = "Sequences in %s are not all the same length!\n" % alignment_file
+        raise CalcDistanceMatrixError(err)
+
+def correctDistance(identical,compared,method="kimura"):
+    """
+    Turn counts of identical and compared sites into distances.  Returns
+    float64 with NaN where nothing was compared or the correction is
+    undefined.
+    """
+
+    if method not in METHODS:
+        err = "Method must be one of %s\n" % ", ".join(METHODS)
+        raise CalcDistanceMatrixError(err)
+
+    with np.errstate(divide="ignore",invalid="ignore"):
+        p = 1.0 - identical/compared.astype(np.float64)
+
+        if method == "p":
+            return p
+
+        if method == "poisson":
+            x = 1.0 - p
+        else:
+            x = 1.0 - p - 0.2*p*p
+
+        d = 0.0 - np.log(np.where(x > 0,x,np.nan))
+
+    return d
+
+def countPairs(a,b,missing_lookup):
+    """
+    For every pair of rows in uint8 blocks a and b, count the sites both
+    have non-missing (compared) and the subset that are identical.  Returns
+    two (len(a) x len(b)) int64 arrays.
+    """
+
+    valid = np.logical_and(missing_lookup[a][:,None,:],missing_lookup[b][None,:,:])
+    compared = valid.sum(axis=2)
+    identical = np.logical_and(a[:,None,:] == b[None,:,:],valid).sum(axis=2)
+
+    return identical, compared
+
+def condensedIndex(i,j,n):
+    """
+    Position of pair (i,j), i < j, in a condensed n x n distance matrix.
+    """
+
+    return i*n - i*(i + 1)//2 + (j - i - 1)
+
+def _missingLookup():
+    """
+    Byte lookup table that is True for characters that are compared.
+    """
+
+    lookup = np.ones(256,dtype=bool)
+    for c in MISSING_CHARACTERS + MISSING_CHARACTERS.lower():
+        lookup[ord(c)] = False
+
+    return lookup
+
+def calcDistanceMatrix(matrix,out_file,method="kimura",block_size=None,
+                       max_block=16777216):
+    """
+    Compute all pairwise distances between the rows of a (num_seq x length)
+    uint8 matrix, writing them as a condensed float32 array to the .npy file
+    out_file.  Rows are compared in square blocks of block_size rows (by
+    default chosen so a block pair compares at most max_block residues), so
+    memory use is bounded whatever the number of sequences.  Returns the
+    memory-mapped result.
+    """
+
+    n, length = matrix.shape
+    if block_size is None:
+        block_size = int(max(1,min(n,np.sqrt(max_block/max(length,1)))))
+
+    out = np.lib.format.open_memmap(out_file,mode="w+",dtype=np.float32,
+                                    shape=(n*(n - 1)//2,))
+
+    missing_lookup = _missingLookup()
+
+    for start in range(0,n,block_size):
+        stop = min(start + block_size,n)
+        a = np.ascontiguousarray(matrix[start:stop])
+
+        # Distances from this block of rows to every row at or after start
+        rows = np.empty((stop - start,n - start),dtype=np.float32)
+        for j in range(start,n,block_size):
+            b = np.ascontiguousarray(matrix[j:j+block_size])
+            identical, compared = countPairs(a,b,missing_lookup)
+            rows[:,j-start:j-start+len(b)] = correctDistance(identical,compared,method)
+
+        for i in range(start,stop):
+            if i + 1 < n:
+                first = condensedIndex(i,i + 1,n)
+                out[first:first + n - i - 1] = rows[i-start,i-start+1:]
+
+    out.flush()
+
+    return out
 
-def extractAncestor(node_file,fasta_file,alternate_states=2):
+def alignmentStates(matrix,block_rows=65536):
     """
+    Return a lookup table mapping each byte to a dense state index (-1 for
+    missing characters and bytes that never occur in the matrix), and the
+    number of states.
     """
 
-    f = phyloBase.FastaFile(fasta_file)
-    num_characters = len(f.sequences[0].sequence)
+    counts = np.zeros(256,dtype=np.int64)
+    for i in range(0,matrix.shape[0],block_rows):
+        counts += np.bincount(np.asarray(matrix[i:i+block_rows]).ravel(),minlength=256)
 
-    to_take = [False for i in range(num_characters)]
-    for seq in f.sequences:
-        for i, character in enumerate(seq.sequence):
-            if character != "-":
-                to_take[i] = True
+    present = np.logical_and(counts > 0,_missingLookup())
 
-    node = readNodeFile(node_file)
+    state_lookup = np.full(256,-1,dtype=np.int64)
+    state_lookup[present] = np.arange(present.sum())
 
-    # Set up header
-    out = ["%6s%6s" % (" ","pos")]
-    for i in range(alternate_states):
-        out.append("%6s%6s" % (("s%i" % i),("pp%i" % i)))
-    out.append("%6s\n" % "total")
+    return state_lookup, int(present.sum())
 
-    # Read reconstructed characters and posterior proabilities from node list.
-    # If there are fewer alternate states at a given position, append NA (the
-    # missing data character from R) and a 0 posterior probability.  Sum the
-    # PP we have looked at and place at the end.
-    counter = 0
-    for i in range(num_characters):
-        if to_take[i] == True:
-            output = node[i][:2*alternate_states]
-            if len(output) != 2*alternate_states:
-                diff = (2*alternate_states-len(output))/2
-                for j in range(diff):
-                    output.extend(["NA","0.000"])
+def oneHotBlock(block,state_lookup,num_states):
+    """
+    One-hot encode a uint8 block of rows as a (rows x length*num_states)
+    float32 matrix.  Missing characters encode as all zeros.  Also returns the
+    (rows x length) float32 mask of compared (non-missing) sites.
+    """
+
+    states = state_lookup[block]
+    one_hot = (states[:,:,None] == np.arange(num_states)).astype(np.float32)
+
+    return one_hot.reshape(len(block),-1), (states >= 0).astype(np.float32)
+
+def blasBlockSize(length,num_states,max_memory=BLAS_MEMORY,num_threads=1):
+    """
+    Largest block_size for which num_threads tiles in flight (one encoded
+    column block plus the float32 products and float64 distances of one
+    tile each) use at most half of max_memory bytes.  The other half holds
+    the encoded row panel.
+    """
+
+    row_bytes = 4*length*(num_states + 1)
+    per_thread = max_memory/2.0/max(num_threads,1)
+
+    block_size = (-row_bytes + np.sqrt(row_bytes**2 + 4*TILE_BYTES_PER_PAIR*per_thread))
+    block_size /= 2*TILE_BYTES_PER_PAIR
+
+    return max(1,int(block_size))
+
+def calcDistanceMatrixBLAS(matrix,out_file,method="kimura",block_size=None,
+                           num_threads=1,max_memory=BLAS_MEMORY):
+    """
+    Same result as calcDistanceMatrix, but identical and compared site
+    counts for each tile of (block_size x block_size) rows come from one-hot
+    matrix products (identical = A.B^T over the one-hot encodings, compared =
+    A.B^T over the non-missing masks).  Counts are exact in float32 for
+    alignments shorter than 2^24 columns.
+
+    Memory is bounded by max_memory bytes (plus the alignment itself).  Rows
+    are encoded in panels of whole blocks taking up to half of max_memory;
+    every later block is then encoded once and multiplied against each panel
+    block, so if the whole alignment fits in one panel each block is encoded
+    exactly once.  block_size is chosen by blasBlockSize if not given.
+
+    The products already run on all cores of a threaded BLAS, so by default
+    column blocks are processed one at a time.  num_threads > 1 processes
+    that many column blocks at once and is only useful with a single-threaded
+    BLAS (e.g. OPENBLAS_NUM_THREADS=1).  Each column block writes its own
+    entries of the condensed output memory map.
+    """
+
+    n, length = matrix.shape
+    if num_threads is None or num_threads < 1:
+        num_threads = 1
+
+    out = np.lib.format.open_memmap(out_file,mode="w+",dtype=np.float32,
+                                    shape=(n*(n - 1)//2,))
+
+    state_lookup, num_states = alignmentStates(matrix)
+
+    if block_size is None:
+        block_size = blasBlockSize(length,num_states,max_memory,num_threads)
+    block_size = min(block_size,max(n,1))
+
+    row_bytes = 4*length*(num_states + 1)
+    panel_blocks = max(1,int(max_memory//2//(row_bytes*block_size)))
+    panel_rows = panel_blocks*block_size
+
+    def encode(start):
+        block = np.asarray(matrix[start:start+block_size])
+        return oneHotBlock(block,state_lookup,num_states)
+
+    def processColumnBlock(j,panel):
+
+        if j in panel:
+            b_one_hot, b_valid = panel[j]
+        else:
+            b_one_hot, b_valid = encode(j)
+        last_j = j + len(b_valid)
 
-            total = sum([float(output[j]) for j in range(1,2*alternate_states,2)])
+        for start in sorted(panel):
+            if start > j:
+                break
+            a_one_hot, a_valid = panel[start]
 
-            out.append("%6i%6i" % (counter,i))
-            out.extend(["%6s" % o for o in output])
-            out.append("%6.3f\n" % total)
-            counter += 1
+            identical = np.rint(np.dot(a_one_hot,b_one_hot.T))
+            compared = np.rint(np.dot(a_valid,b_valid.T))
+            distances = correctDistance(identical,compared,method)
 
-    return "".join(out)
+            # Write the part of each row that lies above the diagonal
+            for i in range(start,start + len(a_valid)):
+                first_j = max(i + 1,j)
+                if first_j < last_j:
+                    first = condensedIndex(i,first_j,n)
+                    out[first:first + last_j - first_j] = \
+                        distances[i-start,first_j-j:last_j-j]
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for panel_start in range(0,n,panel_rows):
+            starts = range(panel_start,min(panel_start + panel_rows,n),block_size)
+            panel = dict(zip(starts,pool.map(encode,starts)))
+
+            columns = range(panel_start,n,block_size)
+            for result in pool.map(lambda j: processColumnBlock(j,panel),columns):
+                pass
+
+            del panel
+
+    out.flush()
+
+    return out
+
+def squareRow(condensed,i,n):
+    """
+    Return row i of the full square distance matrix from a condensed one.
+    """
+
+    row = np.zeros(n,dtype=np.float32)
+
+    # Entries before the diagonal are scattered down column i
+    j = np.arange(i)
+    row[:i] = condensed[condensedIndex(j,i,n)]
+
+    if i + 1 < n:
+        first = condensedIndex(i,i + 1,n)
+        row[i+1:] = condensed[first:first + n - i - 1]
+
+    return row
+
+def writePhylipDistances(condensed,names,out_file,relaxed=False,missing=None,
+                         block_size=16777216):
+    """
+    Write a condensed distance matrix as a square PHYLIP distance matrix,
+    one row at a time.  Names are made with fasta2phylip.phylipNames (10
+    characters, or whole names with whitespace replaced by "_" if relaxed),
+    which raises an error if two names collide.  PHYLIP readers do not accept
+    NaN, so undefined distances are written as missing; if missing is None
+    and there are any, an error is raised before anything is written.
+    """
+
+    n = len(names)
+    phylip_names = fasta2phylip.phylipNames(names,relaxed)
+
+    if missing is None:
+        for start in range(0,len(condensed),block_size):
+            if np.isnan(condensed[start:start+block_size]).any():
+                err = "Some distances are undefined (no comparable sites, or "
+                err += "too divergent for the correction).  Give a value to "
+                err += "write in their place (-u) or skip the PHYLIP file (-n).\n"
+                raise CalcDistanceMatrixError(err)
+
+    with open(out_file,'w') as f:
+        f.write("%i\n" % n)
+        for i in range(n):
+            row = squareRow(condensed,i,n)
+            if missing is not None:
+                row[np.isnan(row)] = missing
+            values = " ".join(["%.6f" % d for d in row])
+            if relaxed:
+                f.write("%s  %s\n" % (phylip_names[i],values))
+            else:
+                f.write("%-10s %s\n" % (phylip_names[i],values))
 
 def main(argv=None):
     """
+    Parse the command line and calculate the distance matrix.
     """
 
     if argv == None:
         argv = sys.argv[1:]
 
     try:
-        node_file = argv[0]
-        fasta_file = argv[1]
+        alignment_file = argv[0]
     except IndexError:
         err = "Incorrect number of arguments!\n\n%s\n\n" % __usage__
-        raise ParseAncestorError(err)
+        raise CalcDistanceMatrixError(err)
 
-    try:
-        num_alternate_states = int(argv[2])
-    except (IndexError,ValueError):
-        num_alternate_states = 2
+    method = "kimura"
+    out_root = os.path.splitext(alignment_file)[0]
+    block_size = None
+    phylip = True
+    relaxed = False
+    missing = None
+    use_blas = False
+    num_threads = 1
+    max_memory = BLAS_MEMORY
+
+    i = 1
+    while i < len(argv):
+        a = argv[i]
+        if a == "-n":
+            phylip = False
+        elif a == "-r":
+            relaxed = True
+        elif a == "-x":
+            use_blas = True
+        elif a in ("-m","-o","-b","-t","-M","-u"):
+            try:
+                value = argv[i+1]
+            except IndexError:
+                err = "%s requires a value!\n\n%s\n\n" % (a,__usage__)
+                raise CalcDistanceMatrixError(err)
+            if a == "-m":
+                method = value
+            elif a == "-o":
+                out_root = value
+            elif a == "-t":
+                num_threads = int(value)
+            elif a == "-M":
+                max_memory = int(float(value)*1048576)
+            elif a == "-u":
+                missing = float(value)
+            else:
+                block_size = int(value)
+            i += 1
+        else:
+            err = "Argument %s not recognized!\n\n%s\n\n" % (a,__usage__)
+            raise CalcDistanceMatrixError(err)
+        i += 1
+
+    if method not in METHODS:
+        err = "Method must be one of %s\n" % ", ".join(METHODS)
+        raise CalcDistanceMatrixError(err)
+
+    alignment = loadAlignment(alignment_file)
+
+    if use_blas:
+        condensed = calcDistanceMatrixBLAS(alignment.matrix,"%s.npy" % out_root,
+                                           method,block_size,num_threads,
+                                           max_memory)
+    else:
+        condensed = calcDistanceMatrix(alignment.matrix,"%s.npy" % out_root,
+                                       method,block_size)
 
-    ancestor = extractAncestor(node_file,fasta_file,num_alternate_states)
+    with open("%s_names.txt" % out_root,'w') as f:
+        f.write("".join(["%s\n" % h for h in alignment.headers]))
 
-    print ancestor
+    if phylip:
+        writePhylipDistances(condensed,alignment.headers,"%s.dist" % out_root,
+                             relaxed,missing)
 
 
 if __name__ == "__main__":
-    main() 
+    main()
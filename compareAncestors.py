@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
 compareAncestor.py
@@ -30,7 +30,7 @@ def readAncestorFile(ancestor_file):
 
     out = []
 
-    num_states = (len(lines[0].split())-2)/2
+    num_states = (len(lines[0].split())-2)//2
 
     for l in lines[1:]:
         position = int(l[7:12])
@@ -59,11 +59,11 @@ def compareAncestors(ancestor1_file,ancestor2_file,ambiguous_cutoff=0.8):
     only_in_anc2 = [p for p in anc2_pos if p not in anc1_pos]
 
     if len(only_in_anc1) > 0:
-        print "# Warning: some sites only in ancestor 1:"
-        print "".join(["# %i\n" % p for p in only_in_anc1]),
+        print("# Warning: some sites only in ancestor 1:")
+        print("".join(["# %i\n" % p for p in only_in_anc1]),end="")
     if len(only_in_anc2) > 0:
-        print "# Warning: some sites only in ancestRr 2:"
-        print "".join(["# %i\n" % p for p in only_in_anc2]),
+        print("# Warning: some sites only in ancestRr 2:")
+        print("".join(["# %i\n" % p for p in only_in_anc2]),end="")
 
     all_pos = [p for p in anc1_pos if p not in only_in_anc1] 
     all_pos.extend([p for p in anc2_pos if p not in only_in_anc2 and p not in all_pos])
@@ -148,7 +148,7 @@ def main(argv=None):
 
     out = compareAncestors(ancestor1_file,ancestor2_file)
 
-    print out
+    print(out)
 
 
 if __name__ == "__main__":
@@ -7,18 +7,25 @@ A name file can be used in conjunction with editNames.py to convert the strings
 within text files between human-readable and phyml readable formats.  The
 sanitized fasta file is ready to be edited with editNames.py.  These are written
 out as fileroot_names.txt and fileroot_names.fasta
+
+With -r registry.db, internal names are assigned by (and recorded in) a
+nameRegistry.py SQLite registry, so they stay unique across runs and projects
+rather than restarting at XX00000000.  A sequence already registered (same
+accession, species and pretty name) keeps its existing internal name.
 """
 __author__ = "Michael J. Harms"
 __date__ = "2014-07-26"
-__usage__ = "createNameFiles.py fasta_file_from_uniprot"
+__usage__ = "createNameFiles.py fasta_file_from_uniprot [generic|uniprot] [-r registry.db]"
 
 import sys, re
 
+import phyloBase, nameRegistry
+
 def parseUniprotLine(line):
     """
-    Parse a uniprot fasta file line, returning the uniprot id and species.  This
-    is a rather hacked parser that is brittle to changes in the default uniprot
-    fasta file header.  
+    Parse a uniprot fasta file header (without ">"), returning the uniprot id
+    and species.  This is a rather hacked parser that is brittle to changes in
+    the default uniprot fasta file header.  
     """
 
     cols = line.split("|")
@@ -34,10 +41,11 @@ def parseUniprotLine(line):
 def parseGenericLine(line):
     """
     Grab the name of a sequence without any (known) structure in the name.  
-    Clean it up so downstream newick files don't choke. 
+    Clean it up so downstream newick files don't choke.  line is the header
+    without the leading ">".
     """
 
-    out_line = line[1:].strip()
+    out_line = line.strip()
     out_line = re.sub(":","-",out_line)
     out_line = re.sub(",","-",out_line)
     out_line = re.sub("\(","\[",out_line)
@@ -46,10 +54,18 @@ def parseGenericLine(line):
     return out_line, "unk" 
    
 
-def createMasterFile(fasta_file,delim="\t",parse_type="generic"):
+def createMasterFile(fasta_file,file_root,delim="\t",parse_type="generic",
+                     registry=None,batch_size=100000):
     """
     Walk through ">" entries in the fasta file, extract the uniprot id and
-    source species name, and then create a name file line from that.
+    source species name, and then create a name file line from that.  Records
+    are streamed straight out to file_root_name.txt and file_root_name.fasta.
+    If registry (a nameRegistry.NameRegistry) is given, internal names come
+    from the registry: each batch_size records are looked up by accession,
+    records already registered reuse their names and the rest are added in
+    one transaction.  Each distinct (accession,species,pretty_name) record
+    gets one name; repeats of a record are written out only once, with a
+    warning.  Returns the number of records read.
     """
 
     parsers = {"generic":parseGenericLine,
@@ -57,34 +73,85 @@ def createMasterFile(fasta_file,delim="\t",parse_type="generic"):
 
     parser = parsers[parse_type]
 
-    # Create output list    
-    name_out = [delim.join(["number","id","species","internal_name","pretty_name"])]
-    fasta_out = []
-
-    # read every line in the fasta file
+    name_out = open("%s_name.txt" % file_root,'w')
+    fasta_out = open("%s_name.fasta" % file_root,'w')
+
+    name_out.write(delim.join(["number","id","species","internal_name",
+                               "pretty_name"]))
+
+    written = set()
+
+    def writeBatch(batch,counter):
+
+        if registry is None:
+            internal_names = ["XX%s" % (str(counter + i).zfill(8))
+                              for i in range(len(batch))]
+            numbers = [counter + i for i in range(len(batch))]
+        else:
+
+            # One name per distinct (accession,species,pretty_name) record,
+            # reusing names that are already registered
+            resolved = {}
+            registered = registry.lookup("accession",[b[0] for b in batch])
+            for b in batch:
+                key = b[:3]
+                if key in resolved:
+                    continue
+                for row in registered.get(b[0],[]):
+                    if (row[2],row[4]) == (b[1],b[2]):
+                        resolved[key] = (row[0],row[3])
+                        break
+
+            new = []
+            for b in batch:
+                if b[:3] not in resolved:
+                    resolved[b[:3]] = None
+                    new.append(b[:3])
+            for key, internal_name in zip(new,registry.addNames(new)):
+                resolved[key] = (int(internal_name[2:]),internal_name)
+
+            numbers = [resolved[b[:3]][0] for b in batch]
+            internal_names = [resolved[b[:3]][1] for b in batch]
+
+        for i, (id_string, species, pretty_name, sequence) in enumerate(batch):
+
+            # A record seen earlier in the file already has its name file line
+            if internal_names[i] in written:
+                warning = "Skipping repeated record %s (%s)\n" % (pretty_name,
+                                                                  internal_names[i])
+                sys.stderr.write(warning)
+                continue
+
+            name_out.write("\n%s" % delim.join([str(numbers[i]),id_string,species,
+                                                 internal_names[i],pretty_name]))
+
+            if len(written) > 0:
+                fasta_out.write("\n")
+            fasta_out.write(">%s\n%s" % (pretty_name,sequence))
+
+            written.add(internal_names[i])
+
+    # read every record in the fasta file
     counter = 0
-    with open(fasta_file) as f:
-        for line in f:
-
-            # If this is a header line
-            if line.startswith(">"):
+    batch = []
+    for header, sequence in phyloBase.FastaFile.iterRecords(fasta_file):
 
-                id_string, species = parser(line)
+        id_string, species = parser(header)
+        pretty_name = "%s-%s" % (id_string,species)
+        batch.append((id_string,species,pretty_name,sequence))
 
-                internal_name = "XX%s" % (str(counter).zfill(8))
-                pretty_name = "%s-%s" % (id_string,species)
-  
-                name_out.append(delim.join([str(counter),id_string,species,
-                                       internal_name,pretty_name]))
-                
-                fasta_out.append(">%s" % pretty_name)
+        if len(batch) == batch_size:
+            writeBatch(batch,counter)
+            counter += len(batch)
+            batch = []
 
-                counter += 1
+    writeBatch(batch,counter)
+    counter += len(batch)
 
-            else:
-                fasta_out.append(line.strip())
+    name_out.close()
+    fasta_out.close()
 
-    return name_out, fasta_out
+    return counter
     
 
 def main(argv=None):
@@ -101,24 +168,30 @@ def main(argv=None):
         err = "Incorrect arguments. Usage:\n\n%s\n\n" % __usage__
         raise IndexError(err)
 
-    try:
-        parser_type = argv[1]
-    except IndexError:
-        parser_type = "generic"
-
-    name_out, fasta_out = createMasterFile(uniprot_fasta)
+    parser_type = "generic"
+    registry = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == "-r":
+            try:
+                registry = nameRegistry.NameRegistry(argv[i+1])
+            except IndexError:
+                err = "-r requires a registry file. Usage:\n\n%s\n\n" % __usage__
+                raise IndexError(err)
+            i += 1
+        else:
+            parser_type = argv[i]
+        i += 1
 
     # Strip extension
     file_root =".".join( uniprot_fasta.split(".")[:-1])
 
     # Write out name database and fasta file with those names
-    f = open("%s_name.txt" % file_root,'w')
-    f.write("\n".join(name_out))
-    f.close()
+    createMasterFile(uniprot_fasta,file_root,parse_type=parser_type,
+                     registry=registry)
 
-    f = open("%s_name.fasta" % file_root,'w')
-    f.write("\n".join(fasta_out))
-    f.close()
+    if registry is not None:
+        registry.close()
 
 
 # If this is called from the command line
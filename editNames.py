@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ =\
 """
 editNames.py
@@ -6,12 +6,28 @@ editNames.py
 Goes through a file looking for a set of strings, replacing each one with a 
 specific counterpart.  The strings are defined in a delimited text file
 with columns naemd "key" and "value".
+
+All keys are found in a single pass over the file.  Keys are literal strings
+(not regular expressions) and overlapping keys resolve to the longest match.
+With -t the file is instead split into Newick/fasta name tokens (anything
+between "(),:;[]'>" and whitespace), and only tokens that exactly equal a key
+are replaced.  -s streams the file through in fixed-size chunks, writing
+output as it goes, so memory use does not depend on the size of the file.
+
+master_file may also be a nameRegistry.py SQLite registry.  Only the names
+whose key appears in the file (as a name token or, without -t, a whole line
+such as a fasta header) are looked up.  -r registry.db records the names in a
+text master file in that registry.
 """
 __author__ = "Michael J. Harms"
 __date__ = "091205"
-__usage__ = "editTreeNames.py file_to_modify master_file key_col value_col"
+__usage__ = "editTreeNames.py file_to_modify master_file key_col value_col [-t] [-s] [-r registry.db]"
+
+import os, sys, re, collections, zipfile
 
-import os, sys, re
+import numpy as np
+
+import phyloBase, nameRegistry
 
 class EditNamesError(Exception):
     """
@@ -20,17 +36,89 @@ class EditNamesError(Exception):
     
     pass
 
-class NameObject:
+class NameTable:
     """
+    Columnar table of sequence names read from a master file.  Each column is
+    stored as one list, and hash indexes (value -> row) are built the first
+    time a column is used as a key.
     """
 
-    def __init__(self,line,column_names,column_delimiter):
+    def __init__(self,column_names,columns=None):
         """
-        Hold all column values for this sequence, keyed to column_name.
+        Create a table with the given column names.  columns, if given, is a
+        dictionary of equal-length lists keyed by column name.
         """
 
-        column_values = [c.strip() for c in line.split(column_delimiter)]
+        self.column_names = list(column_names)
+        if columns is None:
+            columns = dict([(c,[]) for c in self.column_names])
+        self.columns = columns
+        self._indexes = {}
+
+    def __len__(self):
+
+        if len(self.column_names) == 0:
+            return 0
+
+        return len(self.columns[self.column_names[0]])
+
+    def column(self,column_name):
+        """
+        Return the list of values in a column.
+        """
+
+        try:
+            return self.columns[column_name]
+        except KeyError:
+            err = "Name table does not have a '%s' column!\n\n" % column_name
+            raise EditNamesError(err)
+
+    def index(self,column_name):
+        """
+        Return a dictionary mapping each value in column_name to its row,
+        building it on first use.  The column must have unique entries.
+        """
 
+        if column_name not in self._indexes:
+            values = self.column(column_name)
+            repeated = checkUniqueness(values)
+            if len(repeated) != 0:
+                err = "Column '%s' has non-unique entries!\n" % column_name
+                err += "The following entries are repeated:\n\n"
+                err += "\n".join(repeated)
+                err += "\n\n"
+                raise EditNamesError(err)
+
+            self._indexes[column_name] = dict([(v,i) for i, v in enumerate(values)])
+
+        return self._indexes[column_name]
+
+    def getRow(self,row):
+        """
+        Return a dictionary of column values for one row.
+        """
+
+        return dict([(c,self.columns[c][row]) for c in self.column_names])
+
+    def lookup(self,key_column,key,value_column=None):
+        """
+        Find the row whose key_column is key, returning either the value in
+        value_column or (if None) the whole row as a dictionary.
+        """
+
+        row = self.index(key_column)[key]
+        if value_column is None:
+            return self.getRow(row)
+
+        return self.column(value_column)[row]
+
+    def addRow(self,column_values,line=None,column_delimiter="\t"):
+        """
+        Append a row given as a list of values in column order.  line is the
+        original text, used for error messages.
+        """
+
+        column_names = self.column_names
         if len(column_values) > len(column_names):
             warning = "There are more data columns than data names for this\n"
             warning += "line.  This usually occurs if you added a '%s' within\n" \
@@ -44,20 +132,58 @@ class NameObject:
             warning += "\n\n"
 
             sys.stderr.write(warning)
-    
-        try:
-            self.columns = dict([(column_names[i],column_values[i]) 
-                                 for i in range(len(column_names))])
-        except IndexError:
+
+        elif len(column_values) < len(column_names):
             err = "There is an error in the following line:\n\n"
-            err += line
+            err += "%s" % line
             err += "\n\nIncorrect number of columns?\n"
 
             raise EditNamesError(err)
 
-        # make it so all column values can be accessed by a simple 
-        # s.internal_name nomenclature
-        self.__dict__.update(self.columns)
+        for i, c in enumerate(column_names):
+            self.columns[c].append(column_values[i])
+
+        self._indexes = {}
+
+    def save(self,cache_file,source_stat=None):
+        """
+        Write the table to cache_file as an uncompressed numpy .npz archive
+        holding one string array per column (no pickled objects).
+        source_stat (the os.stat of the text file the table came from) is
+        stored so the cache can be checked for staleness.
+        """
+
+        stamp = np.zeros(0,dtype=np.float64)
+        if source_stat is not None:
+            stamp = np.array([source_stat.st_mtime,source_stat.st_size],
+                             dtype=np.float64)
+
+        arrays = {"stamp":stamp,
+                  "column_names":np.array(self.column_names,dtype=str)}
+        for i, c in enumerate(self.column_names):
+            arrays["column_%i" % i] = np.array(self.columns[c],dtype=str)
+
+        with open(cache_file,'wb') as f:
+            np.savez(f,**arrays)
+
+    @staticmethod
+    def load(cache_file,source_stat=None):
+        """
+        Load a table written by save, returning None if it does not match
+        source_stat.  Pickled data is never loaded.
+        """
+
+        with np.load(cache_file,allow_pickle=False) as data:
+            stamp = tuple(data["stamp"].tolist())
+            if source_stat is not None:
+                if stamp != (source_stat.st_mtime,float(source_stat.st_size)):
+                    return None
+
+            column_names = data["column_names"].tolist()
+            columns = dict([(c,data["column_%i" % i].tolist())
+                            for i, c in enumerate(column_names)])
+
+        return NameTable(column_names,columns)
 
 
 def checkUniqueness(some_list):
@@ -66,16 +192,13 @@ def checkUniqueness(some_list):
     non-unique values.
     """
 
-    unique_list = dict([(x,[]) for x in some_list]).keys()
-    repeated_entries = [u for u in unique_list 
-                        if len([s for s in some_list if s == u]) > 1]
+    counts = collections.Counter(some_list)
 
-    return repeated_entries
+    return [u for u in counts if counts[u] > 1]
 
-def readMasterFile(name_file,column_delimiter="\t"):
+def parseMasterFile(name_file,column_delimiter="\t"):
     """
-    Read a delimited (usually comma-delimited) file that has a set of sequence
-    attributes under a unique internal_name.
+    Parse a delimited master file into a NameTable.
     """
 
     f = open(name_file,'r')
@@ -95,20 +218,49 @@ def readMasterFile(name_file,column_delimiter="\t"):
         raise EditNamesError(err)
  
     # Make sure column names are not repeated more than once 
-    for k in column_dict.keys():
-        num_col_in_file = len([c for c in column_names if c == k])
-        if num_col_in_file > 1:
+    if len(column_dict) != len(column_names):
+        for k in checkUniqueness(column_names):
             err = "column '%s' occurs more than once in the file!\n" % k
             raise EditNamesError(err)
 
     # Load all names 
-    names = []
+    names = NameTable(column_names)
     for l in lines[1:]:
-        names.append(NameObject(l,column_names,column_delimiter))
- 
+        names.addRow([c.strip() for c in l.split(column_delimiter)],l,
+                     column_delimiter)
+
+    return names
+
+def readMasterFile(name_file,column_delimiter="\t",use_cache=True):
+    """
+    Read a delimited (usually comma-delimited) file that has a set of sequence
+    attributes under a unique internal_name, returning a NameTable.  The
+    parsed table is cached as name_file.cache (tab-delimited files only) and
+    reused as long as the text file's modification time and size have not
+    changed.
+    """
+
+    cache_file = "%s.cache" % name_file
+    use_cache = use_cache and column_delimiter == "\t"
+    source_stat = os.stat(name_file)
+
+    names = None
+    if use_cache and os.path.exists(cache_file):
+        try:
+            names = NameTable.load(cache_file,source_stat)
+        except (IOError,OSError,ValueError,KeyError,zipfile.BadZipFile):
+            names = None
+
+    if names is None:
+        names = parseMasterFile(name_file,column_delimiter)
+        if use_cache:
+            try:
+                names.save(cache_file,source_stat)
+            except (IOError,OSError):
+                pass
+
     # make sure all internal_names are unique 
-    internal_names = [n.internal_name for n in names]
-    repeated_names = checkUniqueness(internal_names)
+    repeated_names = checkUniqueness(names.column("internal_name"))
     if len(repeated_names) != 0: 
         err = "internal_name column must have unique entry for every line!\n"
         err += "The following entries are repeated:\n\n"
@@ -118,30 +270,133 @@ def readMasterFile(name_file,column_delimiter="\t"):
         raise EditNamesError(err)
 
     return names
-  
 
-def modifyFile(file_to_modify,names,key_column,value_column):
+def registryCandidates(file_to_modify,tokenize=False,chunk_size=1048576):
     """
-    Read a file and replace all instances of the key_column with value_column
-    where key_column and value_column are defined uniquely for each sequence
-    in names.
+    Yield the strings in file_to_modify that could be registry keys: every
+    Newick/fasta name token and, unless tokenize, every whole line with any
+    leading ">" removed (so fasta headers containing spaces are found).  The
+    file is read in chunks of chunk_size characters; lines longer than a
+    chunk are only split into tokens.
     """
 
-    f = open(file_to_modify)
-    contents = f.read()
-    f.close()
+    carry = ""
+    split_line = False
+    with open(file_to_modify,'r') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            at_end = chunk == ""
+            buffer = carry + chunk
+
+            # Cut after the last complete line or, failing that, before a
+            # token that may continue into the next chunk
+            cut = len(buffer) if at_end else buffer.rfind("\n") + 1
+            whole_lines = cut > 0
+            if not whole_lines:
+                cut = len(buffer)
+                while cut > 0 and NAME_TOKEN.match(buffer[cut-1]):
+                    cut -= 1
+
+            for token in NAME_TOKEN.findall(buffer,0,cut):
+                yield token
+
+            if not tokenize:
+                lines = buffer[:cut].split("\n")
+                if not at_end:
+                    lines = lines[:-1]
+                if split_line:
+                    lines = lines[1:]
+                for line in lines:
+                    line = line.strip()
+                    if line.startswith(">"):
+                        line = line[1:].strip()
+                    if line != "":
+                        yield line
+
+            split_line = not whole_lines
+            carry = buffer[cut:]
+
+            if at_end:
+                break
+
+def readRegistry(db_file,file_to_modify,key_column,tokenize=False,
+                 batch_size=100000):
+    """
+    Load the names in a nameRegistry SQLite registry whose key_column
+    appears in file_to_modify (see registryCandidates) into a NameTable with
+    the same columns as a name file.  Candidates are looked up in batches of
+    batch_size through the registry's indexes, so only the names needed are
+    read.  Without tokenize, keys are therefore only found as whole name
+    tokens or whole lines, not as arbitrary substrings.
+    """
+
+    if key_column not in nameRegistry.NAME_FILE_COLUMNS:
+        err = "Registry key column must be one of %s\n" % \
+            ", ".join(nameRegistry.NAME_FILE_COLUMNS)
+        raise EditNamesError(err)
+    registry_column = nameRegistry.REGISTRY_COLUMNS[nameRegistry.NAME_FILE_COLUMNS.index(key_column)]
+
+    registry = nameRegistry.NameRegistry(db_file)
+    found = {}
+
+    def lookupBatch(candidates):
+        if registry_column == "number":
+            candidates = [int(c) for c in candidates if c.isdigit()]
+        for rows in registry.lookup(registry_column,candidates).values():
+            for row in rows:
+                found[row[0]] = row
+
+    candidates = set()
+    for c in registryCandidates(file_to_modify,tokenize):
+        candidates.add(c)
+        if len(candidates) == batch_size:
+            lookupBatch(candidates)
+            candidates = set()
+    lookupBatch(candidates)
+
+    registry.close()
+
+    column_names = nameRegistry.NAME_FILE_COLUMNS[:]
+    columns = dict([(c,[]) for c in column_names])
+    for number in sorted(found):
+        row = found[number]
+        columns["number"].append(str(row[0]))
+        for c, v in zip(column_names[1:],row[1:]):
+            columns[c].append(v)
+
+    return NameTable(column_names,columns)
+
+def registerNames(names,db_file):
+    """
+    Record the names in a NameTable (read from a name file) in a
+    nameRegistry SQLite registry, keeping their internal names.  Returns the
+    number of names that were not already registered.
+    """
+
+    empty = [""]*len(names)
+    columns = [names.column("internal_name")]
+    for c in ["id","species","pretty_name"]:
+        columns.append(names.columns.get(c,empty))
+
+    registry = nameRegistry.NameRegistry(db_file)
+    added = registry.registerNames(zip(*columns))
+    registry.close()
+
+    return added
+  
+
+# Characters that delimit names in Newick and fasta files
+NAME_TOKEN = re.compile(r"[^(),:;\[\]'>\s]+")
+
+def nameDictionary(names,key_column,value_column):
+    """
+    Return a dictionary mapping key_column to value_column for every sequence
+    in the NameTable names, making sure the keys are unique.
+    """
 
     # Grab keys and values from every sequence
-    keys = []
-    values = []
-    for n in names:
-        try:
-            keys.append(n.columns[key_column])
-            values.append(n.columns[value_column])
-        except KeyError:
-            err = "Sequences '%s' does not have '%s' or '%s'!\n\n" % \
-                (n.internal_name,key_column,value_column)
-            raise EditNamesError(err)
+    keys = names.column(key_column)
+    values = names.column(value_column)
 
     # Check keys and values to make sure they are unique
     repeated_keys = checkUniqueness(keys)
@@ -150,23 +405,104 @@ def modifyFile(file_to_modify,names,key_column,value_column):
         err += "The following entries are repeated:\n\n"
         err += "\n".join(repeated_keys)
         err += "\n\n"
+        raise EditNamesError(err)
     repeated_values = checkUniqueness(values)
     if len(repeated_values) != 0:
-        err = "Column '%s' has non-unique entries!\n" % value_column
-        err += "The following entries are repeated:\n\n"
-        err += "\n".join(repeated_values)
-        err += "\n\n"
+        warning = "Column '%s' has non-unique entries!\n" % value_column
+        warning += "The following entries are repeated:\n\n"
+        warning += "\n".join(repeated_values)
+        warning += "\n\n"
+        sys.stderr.write(warning)
+
+    return dict(zip(keys,values))
+
+def modifyFile(file_to_modify,names,key_column,value_column,tokenize=False):
+    """
+    Read a file and replace all instances of the key_column with value_column
+    where key_column and value_column are defined uniquely for each sequence
+    in names.  If tokenize is True, only whole Newick/fasta name tokens are
+    replaced.
+    """
+
+    f = open(file_to_modify)
+    contents = f.read()
+    f.close()
+
+    # Replace every key with its value in a single pass over the file
+    name_dictionary = nameDictionary(names,key_column,value_column)
+    if len(name_dictionary) == 0:
+        return contents
+
+    if tokenize:
+        replace = lambda m: name_dictionary.get(m.group(0),m.group(0))
+        contents = NAME_TOKEN.sub(replace,contents)
+    else:
+        replace = lambda m: name_dictionary[m.group(0)]
+        contents = phyloBase.buildKeyRegex(name_dictionary.keys()).sub(replace,contents)
 
-    # Use regular experessions to replace all instances of key with value in the
-    # file.
-    name_dictionary = dict(zip(keys,values))
-    for key in name_dictionary.keys():
-        k = re.compile(key)
-        num_counts = len(k.findall(contents))
-        contents = k.sub("%s" % name_dictionary[key],contents,count=num_counts)
-        
     return contents
 
+def streamModifyFile(file_to_modify,names,key_column,value_column,
+                     out=sys.stdout,tokenize=False,chunk_size=1048576):
+    """
+    Same replacement as modifyFile, but read file_to_modify in chunks of
+    chunk_size characters and write each processed chunk to out as it goes.
+    The last (longest key - 1) characters of each chunk are carried into the
+    next one, so a key straddling a chunk boundary is still found; only
+    matches that start before the carried tail are replaced in a given chunk.
+    In tokenize mode the carried tail is the partial token at the end of the
+    chunk.
+    """
+
+    name_dictionary = nameDictionary(names,key_column,value_column)
+    if len(name_dictionary) == 0:
+        tokenize = True
+    elif not tokenize:
+        key_regex = phyloBase.buildKeyRegex(name_dictionary.keys())
+        overlap = max([len(k) for k in name_dictionary.keys()]) - 1
+
+    carry = ""
+    with open(file_to_modify,'r') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            at_end = chunk == ""
+            buffer = carry + chunk
+
+            if tokenize:
+
+                # Hold back a token that may continue into the next chunk
+                safe = len(buffer)
+                if not at_end:
+                    while safe > 0 and NAME_TOKEN.match(buffer[safe-1]):
+                        safe -= 1
+
+                replace = lambda m: name_dictionary.get(m.group(0),m.group(0))
+                out.write(NAME_TOKEN.sub(replace,buffer[:safe]))
+                carry = buffer[safe:]
+
+            else:
+
+                # Replace matches starting before the carried tail; these fit
+                # entirely within the buffer.
+                safe = len(buffer) if at_end else max(len(buffer) - overlap,0)
+                pieces = []
+                position = 0
+                while True:
+                    m = key_regex.search(buffer,position)
+                    if m == None or m.start() >= safe:
+                        break
+                    pieces.append(buffer[position:m.start()])
+                    pieces.append(name_dictionary[m.group(0)])
+                    position = m.end()
+
+                cut = max(position,safe)
+                pieces.append(buffer[position:cut])
+                out.write("".join(pieces))
+                carry = buffer[cut:]
+
+            if at_end:
+                break
+
 def main(argv=None):
     """
     Read the command line and master file, then alter contents of 
@@ -184,10 +520,43 @@ def main(argv=None):
         err = "Incorrect number of arguments!\n\nUsage:\n\n%s\n\n" % __usage__
         raise EditNamesError(err)
 
-    names = readMasterFile(master_file)
-    out = modifyFile(file_to_modify,names,key_column,value_column)
+    tokenize = False
+    stream = False
+    registry_file = None
+    i = 4
+    while i < len(argv):
+        a = argv[i]
+        if a == "-t":
+            tokenize = True
+        elif a == "-s":
+            stream = True
+        elif a == "-r":
+            try:
+                registry_file = argv[i+1]
+            except IndexError:
+                err = "-r requires a registry file!\n\nUsage:\n\n%s\n\n" % __usage__
+                raise EditNamesError(err)
+            i += 1
+        else:
+            err = "Argument %s not recognized!\n\nUsage:\n\n%s\n\n" % (a,__usage__)
+            raise EditNamesError(err)
+        i += 1
+
+    if nameRegistry.isRegistry(master_file):
+        names = readRegistry(master_file,file_to_modify,key_column,tokenize)
+    else:
+        names = readMasterFile(master_file)
+        if registry_file != None:
+            registerNames(names,registry_file)
+
+    if stream:
+        streamModifyFile(file_to_modify,names,key_column,value_column,
+                         sys.stdout,tokenize)
+        return
+
+    out = modifyFile(file_to_modify,names,key_column,value_column,tokenize)
 
-    print out
+    print(out)
 
 if __name__ == "__main__":
     main()
@@ -4,58 +4,110 @@ __description__ = \
 Take an alignment and create an R-readable table in which each site is mapped 
 a gap (0) or non-gap (1) for each taxon.  This can then be fed to APE for a 
 character reconstruction.
+
+With -b the gap matrix is instead written as packed bits (eight sites per
+byte, most significant bit first, rows padded to a whole byte).  If out_file
+ends in .npy it is a (num_taxa x ceil(num_sites/8)) uint8 numpy array;
+otherwise it is a text header line "GAPBITS num_taxa num_sites", one taxon
+name per line, then the packed rows.
 """
 __author__ = "Michael J. Harms"
 __date__ = "2015-07-28"
-__usage__ = "encode_gaps_as_characters.py fasta_file"
+__usage__ = "encode_gaps_as_characters.py fasta_file [-b out_file]"
 
-import sys, string
+import sys, io
 
-def encode_gaps(fasta_file):
+import numpy as np
+
+import phyloBase
+
+def gapMatrix(fasta_file):
     """
+    Return the taxon names and a (num_taxa x num_sites) uint8 matrix that is 0
+    for gaps and 1 for any other character.
     """
-    
-    character_map = dict([(char,1) for char in string.ascii_uppercase])
-    character_map["-"] = 0   
 
-    taxon = None
-    sequence = []
+    alignment = phyloBase.Alignment(phyloBase.FastaFile(fasta_file,strict=False).sequences)
+    mask = np.logical_not(alignment.gapMask()).view(np.uint8)
 
-    out_dict = {}
-    with open(fasta_file,'r') as f:
+    return alignment.headers, mask
 
-        for line in f:
+def writeGapTable(taxa,mask,out=sys.stdout,block_rows=256):
+    """
+    Write the gap matrix as a whitespace-delimited table.  Each row of 8
+    character cells is built as one uint8 array rather than formatted cell
+    by cell, and rows are written out in blocks.
+    """
 
-            if line.startswith(">"):
-                if taxon:
-                    character_array = [character_map[s] for s in sequence]
-                    out_dict[taxon] = character_array[:]
+    num_sites = mask.shape[1]
 
-                    sequence = []
+    header = ["{:12s} {:12s}".format("  ","taxon")]
+    for i in range(num_sites):
+        header.append("{:8s}".format("s{:d}".format(i)))
+    out.write("".join(header))
 
-                taxon = line[1:].strip()
-        
+    cells = np.full((min(block_rows,len(taxa)),num_sites,8),ord(" "),dtype=np.uint8)
+    for start in range(0,len(taxa),block_rows):
+        block = mask[start:start+block_rows]
+        cells[:len(block),:,7] = block + ord("0")
 
-            else:
-                if taxon:
-                    sequence.extend(list(line.strip()))
+        lines = []
+        for i in range(len(block)):
+            lines.append("\n{:12d} {:12s}".format(start + i,taxa[start + i]))
+            lines.append(cells[i].tobytes().decode())
+        out.write("".join(lines))
 
-    if taxon:
-        character_array = [character_map[s] for s in sequence]
-        out_dict[taxon] = character_array[:]
-       
-    num_sites = len(list(out_dict.values())[0])
+    out.write("\n")
 
-    header = ["{:12s} {:12s}".format("  ","taxon")]
-    for i in range(num_sites):
-        header.append("{:8s}".format("s{:d}".format(i)))
-    
-    out = ["".join(header)]
-    for i, k in enumerate(list(out_dict.keys())):
-        x = "".join(["{:8d}".format(j) for j in out_dict[k]])
-        out.append("{:12d} {:12s}{:s}".format(i,k,x))
+def writeGapBits(taxa,mask,out_file):
+    """
+    Write the gap matrix as packed bits (see module description for the
+    layout).
+    """
+
+    packed = np.packbits(mask,axis=1)
 
-    return "\n".join(out)
+    if out_file.endswith(".npy"):
+        np.save(out_file,packed)
+        return
+
+    with open(out_file,'wb') as f:
+        f.write(("GAPBITS %i %i\n" % mask.shape).encode())
+        f.write("".join(["%s\n" % t for t in taxa]).encode())
+        f.write(packed.tobytes())
+
+def readGapBits(gap_file):
+    """
+    Read a header-plus-bits gap file, returning the taxon names and the
+    (num_taxa x num_sites) uint8 gap matrix.
+    """
+
+    with open(gap_file,'rb') as f:
+        magic, num_taxa, num_sites = f.readline().split()
+        if magic != b"GAPBITS":
+            err = "{:s} is not a gap bits file\n".format(gap_file)
+            raise IOError(err)
+        num_taxa = int(num_taxa)
+        num_sites = int(num_sites)
+
+        taxa = [f.readline().decode().rstrip("\n") for i in range(num_taxa)]
+        packed = np.frombuffer(f.read(),dtype=np.uint8)
+
+    packed = packed.reshape(num_taxa,(num_sites + 7)//8)
+
+    return taxa, np.unpackbits(packed,axis=1)[:,:num_sites]
+
+def encode_gaps(fasta_file):
+    """
+    Return the gap table for fasta_file as a string.
+    """
+
+    taxa, mask = gapMatrix(fasta_file)
+
+    out = io.StringIO()
+    writeGapTable(taxa,mask,out)
+
+    return out.getvalue().rstrip("\n")
 
 
 def main(argv=None):
@@ -69,7 +121,18 @@ def main(argv=None):
         err = "incorrect arguments. Usage:\n\n{:s}\n\n".format(__usage__)
         raise IndexError(err)
 
-    return encode_gaps(fasta_file)
+    bits_file = None
+    if len(argv) > 1:
+        if argv[1] != "-b" or len(argv) != 3:
+            err = "incorrect arguments. Usage:\n\n{:s}\n\n".format(__usage__)
+            raise IndexError(err)
+        bits_file = argv[2]
+
+    taxa, mask = gapMatrix(fasta_file)
+    if bits_file != None:
+        writeGapBits(taxa,mask,bits_file)
+    else:
+        writeGapTable(taxa,mask,sys.stdout)
 
 if __name__ == "__main__":
-    print(main())
+    main()
@@ -1,14 +1,25 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
 Convert a fasta alignment file into a phylip alignment file.  Took some tweaking,
 but this precise format of phylip file can be read successfully into phyml.
+
+The fasta file is streamed twice: once to collect names and lengths, once to
+write.  Interleaved output reads each block of columns straight from the
+file through a phyloBase.FastaIndex, so the alignment is never held in
+memory; this needs a file whose records have regular line lengths.  By
+default names are truncated to 10 characters (strict phylip) and the output
+is sequential.  -r writes relaxed phylip (full names, with whitespace
+replaced by "_"); -i writes interleaved phylip.  Names that collide after
+truncation are reported as an error rather than written.
 """
 __author__ = "Michael J. Harms"
 __date__ = "100530"
-__usage__ = "./fasta2phylip.py fasta"
+__usage__ = "./fasta2phylip.py fasta [-i] [-r]"
+
+import sys, re
 
-import sys
+import phyloBase
 
 class Fasta2PhylipError(Exception):
     """
@@ -17,45 +28,120 @@ class Fasta2PhylipError(Exception):
 
     pass
 
-
-def fasta2phylip(lines):
+def phylipNames(headers,relaxed=False):
     """
-    Take the lines from a fasta file and return in fasta format.
+    Convert fasta headers into phylip names: the first 10 characters, or (if
+    relaxed) the whole header with runs of whitespace replaced by "_".  Raises
+    an error listing every name that more than one header maps onto.
     """
 
-    lines = [l for l in lines if l.strip() != ""]
+    if relaxed:
+        names = [re.sub(r"\s+","_",h) for h in headers]
+    else:
+        names = [h[:10] for h in headers]
 
-    # Read fasta file
-    out = []
-    for l in lines:
-        if l[0] == ">":
-            if len(out) != 0:
-                out.append("\n")
-            out.append("%-10s" % l[1:11])
-        else:
-            out.append(l.strip())
+    seen = {}
+    for h, n in zip(headers,names):
+        seen.setdefault(n,[]).append(h)
+
+    collisions = [n for n in names if len(seen[n]) > 1]
+    if len(collisions) > 0:
+        err = "Some sequences have the same phylip name!\n"
+        for n in sorted(set(collisions)):
+            err += "%s: %s\n" % (n,", ".join(seen[n]))
+        raise Fasta2PhylipError(err)
+
+    return names
 
-    out = "".join(out)
-    split_out = out.split("\n")
+def checkLengths(headers,lengths,fasta_file):
+    """
+    Make sure there is at least one sequence and every sequence has the same
+    length, returning that length.
+    """
+
+    if len(headers) == 0:
+        err = "No sequences found in %s\n" % fasta_file
+        raise Fasta2PhylipError(err)
 
-    # Quick sanity check
-    lengths = dict([(len(l),i) for (i,l) in enumerate(split_out)])
-    if len(lengths) > 1:
+    first_header = {}
+    for h, l in zip(headers,lengths):
+        first_header.setdefault(int(l),h)
+
+    if len(first_header) > 1:
         err = "Some sequences have different lengths!\n"
-        for d in lengths.keys():
-            err = "%s, %i\n" % (split_out[lengths[d]][:10],d)
-    
+        for d in sorted(first_header.keys()):
+            err += "%s, %i\n" % (first_header[d],d)
         raise Fasta2PhylipError(err)
 
-    num_seq = len(split_out)
-    num_columns = lengths.keys()[0]
+    return list(first_header.keys())[0]
 
-    to_write = ["%s\n%s\n" % (o[:10],o[10:]) for o in split_out]
-    to_write = "".join(to_write)
+def scanAlignment(fasta_file):
+    """
+    First pass: return the headers and the alignment length, checking that
+    every sequence has the same length.  Only headers are held in memory.
+    """
+
+    headers = []
+    lengths = []
+    for header, sequence in phyloBase.FastaFile.iterRecords(fasta_file):
+        headers.append(header)
+        lengths.append(len(sequence))
 
-    final_out = "%i  %i\n\n%s\n" % (num_seq,num_columns-10,to_write)
+    return headers, checkLengths(headers,lengths,fasta_file)
 
-    return final_out
+def fasta2phylip(fasta_file,out=sys.stdout,interleaved=False,relaxed=False,
+                 line_width=60,lines_per_write=4096):
+    """
+    Convert fasta_file to phylip, writing to the file object out.  Sequential
+    output is streamed record by record.  Interleaved output uses a
+    phyloBase.IndexedFastaFile (building fasta_file.fai if needed) and reads
+    each block of line_width columns for each record straight from the
+    file, writing lines_per_write lines at a time.
+    """
+
+    if not interleaved:
+        headers, num_columns = scanAlignment(fasta_file)
+        names = phylipNames(headers,relaxed)
+
+        out.write("%i  %i\n\n" % (len(names),num_columns))
+        records = phyloBase.FastaFile.iterRecords(fasta_file)
+        name_width = 0 if relaxed else 10
+        for n, (header, sequence) in zip(names,records):
+            out.write("%-*s\n%s\n" % (name_width,n,sequence))
+        out.write("\n\n")
+        return
+
+    fasta = phyloBase.IndexedFastaFile(fasta_file)
+    try:
+        headers = fasta.index.names
+        num_columns = checkLengths(headers,fasta.index.lengths,fasta_file)
+        names = phylipNames(headers,relaxed)
+        num_seq = len(names)
+
+        if relaxed:
+            width = max([len(n) for n in names]) + 2
+        else:
+            width = 10
+
+        out.write("%i %i\n" % (num_seq,num_columns))
+        for start in range(0,num_columns,line_width):
+            end = min(start + line_width,num_columns)
+            lines = []
+            for i in range(num_seq):
+                block = fasta.getSubsequence(headers[i],start,end)
+                if start == 0:
+                    lines.append("%-*s%s\n" % (width,names[i],block))
+                else:
+                    lines.append("%s\n" % block)
+
+                if len(lines) == lines_per_write:
+                    out.write("".join(lines))
+                    lines = []
+
+            out.write("".join(lines))
+            out.write("\n")
+    finally:
+        fasta.close()
 
 def main(argv=None):
     """
@@ -68,16 +154,21 @@ def main(argv=None):
     try:
         filename = argv[0]
     except IndexError:
-        print __usage__
+        print(__usage__)
         sys.exit()
 
-    f = open(filename)
-    lines = f.readlines()
-    f.close()
+    interleaved = False
+    relaxed = False
+    for a in argv[1:]:
+        if a == "-i":
+            interleaved = True
+        elif a == "-r":
+            relaxed = True
+        else:
+            err = "Argument %s not recognized!\n\n%s\n\n" % (a,__usage__)
+            raise Fasta2PhylipError(err)
 
-    return "".join(fasta2phylip(lines))
+    fasta2phylip(filename,sys.stdout,interleaved,relaxed)
 
 if __name__ == "__main__":
-    print main()
-
-
+    main()
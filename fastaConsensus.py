@@ -1,16 +1,31 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
 fastaConsensus.py
 
-Create a consensus sequence from a fasta file.
+Create a consensus sequence from a fasta file.  By default the most common
+character in each column wins (plurality).  -m requires the winner to make up
+more than half of the column (majority); -t sets any other threshold.  Columns
+that fail the threshold are written as "X", or with -a as an IUPAC-style
+ambiguity code (B = D/N, Z = E/Q, J = I/L, X = anything else).  -n excludes
+gaps from the counts.
+
+Column counts are accumulated as records stream past, so the alignment is
+never held in memory.  Several fasta files (shards of one alignment) can be
+given at once, and -p counts them in parallel.  -c counts.npz adds to the
+counts stored in counts.npz (if it exists) and writes the updated counts back,
+so a consensus can be updated as sequences are appended.
 """
 __author__ = "Michael J. Harms"
 __date__ = "2014-11-19"
-__usage__ = "fastaConsensus.py fasta_file"
+__usage__ = "fastaConsensus.py fasta_file [fasta_file2 ...] [-m] [-t threshold] [-a] [-n] [-p num_processes] [-c counts.npz]"
+
 
+import sys, os, string, multiprocessing
 
-import sys, string
+import numpy as np
+
+import phyloBase
 
 class ConsensusError(Exception):
     """
@@ -19,77 +34,332 @@ class ConsensusError(Exception):
 
     pass
 
-def createConsensus(fasta_file,include_gaps=True):
+# Amino acids counted in the consensus (uppercase letters less the ambiguity
+# and non-standard codes)
+AMINO_ACIDS = [a for a in string.ascii_uppercase if a not in "BJOUXZ"]
+
+# Ambiguity codes for sets of residues that fail the threshold
+AMBIGUITY_CODES = [("B",set("DN")),("Z",set("EQ")),("J",set("IL"))]
+
+def countAlphabet(include_gaps=True):
     """
-    Create a most-common-wins consensus sequence.  If include_gaps is true, a
-    '-' character can be the most common and win in the consensus.
+    Return the list of characters counted in each column.
     """
 
-    # Read file
-    f = open(fasta_file,'r')
-    lines = f.readlines()
-    f.close()
+    index_to_aa = AMINO_ACIDS[:]
+    if include_gaps:
+        index_to_aa.append("-")
 
-    # Read in all sequences
-    current_seq = None
-    sequences = []
-    for l in lines:
-        if l[0] == ">":
-            if current_seq != None:
-                sequences.append(list(current_seq))
-            current_seq = []
-        else:
-            current_seq.extend(l.strip())
-    sequences.append(list(current_seq))
+    return index_to_aa
 
-    # Sanity check; sequences should be same length
-    unique_lengths = dict([(len(s),[]) for s in sequences]).keys()
-    if len(unique_lengths) != 1:
-        err = "fasta file has sequences of different length!"
-        raise ConsensusError(err)
+def countColumns(matrix,index_to_aa,max_block=4194304):
+    """
+    Count how often each character in index_to_aa occurs in each column of a
+    (num_seq x length) uint8 matrix.  Returns a (length x len(index_to_aa))
+    int64 array.  Characters are mapped to count indexes through a byte lookup
+    table and tallied with a single bincount per block of rows, offsetting
+    each column into its own stretch of bins; anything not in index_to_aa
+    lands in a discard bin.  Blocks hold at most max_block residues.
+    """
 
-    # Create list that maps indexes to letters
-    index_to_aa = list(string.letters[26:])
-    index_to_aa.remove("B")
-    index_to_aa.remove("J")
-    index_to_aa.remove("O")
-    index_to_aa.remove("U")
-    index_to_aa.remove("X")
-    index_to_aa.remove("Z")
-    if include_gaps:
-        index_to_aa.append("-")
+    num_states = len(index_to_aa) + 1
+    length = matrix.shape[1]
 
-    # Create dictionary that maps letters to indexes
-    aa_to_index = dict([(k,i) for i, k in enumerate(index_to_aa)])
+    lookup = np.full(256,num_states - 1,dtype=np.intp)
+    for i, aa in enumerate(index_to_aa):
+        lookup[ord(aa)] = i
 
-    # Create a possible_characters x sequence_length array 
-    out_array = [[0 for j in range(len(index_to_aa))]
-                 for i in range(len(sequences[0]))]
+    column_offsets = np.arange(length,dtype=np.intp)*num_states
 
-    # Count how often each amino acid is seen in each column by looping over
-    # seuqences
-    for seq in sequences:
-        for i, s in enumerate(seq):
-            try:
-                index = aa_to_index[s]
-                out_array[i][index] += 1
-            except KeyError:
-                pass
-
-    # Create the consensus sequence
-    consensus = []
-    for i in range(len(out_array)):
-        x = [(out_array[i][j],j) for j in range(len(out_array[i]))]
-        x.sort(reverse=True)
-
-        # In this case, the first and second most common are the same.  Use the
-        # first one, but report the ambiguity with a "#" at the top of the 
-        # output.
-        if x[0][0] == x[1][0]:
-            print "# %i: %i %s, %i %s" % (i, x[0][0],index_to_aa[x[0][1]],
-                                             x[1][0],index_to_aa[x[1][1]])
-
-        consensus.append(index_to_aa[x[0][1]])
+    counts = np.zeros(length*num_states,dtype=np.int64)
+    block_rows = max(1,max_block//max(length,1))
+    for i in range(0,matrix.shape[0],block_rows):
+        bins = lookup[matrix[i:i+block_rows]] + column_offsets
+        counts += np.bincount(bins.ravel(),minlength=length*num_states)
+
+    return counts.reshape(length,num_states)[:,:-1]
+
+def _ambiguityCode(residues):
+    """
+    Return the ambiguity code covering a set of residues.
+    """
+
+    for code, members in AMBIGUITY_CODES:
+        if residues.issubset(members):
+            return code
+
+    return "X"
+
+def callConsensus(counts,index_to_aa,threshold=0.0,ambiguity=False):
+    """
+    Call a consensus from a (length x len(index_to_aa)) count matrix.  The
+    most common character wins if it makes up more than threshold of the
+    counted characters in its column (threshold = 0 is plurality, 0.5 is
+    majority).  Otherwise the column is "X" or, if ambiguity is True, the
+    ambiguity code for the smallest set of most-common characters that
+    clears the threshold.  Ties are resolved in favor of the later character
+    in index_to_aa, and reported.
+
+    Returns the consensus as a list of characters and a list of
+    (column,count1,aa1,count2,aa2) tuples for tied columns.
+    """
+
+    num_states = counts.shape[1]
+    index_to_aa = np.array(index_to_aa)
+
+    # Sort each column from most to least common, breaking ties toward the
+    # later character
+    order = np.argsort(-(counts*num_states + np.arange(num_states)),axis=1)
+    sorted_counts = np.take_along_axis(counts,order,axis=1)
+
+    totals = counts.sum(axis=1)
+    fractions = sorted_counts[:,0]/np.maximum(totals,1)
+
+    consensus = index_to_aa[order[:,0]]
+    passed = np.logical_and(totals > 0,fractions > threshold)
+
+    ties = []
+    if num_states > 1:
+        for i in np.flatnonzero(sorted_counts[:,0] == sorted_counts[:,1]):
+            ties.append((int(i),int(sorted_counts[i,0]),index_to_aa[order[i,0]],
+                         int(sorted_counts[i,1]),index_to_aa[order[i,1]]))
+
+    consensus = list(consensus)
+    for i in np.flatnonzero(np.logical_not(passed)):
+
+        if not ambiguity or totals[i] == 0:
+            consensus[i] = "X"
+            continue
+
+        # Add most-common residues until together they clear the threshold,
+        # taking in anything tied with the last one added
+        cumulative = np.cumsum(sorted_counts[i])/totals[i]
+        n = int(np.searchsorted(cumulative,threshold,side="right")) + 1
+        n = min(n,num_states)
+        while n < num_states and sorted_counts[i,n] == sorted_counts[i,n-1]:
+            n += 1
+
+        consensus[i] = _ambiguityCode(set(index_to_aa[order[i,:n]]))
+
+    return consensus, ties
+
+class ColumnCounts:
+    """
+    Accumulate column x character counts for an alignment.  Counts from
+    separate chunks of records, files or processes can be merged with + and
+    saved to/loaded from a .npz file.
+    """
+
+    def __init__(self,include_gaps=True,index_to_aa=None):
+        """
+        Create an empty set of counts.  The alignment length is set by the
+        first records added.
+        """
+
+        if index_to_aa is None:
+            index_to_aa = countAlphabet(include_gaps)
+
+        self.index_to_aa = list(index_to_aa)
+        self.length = None
+        self.num_seqs = 0
+        self.counts = None
+
+    def _checkLength(self,length):
+        """
+        Set the alignment length, or make sure it matches the current one.
+        """
+
+        if self.length is None:
+            self.length = length
+            self.counts = np.zeros((length,len(self.index_to_aa)),dtype=np.int64)
+        elif length != self.length:
+            err = "fasta file has sequences of different length!"
+            raise ConsensusError(err)
+
+    def addMatrix(self,matrix):
+        """
+        Add the counts for a (num_seq x length) uint8 matrix.
+        """
+
+        self._checkLength(matrix.shape[1])
+        self.counts += countColumns(matrix,self.index_to_aa)
+        self.num_seqs += matrix.shape[0]
+
+    def addRecords(self,records,block_size=16777216):
+        """
+        Add the counts for an iterable of (header,sequence) records, building
+        uint8 blocks of at most block_size residues at a time.
+        """
+
+        block = []
+        block_residues = 0
+        for header, sequence in records:
+            self._checkLength(len(sequence))
+            block.append(sequence.upper().encode())
+            block_residues += len(sequence)
+
+            if block_residues >= block_size:
+                self._addBlock(block)
+                block = []
+                block_residues = 0
+
+        if len(block) > 0:
+            self._addBlock(block)
+
+    def _addBlock(self,block):
+        """
+        Add a list of equal-length byte strings.
+        """
+
+        matrix = np.frombuffer(b"".join(block),dtype=np.uint8)
+        self.addMatrix(matrix.reshape(len(block),self.length))
+
+    def addFastaFile(self,fasta_file):
+        """
+        Stream the records in a fasta file into the counts.
+        """
+
+        self.addRecords(phyloBase.FastaFile.iterRecords(fasta_file))
+
+    def __iadd__(self,other):
+        """
+        Merge another set of counts into this one.
+        """
+
+        if other.index_to_aa != self.index_to_aa:
+            err = "Cannot merge counts over different characters.\n"
+            raise ConsensusError(err)
+
+        if other.length is not None:
+            self._checkLength(other.length)
+            self.counts += other.counts
+            self.num_seqs += other.num_seqs
+
+        return self
+
+    def __add__(self,other):
+        """
+        Return the merge of two sets of counts.
+        """
+
+        merged = ColumnCounts(index_to_aa=self.index_to_aa)
+        merged += self
+        merged += other
+
+        return merged
+
+    def save(self,counts_file):
+        """
+        Write the counts to a .npz file.
+        """
+
+        if self.length is None:
+            err = "No sequences have been counted.\n"
+            raise ConsensusError(err)
+
+        with open(counts_file,'wb') as f:
+            np.savez(f,counts=self.counts,index_to_aa=np.array(self.index_to_aa),
+                     num_seqs=self.num_seqs)
+
+    @staticmethod
+    def load(counts_file):
+        """
+        Read counts written by save.
+        """
+
+        with np.load(counts_file) as data:
+            counts = ColumnCounts(index_to_aa=[str(a) for a in data["index_to_aa"]])
+            counts.counts = data["counts"].astype(np.int64)
+            counts.length = counts.counts.shape[0]
+            counts.num_seqs = int(data["num_seqs"])
+
+        return counts
+
+    def callConsensus(self,threshold=0.0,ambiguity=False):
+        """
+        Call a consensus from the counts (see callConsensus).
+        """
+
+        if self.length is None:
+            err = "No sequences have been counted.\n"
+            raise ConsensusError(err)
+
+        return callConsensus(self.counts,self.index_to_aa,threshold,ambiguity)
+
+def _countFastaChunk(args):
+    """
+    Count the records in one byte range of a fasta file.  Run in worker
+    processes by countFastaFiles.
+    """
+
+    fasta_file, start, end, index_to_aa = args
+
+    counts = ColumnCounts(index_to_aa=index_to_aa)
+    counts.addRecords(phyloBase.iterFastaChunk(fasta_file,start,end))
+
+    return counts
+
+def countFastaFiles(fasta_files,include_gaps=True,num_processes=1,
+                    chunks_per_process=4,chunk_bytes=phyloBase.CHUNK_BYTES):
+    """
+    Count the columns of the alignment held in one or more fasta files.  If
+    num_processes is not 1, each file is split into chunks of whole records
+    (at most about chunk_bytes each; see phyloBase.parallelChunks) that are
+    counted in a pool of worker processes (all cores if None), and the
+    partial counts are summed.
+    """
+
+    counts = ColumnCounts(include_gaps)
+
+    if num_processes == 1:
+        for fasta_file in fasta_files:
+            counts.addFastaFile(fasta_file)
+        return counts
+
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+
+    jobs = []
+    for fasta_file in fasta_files:
+        chunks = phyloBase.parallelChunks(fasta_file,num_processes,
+                                          chunks_per_process,chunk_bytes)
+        for start, end in chunks:
+            jobs.append((fasta_file,start,end,counts.index_to_aa))
+
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for partial in pool.imap_unordered(_countFastaChunk,jobs):
+            counts += partial
+    finally:
+        pool.terminate()
+
+    return counts
+
+def createConsensus(fasta_file,include_gaps=True,threshold=0.0,ambiguity=False,
+                    num_processes=1,counts_file=None):
+    """
+    Create a consensus sequence.  If include_gaps is true, a '-' character can
+    be the most common and win in the consensus.  threshold and ambiguity are
+    described in callConsensus.  fasta_file may be a single file or a list of
+    shards; num_processes is passed to countFastaFiles.  If counts_file is
+    given, counts already stored there are added to and the result written
+    back.  Tied columns are reported with a "#" at the top of the output.
+    """
+
+    if isinstance(fasta_file,str):
+        fasta_file = [fasta_file]
+
+    counts = countFastaFiles(fasta_file,include_gaps,num_processes)
+
+    if counts_file is not None:
+        if os.path.exists(counts_file):
+            counts = ColumnCounts.load(counts_file) + counts
+        counts.save(counts_file)
+
+    consensus, ties = counts.callConsensus(threshold,ambiguity)
+
+    for t in ties:
+        print("# %i: %i %s, %i %s" % t)
 
     return consensus
  
@@ -102,18 +372,60 @@ def main(argv=None):
     if argv == None:
         argv = sys.argv[1:]
 
-    try:
-        fasta_file = argv[0]
-    except IndexError:
+    fasta_files = []
+    include_gaps = True
+    threshold = 0.0
+    ambiguity = False
+    num_processes = 1
+    counts_file = None
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a == "-m":
+            threshold = 0.5
+        elif a == "-a":
+            ambiguity = True
+        elif a == "-n":
+            include_gaps = False
+        elif a == "-t":
+            try:
+                threshold = float(argv[i+1])
+            except (IndexError,ValueError):
+                err = "-t requires a threshold between 0 and 1.\n"
+                raise ConsensusError(err)
+            i += 1
+        elif a == "-p":
+            try:
+                num_processes = int(argv[i+1])
+            except (IndexError,ValueError):
+                err = "-p requires a number of processes.\n"
+                raise ConsensusError(err)
+            i += 1
+        elif a == "-c":
+            try:
+                counts_file = argv[i+1]
+            except IndexError:
+                err = "-c requires a counts file.\n"
+                raise ConsensusError(err)
+            i += 1
+        elif a.startswith("-"):
+            err = "Argument %s not recognized. Usage:\n\n%s\n\n" % (a,__usage__)
+            raise ConsensusError(err)
+        else:
+            fasta_files.append(a)
+        i += 1
+
+    if len(fasta_files) == 0:
         err = "Incorrect arguments. Usage:\n\n%s\n\n" % __usage__
         raise ConsensusError(err)
 
     # Create consensus
-    out = createConsensus(fasta_file)
+    out = createConsensus(fasta_files,include_gaps,threshold,ambiguity,
+                          num_processes,counts_file)
 
     return "".join(out)
 
 # If called from the command line, run and print to stdout
 if __name__ == "__main__":
-    print ">consensus"
+    print(">consensus")
     print(main())
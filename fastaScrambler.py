@@ -1,13 +1,21 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
-Scramble the order of a set of entries in a fasta file.
+Scramble the order of a set of entries in a fasta file.  By default the whole
+file is read into memory and shuffled.  -x shuffles out of core: only the byte
+offset of each record is held in memory, and records are read back from disk
+in permuted order.  -k num writes a random subset of num records, chosen in a
+single pass by reservoir sampling.  -s seed makes the output reproducible.
 """
-__usage__ = "fastaScrambler.py fasta_file"
+__usage__ = "fastaScrambler.py fasta_file [-x] [-k num_records] [-s seed]"
 __author__ = "Michael J. Harms"
 __date__ = "110714"
 
-import sys, re, os, random
+import sys, re, os, random, array
+
+import numpy as np
+
+import phyloBase
 
 class FastaScramblerError(Exception):
     """
@@ -16,49 +24,107 @@ class FastaScramblerError(Exception):
 
     pass
 
-def fastaScrambler(fasta_file,collapse=True):
+def fastaScrambler(fasta_file,collapse=True,seed=None):
     """
     Scramble the order of a set of entries in a fasta file.
 
     If collapse == True, collapse the entire sequence onto a single line.
     """
 
-    f = open(fasta_file,'r')
-   
-    out = [] 
-    tmp_out = []
-    line = f.readline()
-    while line != "": 
+    out = []
+    raw_lines = not collapse
+    for header, sequence in phyloBase.FastaFile.iterRecords(fasta_file,raw_lines):
+        if collapse:
+            out.append(">%s\n%s\n" % (header,sequence))
+        else:
+            out.append(">%s\n%s" % (header,"".join(sequence)))
+
+    random.Random(seed).shuffle(out) 
+
+    return out
+
+def recordOffsets(fasta_file):
+    """
+    Return an int64 array with the byte offset of every ">" line in a fasta
+    file, followed by the size of the file (so record i spans
+    offsets[i]:offsets[i+1]).  Costs eight bytes per record.
+    """
+
+    offsets = array.array("q")
+    position = 0
+    with open(fasta_file,'rb',buffering=phyloBase.FastaFile.buffer_size) as f:
+        for line in f:
+            if line.startswith(b">"):
+                offsets.append(position)
+            position += len(line)
 
-        # If this is a new entry...
-        if line.startswith(">"):
+    offsets.append(position)
 
-            # If we've been recording the previous entry, record it
-            if len(tmp_out) != 0:
-                if collapse == True:
-                    tmp_out = [o.strip() for o in tmp_out]
-                    tmp_out[0] = "%s\n" % tmp_out[0]
+    return np.frombuffer(offsets,dtype=np.int64)
 
-                out.append("%s\n" % ("".join(tmp_out)))
-                tmp_out = []
-                
-        tmp_out.append(line)
+def _collapseRecord(record):
+    """
+    Turn the raw bytes of one fasta record into a collapsed ">header\\nseq\\n"
+    string.
+    """
 
-        line = f.readline()
-    
-    # Print the last sequence        
-    if len(tmp_out) != 0:
-        if collapse == True:
-            tmp_out = [o.strip() for o in tmp_out]
-            tmp_out[0] = "%s\n" % tmp_out[0]
+    lines = record.decode().split("\n")
+    header = lines[0][1:].strip()
+    sequence = "".join([l.strip() for l in lines[1:]])
 
-        out.append("%s\n" % ("".join(tmp_out)))
+    return ">%s\n%s\n" % (header,sequence)
 
-    f.close()
+def outOfCoreScrambler(fasta_file,out=sys.stdout,seed=None):
+    """
+    Scramble the order of the entries in a fasta file without loading it:
+    scan the record offsets, permute them and copy each record from disk to
+    out in permuted order (collapsed onto a single line).  Memory use depends
+    on the number of records, not their size.
+    """
 
-    random.shuffle(out) 
+    offsets = recordOffsets(fasta_file)
+    order = np.random.RandomState(seed).permutation(len(offsets) - 1)
 
-    return out
+    with open(fasta_file,'rb') as f:
+        for i in order:
+            f.seek(offsets[i])
+            out.write(_collapseRecord(f.read(offsets[i+1] - offsets[i])))
+
+def reservoirSample(fasta_file,num_records,collapse=True,seed=None):
+    """
+    Select num_records entries from a fasta file uniformly at random in a
+    single pass (reservoir sampling), holding only the sample in memory.
+    Returns the selected records in scrambled order.
+    """
+
+    if num_records < 1:
+        err = "Number of records to sample must be at least 1.\n"
+        raise FastaScramblerError(err)
+
+    rng = random.Random(seed)
+
+    reservoir = []
+    raw_lines = not collapse
+    records = phyloBase.FastaFile.iterRecords(fasta_file,raw_lines)
+    for i, (header, sequence) in enumerate(records):
+
+        # Fill the reservoir, then replace entries with probability k/(i+1)
+        if i < num_records:
+            slot = i
+            reservoir.append(None)
+        else:
+            slot = rng.randint(0,i)
+            if slot >= num_records:
+                continue
+
+        if collapse:
+            reservoir[slot] = ">%s\n%s\n" % (header,sequence)
+        else:
+            reservoir[slot] = ">%s\n%s" % (header,"".join(sequence))
+
+    rng.shuffle(reservoir)
+
+    return reservoir
 
 def main(argv=None):
     """
@@ -74,7 +140,40 @@ def main(argv=None):
         err = "Incorrect number of arguments!\nUSAGE:\n\n%s\n\n" % __usage__
         raise FastaScramblerError(err)
 
-    return fastaScrambler(fasta_file) 
+    out_of_core = False
+    num_records = None
+    seed = None
+    i = 1
+    while i < len(argv):
+        a = argv[i]
+        if a == "-x":
+            out_of_core = True
+        elif a in ("-k","-s"):
+            try:
+                value = int(argv[i+1])
+            except (IndexError,ValueError):
+                err = "Argument %s requires an integer value!\n" % a
+                raise FastaScramblerError(err)
+            if a == "-k":
+                num_records = value
+            else:
+                seed = value
+            i += 1
+        else:
+            err = "Argument %s not recognized!\n" % a
+            raise FastaScramblerError(err)
+        i += 1
+
+    if out_of_core and num_records != None:
+        err = "-x and -k cannot be combined.\n"
+        raise FastaScramblerError(err)
+
+    if out_of_core:
+        outOfCoreScrambler(fasta_file,sys.stdout,seed)
+    elif num_records != None:
+        sys.stdout.write("".join(reservoirSample(fasta_file,num_records,seed=seed)))
+    else:
+        sys.stdout.write("".join(fastaScrambler(fasta_file,seed=seed)))
 
 if __name__ == "__main__":
-    print "".join(main())
+    main()
@@ -1,32 +1,173 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
-Print the length of each sequence in a fasta file.
+Print the length (not counting gaps) of each sequence in a fasta file.  The
+file is read in fixed-size chunks, so memory use does not depend on the size
+of the file or of any one sequence.  -s prints summary statistics instead
+(number of sequences, total residues, min/max/mean length, N50 and a length
+histogram with num_bins bins, default 10).
 """
+__usage__ = "fastaSeqLength.py fasta_file [-s [num_bins]]"
+__author__ = "Michael J. Harms"
+__date__ = "261017"
 
+import sys, array
 
-import sys
+import numpy as np
 
-f = open(sys.argv[1])
-lines = f.readlines()
-f.close()
+class FastaSeqLengthError(Exception):
+    """
+    Error class.
+    """
 
-lines = [l for l in lines if l.strip() != ""]
+    pass
 
-out_lines = []
-names = []
-for l in lines:
-    if l[0] == ">":
-        out_lines.append(">")
-        names.append(l[1:].strip())
-    else:
-        t = "".join([a for a in l if a != "-"])
-        out_lines.append(t.strip())
+# Bytes that do not count toward sequence length
+WHITESPACE = b" \t\r\n"
+
+def iterLengths(fasta_file,chunk_size=1048576):
+    """
+    Yield (header,length,gaps) for every record in a fasta file, where length
+    counts every non-whitespace sequence character and gaps counts "-".
+    Residues and gaps are counted over whole chunks of sequence at a time
+    rather than line by line.
+    """
+
+    header = None
+    header_bytes = []
+    in_header = False
+    line_start = True
+    length = 0
+    gaps = 0
+
+    with open(fasta_file,'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+
+            pos = 0
+            while pos < len(data):
+
+                # Finish reading a header line (which may span chunks)
+                if in_header:
+                    end = data.find(b"\n",pos)
+                    if end == -1:
+                        header_bytes.append(data[pos:])
+                        break
+                    header_bytes.append(data[pos:end])
+                    header = b"".join(header_bytes).decode().strip()
+                    in_header = False
+                    line_start = True
+                    pos = end + 1
+                    continue
+
+                # Start of a new record; emit the previous one
+                if line_start and data[pos:pos+1] == b">":
+                    if header is not None:
+                        yield header, length, gaps
+                    header_bytes = []
+                    in_header = True
+                    length = 0
+                    gaps = 0
+                    pos += 1
+                    continue
+
+                # Count everything up to the next header line in one go
+                end = data.find(b"\n>",pos)
+                end = len(data) if end == -1 else end + 1
+                segment = data[pos:end]
+                if header is not None or header_bytes:
+                    length += len(segment.translate(None,WHITESPACE))
+                    gaps += segment.count(b"-")
+                line_start = segment.endswith(b"\n")
+                pos = end
+
+    # Emit the last record
+    if in_header:
+        header = b"".join(header_bytes).decode().strip()
+    if header is not None:
+        yield header, length, gaps
+
+def calcN50(lengths):
+    """
+    Length L such that sequences of length >= L hold at least half of all
+    residues.
+    """
+
+    lengths = np.sort(lengths)[::-1]
+    cumulative = np.cumsum(lengths)
 
-combined = "".join(out_lines)
-seq = combined.split(">")
+    return int(lengths[np.searchsorted(cumulative,cumulative[-1]/2.0)])
 
-lengths = [len(s) for s in seq]
+def summarizeLengths(fasta_file,num_bins=10):
+    """
+    Return a list of output lines summarizing the ungapped sequence lengths
+    in a fasta file.  Only the lengths (eight bytes per sequence) are held in
+    memory.
+    """
+
+    lengths = array.array("q")
+    for header, length, gaps in iterLengths(fasta_file):
+        lengths.append(length - gaps)
+    lengths = np.frombuffer(lengths,dtype=np.int64)
+
+    if len(lengths) == 0:
+        err = "No sequences found in %s\n" % fasta_file
+        raise FastaSeqLengthError(err)
+
+    out = []
+    out.append("num_seqs\t%i" % len(lengths))
+    out.append("total\t%i" % lengths.sum())
+    out.append("min\t%i" % lengths.min())
+    out.append("max\t%i" % lengths.max())
+    out.append("mean\t%.2f" % lengths.mean())
+    out.append("N50\t%i" % calcN50(lengths))
+
+    counts, edges = np.histogram(lengths,bins=num_bins)
+    out.append("#histogram (bin_start bin_end count)")
+    for i in range(len(counts)):
+        out.append("%.1f\t%.1f\t%i" % (edges[i],edges[i+1],counts[i]))
+
+    return out
+
+def main(argv=None):
+    """
+    Main function to parse command line.
+    """
+
+    if argv == None:
+        argv = sys.argv[1:]
+
+    try:
+        fasta_file = argv[0]
+    except IndexError:
+        err = "Incorrect number of arguments!\nUSAGE:\n\n%s\n\n" % __usage__
+        raise FastaSeqLengthError(err)
+
+    summary = False
+    num_bins = 10
+    if len(argv) > 1:
+        if argv[1] != "-s":
+            err = "Argument %s not recognized!\n" % argv[1]
+            raise FastaSeqLengthError(err)
+        summary = True
+        if len(argv) > 2:
+            try:
+                num_bins = int(argv[2])
+            except ValueError:
+                err = "Number of histogram bins must be an integer!\n"
+                raise FastaSeqLengthError(err)
+            if num_bins < 1:
+                err = "Number of histogram bins must be at least 1!\n"
+                err += "USAGE:\n\n%s\n\n" % __usage__
+                raise FastaSeqLengthError(err)
+
+    if summary:
+        print("\n".join(summarizeLengths(fasta_file,num_bins)))
+    else:
+        for header, length, gaps in iterLengths(fasta_file):
+            print(header, length - gaps)
 
-for i in range(len(names)):
-    print names[i], lengths[i]
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
 Take a subset of the entries in a fasta file where something in the header 
-matches "pattern". -e forces an exact match to everything after >.
+matches "pattern". -e forces an exact match to everything after >.  -i does an
+exact match by pulling records straight out of the file through a faidx-style
+index (fasta_file.fai, built on first use) rather than scanning every header.
+Patterns are literal strings (so "XP_000001.1" matches only itself); -r treats
+them as regular expressions instead.  -v takes the records that do *not*
+match.  -o writes to a file rather than stdout.  -d out_dir demultiplexes in a
+single pass: each line of the pattern file holds a pattern and, after a tab, a
+group name, and matching records are written to out_dir/group.fasta (a record
+matching several groups goes to each).
 """
-__usage__ = "fastaSubset.py fasta_file pattern OR file_with_patterns [-e]"
+__usage__ = "fastaSubset.py fasta_file pattern OR file_with_patterns [-e] [-i] [-r] [-v] [-o out_file] [-d out_dir]"
 __author__ = "Michael J. Harms"
 __date__ = "110604"
 
 import sys, re, os
 
+import phyloBase
+
 class FastaSubsetError(Exception):
     """
     Error class.
@@ -17,74 +27,204 @@ class FastaSubsetError(Exception):
 
     pass
 
-def fastaSubset(fasta_file,patterns,collapse=True,exact=False,inverse=False):
+def buildMatcher(patterns,exact=False,regex=False):
+    """
+    Return a function that takes a header (without ">") and returns True if
+    it matches any of patterns.  Exact matching is a set lookup.  Otherwise
+    patterns are literal strings, compiled into a single trie-shaped regex by
+    phyloBase.buildKeyRegex; if regex == True they are regular expressions
+    combined into one alternation.  Both search the whole header line,
+    ">header\n", as the original per-pattern regexes did.  In every case each
+    header is scanned once, however many patterns there are.
+    """
+
+    if exact:
+        pattern_set = set(patterns)
+        return lambda header: header in pattern_set
+
+    if regex:
+        combined = re.compile("|".join(["(?:%s)" % p for p in patterns]))
+    else:
+        combined = phyloBase.buildKeyRegex(patterns)
+
+    return lambda header: combined.search(">%s\n" % header) != None
+
+def buildGroupMatcher(patterns,groups,exact=False,regex=False):
+    """
+    Return a function that takes a header (without ">") and returns the set
+    of groups whose patterns it matches.  groups[i] is the group of
+    patterns[i].  Exact and literal patterns are resolved in a single pass;
+    regular expressions (regex == True) are combined into one alternation
+    per group.
+    """
+
+    if exact:
+        pattern_groups = {}
+        for p, g in zip(patterns,groups):
+            pattern_groups.setdefault(p,set()).add(g)
+        return lambda header: pattern_groups.get(header,set())
+
+    if not regex:
+        pattern_groups = {}
+        for p, g in zip(patterns,groups):
+            pattern_groups.setdefault(p,set()).add(g)
+        findKeys = phyloBase.buildKeyFinder(pattern_groups.keys())
+
+        def matchLiterals(header):
+            found = set()
+            for p in findKeys(">%s\n" % header):
+                found.update(pattern_groups[p])
+            return found
+
+        return matchLiterals
+
+    group_patterns = {}
+    for p, g in zip(patterns,groups):
+        group_patterns.setdefault(g,[]).append("(?:%s)" % p)
+    combined = [(g,re.compile("|".join(group_patterns[g])))
+                for g in sorted(group_patterns.keys())]
+
+    def matchGroups(header):
+        line_search = ">%s\n" % header
+        return set([g for g, c in combined if c.search(line_search) != None])
+
+    return matchGroups
+
+class FastaWriter:
+    """
+    Write fasta records through an in-memory buffer, so records go out in
+    large writes rather than one system call per record.
+    """
+
+    def __init__(self,output=None,buffer_size=1048576):
+        """
+        output is a file name or an open file object (stdout if None).
+        """
+
+        if output == None:
+            self.out = sys.stdout
+            self.own_file = False
+        elif isinstance(output,str):
+            self.out = open(output,'w')
+            self.own_file = True
+        else:
+            self.out = output
+            self.own_file = False
+
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self,header,sequence):
+        """
+        Write a record.  sequence is either a string (written on one line) or
+        a list of raw lines (written as-is).
+        """
+
+        if isinstance(sequence,str):
+            record = ">%s\n%s\n" % (header,sequence)
+        else:
+            record = ">%s\n%s" % (header,"".join(sequence))
+
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out whatever is in the buffer.
+        """
+
+        self.out.write("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        """
+        Flush the buffer and close the output if we opened it.
+        """
+
+        self.flush()
+        if self.own_file:
+            self.out.close()
+        else:
+            self.out.flush()
+
+
+def indexedSubset(fasta_file,names,writer):
+    """
+    Pull the records whose headers exactly match names out of fasta_file
+    using a FastaIndex, so the cost depends on the number of names rather
+    than the size of the file.  Records come out in the order of names.
+    """
+
+    indexed = phyloBase.IndexedFastaFile(fasta_file)
+    for header, sequence in indexed.iterRecords(names):
+        writer.write(header,sequence)
+
+    indexed.close()
+
+def fastaSubset(fasta_file,patterns,collapse=True,exact=False,inverse=False,
+                indexed=False,regex=False,out_file=None):
     """
     Take a subset of entries in a fasta file according to whether or not the
     header contains one of the patterns in patterns.  If collapse == True,
-    collapse the entire sequence onto a single line.
+    collapse the entire sequence onto a single line.  If exact == True, the
+    pattern must match everything after ">".  If regex == True, patterns are
+    regular expressions rather than literal strings.  If inverse == True, take
+    the entries that do not match.  If indexed == True (and exact and not
+    inverse), records are fetched through the fasta index.  Output goes to
+    out_file (stdout if None).
     """
 
-    compiled_patterns = [re.compile(p) for p in patterns]
+    writer = FastaWriter(out_file)
 
-    f = open(fasta_file,'r')
-    
-    out = []
-    recording = False
-    line = f.readline()
-    while line != "": 
+    if exact and indexed and not inverse:
+        indexedSubset(fasta_file,patterns,writer)
+        writer.close()
+        return
 
-        # If this is a new entry...
-        if line.startswith(">"):
+    matches = buildMatcher(patterns,exact,regex)
 
-            # If we've been recording the previous entry, print it out
-            if len(out) != 0:
-                if collapse == True:
-                    out = [o.strip() for o in out]
-                    out[0] = "%s\n" % out[0]
-                    print "".join(out)
-                else:
-                    print "".join(out),
+    raw_lines = not collapse
+    for header, sequence in phyloBase.FastaFile.iterRecords(fasta_file,raw_lines):
 
-                sys.stdout.flush()
+        # If we're recording, er, record
+        if matches(header) != inverse:
+            writer.write(header,sequence)
 
-                out = []
+    writer.close()
 
-            # Now see if this entry is matches one of the patterns
-            recording = False
-            if exact:
-                line_search = "%s\n" % line
-            else:
-                line_search = "%s" % line
+def fastaDemultiplex(fasta_file,patterns,groups,out_dir,collapse=True,
+                     exact=False,regex=False):
+    """
+    Split a fasta file into one file per group in a single pass.  groups[i]
+    is the group of patterns[i]; each record is written to
+    out_dir/group.fasta for every group with a pattern matching its header.
+    Returns a dictionary of the number of records written to each group.
+    """
 
-            if not inverse:
-                for p in compiled_patterns:
-                    if p.search(line_search) != None:
-                        recording = True
-                        break
-            else:
-                recording = True
-                for p in compiled_patterns:
-                    if p.search(line_search) != None:
-                        recording = False
-                        break
-                
-                
-        # If we're recording, er, record
-        if recording == True:
-            out.append(line)
-
-        line = f.readline()
-    
-    # Print the last sequence        
-    if len(out) != 0:
-        if collapse == True:
-            out = [o.strip() for o in out]
-            out[0] = "%s\n" % out[0]
-            print "".join(out)
-        else:
-            print "".join(out),
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    group_names = sorted(set(groups))
+    writers = dict([(g,FastaWriter(os.path.join(out_dir,"%s.fasta" % g)))
+                    for g in group_names])
+    counts = dict([(g,0) for g in group_names])
 
-    f.close()
+    matches = buildGroupMatcher(patterns,groups,exact,regex)
+
+    raw_lines = not collapse
+    for header, sequence in phyloBase.FastaFile.iterRecords(fasta_file,raw_lines):
+        for g in matches(header):
+            writers[g].write(header,sequence)
+            counts[g] += 1
+
+    for g in group_names:
+        writers[g].close()
+
+    return counts
 
 def main(argv=None):
     """
@@ -101,33 +241,78 @@ def main(argv=None):
         err = "Incorrect number of arguments!\nUSAGE:\n\n%s\n\n" % __usage__
         raise FastaSubsetError(err)
 
-    # Grab optional "exact match" argument
-    try:
-        if argv[2] == "-e":
+    # Grab optional "exact match", "indexed", "regex", "inverse", output and
+    # demultiplex arguments
+    exact = False
+    indexed = False
+    regex = False
+    inverse = False
+    out_file = None
+    out_dir = None
+    i = 2
+    while i < len(argv):
+        a = argv[i]
+        if a == "-e":
             exact = True
+        elif a == "-i":
+            exact = True
+            indexed = True
+        elif a == "-r":
+            regex = True
+        elif a == "-v":
+            inverse = True
+        elif a in ("-o","-d"):
+            try:
+                value = argv[i+1]
+            except IndexError:
+                err = "Argument %s requires a value!\n" % a
+                raise FastaSubsetError(err)
+            if a == "-o":
+                out_file = value
+            else:
+                out_dir = value
+            i += 1
         else:
-            err = "Argument %s not recognized!\n" % argv[2]
+            err = "Argument %s not recognized!\n" % a
             raise FastaSubsetError(err)
-    except IndexError:
-        exact = False
+        i += 1
+
+    if out_dir != None and (inverse or indexed or out_file != None):
+        err = "-d cannot be combined with -v, -i or -o.\n"
+        raise FastaSubsetError(err)
 
     if os.path.exists(pattern):
         f = open(pattern,'r')
         lines = f.readlines()
+        f.close()
         lines = [l.split("#")[0].strip() for l in lines]
-        if exact:
-            patterns = ["%s\n" % l for l in lines if l != ""]
-        else:
-            patterns = [l for l in lines if l != ""]
-        if len(patterns) == 0:
-            err = "Specified pattern file (%s) does not contain any lines!\n" 
-            err = "%s" % err
+        lines = [l for l in lines if l != ""]
+        if len(lines) == 0:
+            err = "Specified pattern file (%s) does not contain any lines!\n" % pattern
             raise FastaSubsetError(err)
+
+        if out_dir != None:
+            columns = [l.split("\t") for l in lines]
+            if min([len(c) for c in columns]) < 2:
+                err = "Demultiplexing requires a tab-separated group name after\n"
+                err += "every pattern in %s.\n" % pattern
+                raise FastaSubsetError(err)
+            patterns = [c[0].strip() for c in columns]
+            groups = [c[1].strip() for c in columns]
+        else:
+            patterns = lines
     else:
+        if out_dir != None:
+            err = "Demultiplexing requires a pattern file.\n"
+            raise FastaSubsetError(err)
         patterns = [pattern]
-   
- 
-    fastaSubset(fasta_file,patterns,exact=exact) 
+
+    if out_dir != None:
+        fastaDemultiplex(fasta_file,patterns,groups,out_dir,exact=exact,
+                         regex=regex)
+    else:
+        fastaSubset(fasta_file,patterns,exact=exact,inverse=inverse,
+                    indexed=indexed,regex=regex,out_file=out_file)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+kmerSketch.py
+
+Find near-duplicate sequences in a large set of unaligned sequences (for
+example, the homologs pulled out of a BLAST download by
+blastTools.parseFastaXML) without aligning them, so they can be dropped
+before the expensive cdhit clustering and alignment steps.
+
+Each sequence is reduced to a MinHash sketch: residues are coded in 5 bits,
+k-mers are packed into uint64 codes, and each of num_hashes multiply-shift
+hash functions contributes the minimum hash over the sequence's k-mers.
+Sketches for many sequences are computed at once with numpy, in a pool of
+processes for large files.  Sketches are then split into bands (LSH); any two
+sequences with an identical band are candidates, and the fraction of matching
+sketch entries estimates their k-mer Jaccard similarity.
+
+By default, prints each candidate pair with an estimated Jaccard similarity
+of at least threshold as "header1 header2 jaccard" (tab-delimited).  With -r,
+instead writes the sequences left after removing near duplicates to out_file,
+keeping the earlier sequence in the file (as runCdhit keeps the lowest rank).
+"""
+__author__ = "Michael J. Harms"
+__date__ = "261017"
+__usage__ = "kmerSketch.py fasta_file [-k kmer_size] [-n num_hashes] [-b num_bands] [-t threshold] [-p num_processes] [-s seed] [-r out_file]"
+
+import sys, multiprocessing
+
+import numpy as np
+
+import phyloBase
+
+class KmerSketchError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+# Five bits per residue.  Letters (either case) are coded 1-26 and anything
+# else 27, so at most 12 residues fit into one uint64 k-mer code.
+BITS_PER_RESIDUE = 5
+MAX_KMER_SIZE = 64//BITS_PER_RESIDUE
+
+RESIDUE_CODES = np.full(256,27,dtype=np.uint64)
+for i in range(26):
+    RESIDUE_CODES[ord("A") + i] = i + 1
+    RESIDUE_CODES[ord("a") + i] = i + 1
+
+# Characters dropped from sequences before k-mers are taken
+SKIPPED_CHARACTERS = b"-.*"
+
+# Largest number of (hash function x k-mer) values held at once
+MAX_BLOCK = 16777216
+
+# LSH buckets larger than this are collapsed onto their first member
+MAX_BUCKET = 256
+
+EMPTY = np.iinfo(np.uint64).max
+
+def hashFunctions(num_hashes,seed=None):
+    """
+    Draw num_hashes multiply-shift hash functions h(x) = a*x + b (mod 2^64),
+    with a odd.  Returns (multipliers,increments) as uint64 arrays.
+    """
+
+    rng = np.random.RandomState(seed)
+    values = rng.randint(0,2**32,size=(4,num_hashes)).astype(np.uint64)
+
+    multipliers = (values[0] << np.uint64(32)) | values[1] | np.uint64(1)
+    increments = (values[2] << np.uint64(32)) | values[3]
+
+    return multipliers, increments
+
+def kmerCodes(sequences,kmer_size):
+    """
+    Pack every k-mer of every sequence into a uint64 code.  Returns the codes
+    for all sequences concatenated, and the number of k-mers taken from each
+    sequence (zero for sequences shorter than kmer_size).
+    """
+
+    if kmer_size < 1 or kmer_size > MAX_KMER_SIZE:
+        err = "kmer_size must be between 1 and %i\n" % MAX_KMER_SIZE
+        raise KmerSketchError(err)
+
+    data = [s.encode().translate(None,SKIPPED_CHARACTERS) for s in sequences]
+    lengths = np.array([len(d) for d in data],dtype=np.int64)
+    num_kmers = np.maximum(lengths - kmer_size + 1,0)
+
+    residues = RESIDUE_CODES[np.frombuffer(b"".join(data),dtype=np.uint8)]
+
+    # Roll a window over the concatenated residues ...
+    num_windows = max(len(residues) - kmer_size + 1,0)
+    codes = np.zeros(num_windows,dtype=np.uint64)
+    for j in range(kmer_size):
+        codes <<= np.uint64(BITS_PER_RESIDUE)
+        codes |= residues[j:j+num_windows]
+
+    # ... and keep only the windows that lie within a single sequence
+    starts = np.cumsum(lengths) - lengths
+    within = np.arange(num_kmers.sum()) - np.repeat(np.cumsum(num_kmers) - num_kmers,num_kmers)
+    keep = np.repeat(starts,num_kmers) + within
+
+    return codes[keep], num_kmers
+
+def sketchSequences(sequences,kmer_size=5,num_hashes=128,seed=0,
+                    max_block=MAX_BLOCK):
+    """
+    Return a (num_sequences x num_hashes) uint64 array of MinHash sketches.
+    All sequences are hashed together; k-mer codes are processed in blocks so
+    that no more than max_block hash values are held at once.  Sequences with
+    no k-mers get a sketch of all EMPTY values.
+    """
+
+    multipliers, increments = hashFunctions(num_hashes,seed)
+    sketches = np.full((len(sequences),num_hashes),EMPTY,dtype=np.uint64)
+
+    codes, num_kmers = kmerCodes(sequences,kmer_size)
+    owner = np.repeat(np.arange(len(sequences)),num_kmers)
+
+    step = max(max_block//num_hashes,1)
+    for start in range(0,len(codes),step):
+        block = codes[start:start+step]
+        block_owner = owner[start:start+step]
+
+        hashes = np.outer(block,multipliers) + increments
+
+        # Minimum over each run of k-mers belonging to the same sequence
+        run_starts = np.flatnonzero(np.r_[True,block_owner[1:] != block_owner[:-1]])
+        minima = np.minimum.reduceat(hashes,run_starts,axis=0)
+
+        rows = block_owner[run_starts]
+        sketches[rows] = np.minimum(sketches[rows],minima)
+
+    return sketches
+
+def _sketchFastaChunk(args):
+    """
+    Sketch the records in one byte range of a fasta file.  Run in worker
+    processes by sketchFastaFile.
+    """
+
+    fasta_file, start, end, kmer_size, num_hashes, seed = args
+
+    headers = []
+    sequences = []
+    for header, sequence in phyloBase.iterFastaChunk(fasta_file,start,end):
+        headers.append(header)
+        sequences.append(sequence)
+    sketches = sketchSequences(sequences,kmer_size,num_hashes,seed)
+
+    return headers, sketches
+
+def sketchFastaFile(fasta_file,kmer_size=5,num_hashes=128,seed=0,
+                    num_processes=1,chunks_per_process=4,
+                    chunk_bytes=phyloBase.CHUNK_BYTES):
+    """
+    Sketch every record in fasta_file.  The file is split into chunks of
+    whole records (at most about chunk_bytes each; see
+    phyloBase.parallelChunks) that are sketched in a pool of num_processes
+    processes (all cores if None).  Returns the headers and sketches in file
+    order.
+    """
+
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+
+    chunks = phyloBase.parallelChunks(fasta_file,num_processes,
+                                      chunks_per_process,chunk_bytes)
+    jobs = [(fasta_file,start,end,kmer_size,num_hashes,seed) for start, end in chunks]
+
+    if num_processes == 1:
+        results = [_sketchFastaChunk(j) for j in jobs]
+    else:
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            results = pool.map(_sketchFastaChunk,jobs)
+        finally:
+            pool.terminate()
+
+    headers = []
+    for h, s in results:
+        headers.extend(h)
+
+    if len(headers) == 0:
+        return headers, np.zeros((0,num_hashes),dtype=np.uint64)
+
+    return headers, np.vstack([s for h, s in results])
+
+def chooseBands(num_hashes,threshold):
+    """
+    Choose the number of LSH bands for num_hashes hash functions.  Two
+    sequences with Jaccard similarity J become candidates with probability
+    1 - (1 - J^r)^b for b bands of r rows; this takes the largest r (fewest
+    false candidates) whose threshold (1/b)^(1/r) is still at or below
+    threshold, so few true pairs are missed.
+    """
+
+    best = num_hashes
+    for rows in range(1,num_hashes + 1):
+        if num_hashes % rows != 0:
+            continue
+        bands = num_hashes//rows
+        if (1.0/bands)**(1.0/rows) <= threshold:
+            best = bands
+
+    return best
+
+def collapseIdentical(sketches):
+    """
+    Group sequences with identical sketches (exact duplicates, in practice).
+    Returns the index of the first member of each group and, for every
+    sequence, the number of its group.
+    """
+
+    if len(sketches) == 0:
+        return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64)
+
+    unique, first, inverse = np.unique(sketches,axis=0,return_index=True,
+                                       return_inverse=True)
+
+    return first, inverse.ravel()
+
+def candidatePairs(sketches,num_bands,max_bucket=MAX_BUCKET):
+    """
+    Return the (i,j) pairs, i < j, of sketches that are identical in at
+    least one band, as two int64 arrays.  Each band is hashed to one uint64
+    key; rows are grouped by sorting on that key.  Buckets with more than
+    max_bucket members are not expanded into all pairs; each member is
+    instead paired with the bucket's first member.
+    """
+
+    num_seq, num_hashes = sketches.shape
+    if num_hashes % num_bands != 0:
+        err = "num_bands (%i) must divide num_hashes (%i)\n" % (num_bands,num_hashes)
+        raise KmerSketchError(err)
+    rows = num_hashes//num_bands
+
+    mixers, ignored = hashFunctions(rows,seed=num_hashes)
+
+    # Empty sketches (sequences shorter than k) are never candidates
+    usable = np.flatnonzero(sketches[:,0] != EMPTY)
+
+    found = []
+    for b in range(num_bands):
+        band = sketches[usable,b*rows:(b+1)*rows]
+        keys = (band*mixers).sum(axis=1,dtype=np.uint64)
+
+        order = np.argsort(keys,kind="stable")
+        sorted_keys = keys[order]
+        edges = np.flatnonzero(np.r_[True,sorted_keys[1:] != sorted_keys[:-1],True])
+
+        for start, end in zip(edges[:-1],edges[1:]):
+            if end - start < 2:
+                continue
+            members = np.sort(usable[order[start:end]])
+            if len(members) > max_bucket:
+                found.append(members[0]*num_seq + members[1:])
+            else:
+                i, j = np.triu_indices(len(members),1)
+                found.append(members[i]*num_seq + members[j])
+
+    if len(found) == 0:
+        return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64)
+
+    pairs = np.unique(np.concatenate(found))
+
+    return pairs//num_seq, pairs % num_seq
+
+def estimateJaccard(sketches,i,j,max_block=MAX_BLOCK):
+    """
+    Estimate the k-mer Jaccard similarity of each pair (i[x],j[x]) as the
+    fraction of sketch entries they share.  Pairs are compared in batches so
+    that no more than max_block sketch entries are held at once.
+    """
+
+    jaccard = np.zeros(len(i),dtype=np.float64)
+
+    step = max(max_block//max(sketches.shape[1],1),1)
+    for start in range(0,len(i),step):
+        a = sketches[i[start:start+step]]
+        b = sketches[j[start:start+step]]
+        jaccard[start:start+step] = (a == b).mean(axis=1)
+
+    return jaccard
+
+def _groupNeighbours(sketches,members,threshold,num_bands,max_bucket):
+    """
+    Find near-duplicate pairs among the distinct sketches sketches[members].
+    Returns (i,j,jaccard) with i < j numbering positions in members, so
+    large buckets are collapsed onto their earliest position in members.
+    """
+
+    if num_bands is None:
+        num_bands = chooseBands(sketches.shape[1],threshold)
+
+    unique = sketches[members]
+    i, j = candidatePairs(unique,num_bands,max_bucket)
+    jaccard = estimateJaccard(unique,i,j)
+
+    keep = jaccard >= threshold
+
+    return i[keep], j[keep], jaccard[keep]
+
+def findNearDuplicates(sketches,threshold=0.9,num_bands=None,
+                       max_bucket=MAX_BUCKET):
+    """
+    Find pairs of sequences whose estimated Jaccard similarity is at least
+    threshold.  Returns (i,j,jaccard) arrays.  num_bands is chosen from
+    threshold by chooseBands if not given.  Sequences with identical
+    sketches are collapsed before banding: each is reported once, paired
+    (with jaccard 1) with the first sequence that has the same sketch, and
+    only that first sequence is paired with other near duplicates.
+    """
+
+    num_seq = len(sketches)
+    first, inverse = collapseIdentical(sketches)
+
+    # Copies of an earlier sketch
+    representative = first[inverse]
+    copies = np.flatnonzero(representative != np.arange(num_seq))
+    copies = copies[sketches[copies,0] != EMPTY]
+
+    members = np.sort(first)
+    i, j, jaccard = _groupNeighbours(sketches,members,threshold,num_bands,max_bucket)
+
+    return np.concatenate((representative[copies],members[i])), \
+           np.concatenate((copies,members[j])), \
+           np.concatenate((np.ones(len(copies)),jaccard))
+
+def removeNearDuplicates(sketches,ranks=None,threshold=0.9,num_bands=None,
+                         max_bucket=MAX_BUCKET):
+    """
+    Return the sorted indices of sequences to keep after removing near
+    duplicates.  Like runCdhit, the lowest-rank sequence represents its
+    neighbours.  Sequences with identical sketches are first collapsed onto
+    their lowest-rank member; the distinct sketches are then visited in rank
+    order (file order if ranks is None) and dropped if a sketch already kept
+    is a near duplicate.  Sequences too short to sketch are always kept.
+    For a homolog_list, pass sketches of [h.sequence for h in homolog_list]
+    and ranks [h.rank for h in homolog_list].
+    """
+
+    num_seq = len(sketches)
+    if ranks is None:
+        ranks = np.arange(num_seq)
+    ranks = np.asarray(ranks)
+
+    first, inverse = collapseIdentical(sketches)
+    if len(first) == 0:
+        return np.zeros(0,dtype=np.int64)
+
+    # Lowest-rank (then earliest) member of each group of identical
+    # sketches, with the groups themselves put in that rank order
+    order = np.lexsort((np.arange(num_seq),ranks,inverse))
+    best = order[np.flatnonzero(np.r_[True,inverse[order][1:] != inverse[order][:-1]])]
+    members = best[np.lexsort((best,ranks[best]))]
+
+    i, j, jaccard = _groupNeighbours(sketches,members,threshold,num_bands,max_bucket)
+
+    # Earlier neighbours of each group, in compressed sparse row form
+    earlier = i[np.argsort(j,kind="stable")]
+    offsets = np.r_[0,np.cumsum(np.bincount(j,minlength=len(members)))]
+
+    kept = np.zeros(len(members),dtype=bool)
+    for g in range(len(members)):
+        if not kept[earlier[offsets[g]:offsets[g+1]]].any():
+            kept[g] = True
+
+    empty = np.flatnonzero(sketches[:,0] == EMPTY)
+
+    return np.union1d(members[kept],empty)
+
+def main(argv=None):
+    """
+    Parse the command line and run.
+    """
+
+    if argv == None:
+        argv = sys.argv[1:]
+
+    fasta_file = None
+    kmer_size = 5
+    num_hashes = 128
+    num_bands = None
+    threshold = 0.9
+    num_processes = 1
+    seed = 0
+    out_file = None
+
+    flags = {"-k":"kmer size","-n":"number of hashes","-b":"number of bands",
+             "-t":"threshold","-p":"number of processes","-s":"seed",
+             "-r":"output file"}
+
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a in flags:
+            try:
+                value = argv[i+1]
+                if a == "-k":
+                    kmer_size = int(value)
+                elif a == "-n":
+                    num_hashes = int(value)
+                elif a == "-b":
+                    num_bands = int(value)
+                elif a == "-t":
+                    threshold = float(value)
+                elif a == "-p":
+                    num_processes = int(value)
+                elif a == "-s":
+                    seed = int(value)
+                else:
+                    out_file = value
+            except (IndexError,ValueError):
+                err = "%s requires a %s.\n" % (a,flags[a])
+                raise KmerSketchError(err)
+            i += 1
+        elif a.startswith("-") or fasta_file != None:
+            err = "Argument %s not recognized. Usage:\n\n%s\n\n" % (a,__usage__)
+            raise KmerSketchError(err)
+        else:
+            fasta_file = a
+        i += 1
+
+    if fasta_file == None:
+        err = "Incorrect arguments. Usage:\n\n%s\n\n" % __usage__
+        raise KmerSketchError(err)
+
+    headers, sketches = sketchFastaFile(fasta_file,kmer_size,num_hashes,seed,
+                                        num_processes)
+
+    if out_file == None:
+        first, second, jaccard = findNearDuplicates(sketches,threshold,num_bands)
+        out = ["%s\t%s\t%.4f\n" % (headers[a],headers[b],j)
+               for a, b, j in zip(first,second,jaccard)]
+        sys.stdout.write("".join(out))
+        return
+
+    keep = set(removeNearDuplicates(sketches,None,threshold,num_bands).tolist())
+    with open(out_file,'w') as f:
+        records = phyloBase.FastaFile.iterRecords(fasta_file)
+        for index, (header, sequence) in enumerate(records):
+            if index in keep:
+                f.write(">%s\n%s\n" % (header,sequence))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+nameRegistry.py
+
+A local SQLite registry of sequence names shared between runs and projects.
+Each name gets a permanent internal name (XX00000001, XX00000002, ...) taken
+from its row id, so internal names never collide across runs.  Internal name,
+accession, species and pretty name are all indexed.  From the command line,
+prints the registry as a tab-delimited name file (the format written by
+createNameFiles.py and read by editNames.py).
+"""
+__author__ = "Michael J. Harms"
+__date__ = "261017"
+__usage__ = "nameRegistry.py registry.db"
+
+import sys, os, re, sqlite3
+
+class NameRegistryError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+# Columns as they appear in name files, and the registry column each maps to
+NAME_FILE_COLUMNS = ["number","id","species","internal_name","pretty_name"]
+REGISTRY_COLUMNS = ["number","accession","species","internal_name","pretty_name"]
+
+# Internal names generated from row ids
+INTERNAL_NAME_FORMAT = "XX%08i"
+INTERNAL_NAME_PATTERN = re.compile(r"^XX(\d{8})$")
+
+# SQLite limits the number of parameters in a single statement
+LOOKUP_BATCH = 900
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS names (
+    number INTEGER PRIMARY KEY AUTOINCREMENT,
+    internal_name TEXT UNIQUE,
+    accession TEXT,
+    species TEXT,
+    pretty_name TEXT);
+CREATE INDEX IF NOT EXISTS names_accession ON names (accession);
+CREATE INDEX IF NOT EXISTS names_species ON names (species);
+CREATE INDEX IF NOT EXISTS names_pretty_name ON names (pretty_name);
+"""
+
+def isRegistry(some_file):
+    """
+    Return True if some_file is an SQLite database.
+    """
+
+    if not os.path.isfile(some_file):
+        return False
+
+    with open(some_file,'rb') as f:
+        return f.read(16) == b"SQLite format 3\x00"
+
+class NameRegistry:
+    """
+    Read and write names in an SQLite registry.
+    """
+
+    def __init__(self,db_file):
+        """
+        Open (creating if necessary) the registry in db_file.
+        """
+
+        self.db_file = db_file
+        self.connection = sqlite3.connect(db_file)
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+
+        self.connection.close()
+
+    def __len__(self):
+
+        return self.connection.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+
+    def addNames(self,records):
+        """
+        Register a list of (accession,species,pretty_name) records in a single
+        transaction, returning the list of new internal names in the same
+        order.
+        """
+
+        records = list(records)
+
+        c = self.connection
+        try:
+            c.execute("BEGIN IMMEDIATE")
+
+            # The write lock is held, so new rows are numbered from one past
+            # the highest number ever used
+            first = c.execute("SELECT MAX(seq) FROM sqlite_sequence "
+                              "WHERE name = 'names'").fetchone()[0]
+            first = 1 if first is None else first + 1
+
+            internal_names = [INTERNAL_NAME_FORMAT % (first + i)
+                              for i in range(len(records))]
+            c.executemany("INSERT INTO names "
+                          "(number,internal_name,accession,species,pretty_name) "
+                          "VALUES (?,?,?,?,?)",
+                          [(first + i,internal_names[i]) + tuple(r)
+                           for i, r in enumerate(records)])
+            c.commit()
+        except sqlite3.Error as e:
+            c.rollback()
+            err = "Could not add names to %s (%s)\n" % (self.db_file,e)
+            raise NameRegistryError(err)
+
+        return internal_names
+
+    def registerNames(self,records):
+        """
+        Register a list of (internal_name,accession,species,pretty_name)
+        records that already have internal names (e.g. from a name file) in a
+        single transaction.  Internal names in the XX00000000 format keep the
+        matching row number where it is free, so generated names cannot
+        collide with them.  Names already registered with the same accession,
+        species and pretty name are skipped.  If any internal name is already
+        registered (or given twice) with different values, nothing is added
+        and the conflicts are reported as an error.  Returns the number of
+        names added.
+        """
+
+        records = [tuple(r) for r in records]
+
+        # Conflicts within the records themselves
+        conflicts = []
+        given = {}
+        for r in records:
+            if r[0] in given and given[r[0]] != r[1:]:
+                conflicts.append((r[0],given[r[0]],r[1:]))
+            given.setdefault(r[0],r[1:])
+
+        c = self.connection
+        try:
+            c.execute("BEGIN IMMEDIATE")
+
+            # Conflicts with names already in the registry
+            existing = self.lookup("internal_name",list(given.keys()))
+            for internal_name, rows in existing.items():
+                registered = (rows[0][1],rows[0][2],rows[0][4])
+                if registered != given[internal_name]:
+                    conflicts.append((internal_name,registered,given[internal_name]))
+
+            if len(conflicts) > 0:
+                c.rollback()
+                err = "Names conflict with %s:\n" % self.db_file
+                for internal_name, old, new in conflicts:
+                    err += "%s is (%s), not (%s)\n" % \
+                        (internal_name,", ".join([str(v) for v in old]),
+                         ", ".join([str(v) for v in new]))
+                raise NameRegistryError(err)
+
+            new_names = [(n,) + v for n, v in given.items() if n not in existing]
+
+            # Row numbers already used by some other name
+            numbers = {}
+            for r in new_names:
+                m = INTERNAL_NAME_PATTERN.match(r[0])
+                if m:
+                    numbers[int(m.group(1))] = r[0]
+
+            taken = set()
+            number_list = list(numbers.keys())
+            for i in range(0,len(number_list),LOOKUP_BATCH):
+                batch = number_list[i:i+LOOKUP_BATCH]
+                query = "SELECT number FROM names WHERE number IN (%s)" % \
+                    ",".join(["?"]*len(batch))
+                taken.update([row[0] for row in c.execute(query,batch)])
+
+            with_number = []
+            without_number = []
+            for r in new_names:
+                m = INTERNAL_NAME_PATTERN.match(r[0])
+                if m and int(m.group(1)) not in taken:
+                    with_number.append((int(m.group(1)),) + r)
+                else:
+                    without_number.append(r)
+
+            c.executemany("INSERT INTO names "
+                          "(number,internal_name,accession,species,pretty_name) "
+                          "VALUES (?,?,?,?,?)",with_number)
+            c.executemany("INSERT INTO names "
+                          "(internal_name,accession,species,pretty_name) "
+                          "VALUES (?,?,?,?)",without_number)
+            c.commit()
+        except sqlite3.Error as e:
+            c.rollback()
+            err = "Could not register names in %s (%s)\n" % (self.db_file,e)
+            raise NameRegistryError(err)
+
+        return len(new_names)
+
+    def lookup(self,column,values):
+        """
+        Look up many values of one column (internal_name, accession, species
+        or pretty_name) in batches.  Returns a dictionary mapping each value
+        found to a list of (number,accession,species,internal_name,
+        pretty_name) rows.
+        """
+
+        if column not in REGISTRY_COLUMNS:
+            err = "Column must be one of %s\n" % ", ".join(REGISTRY_COLUMNS)
+            raise NameRegistryError(err)
+
+        values = list(set(values))
+        position = REGISTRY_COLUMNS.index(column)
+
+        out = {}
+        for i in range(0,len(values),LOOKUP_BATCH):
+            batch = values[i:i+LOOKUP_BATCH]
+            query = "SELECT %s FROM names WHERE %s IN (%s)" % \
+                (",".join(REGISTRY_COLUMNS),column,",".join(["?"]*len(batch)))
+            for row in self.connection.execute(query,batch):
+                out.setdefault(row[position],[]).append(row)
+
+        return out
+
+    def getColumns(self):
+        """
+        Return the whole registry as name-file columns: a list of column names
+        and a dictionary of value lists keyed by column name.  number is
+        returned as a string, as it would be read from a name file.
+        """
+
+        columns = dict([(c,[]) for c in NAME_FILE_COLUMNS])
+        query = "SELECT %s FROM names ORDER BY number" % ",".join(REGISTRY_COLUMNS)
+        for row in self.connection.execute(query):
+            columns["number"].append(str(row[0]))
+            for c, v in zip(NAME_FILE_COLUMNS[1:],row[1:]):
+                columns[c].append(v)
+
+        return NAME_FILE_COLUMNS[:], columns
+
+def main(argv=None):
+    """
+    Print the contents of a registry as a name file.
+    """
+
+    if argv == None:
+        argv = sys.argv[1:]
+
+    try:
+        db_file = argv[0]
+    except IndexError:
+        err = "Incorrect arguments. Usage:\n\n%s\n\n" % __usage__
+        raise NameRegistryError(err)
+
+    if not isRegistry(db_file):
+        err = "%s is not a name registry.\n" % db_file
+        raise NameRegistryError(err)
+
+    registry = NameRegistry(db_file)
+    column_names, columns = registry.getColumns()
+    registry.close()
+
+    out = ["\t".join(column_names)]
+    for i in range(len(columns["number"])):
+        out.append("\t".join([columns[c][i] for c in column_names]))
+
+    print("\n".join(out))
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
 parseAncestor.py
@@ -37,13 +37,11 @@ def extractAncestor(node_file,fasta_file,alternate_states=2):
     """
 
     f = phyloBase.FastaFile(fasta_file)
-    num_characters = len(f.sequences[0].sequence)
+    alignment = phyloBase.Alignment(f.sequences)
+    num_characters = alignment.length
 
-    to_take = [False for i in range(num_characters)]
-    for seq in f.sequences:
-        for i, character in enumerate(seq.sequence):
-            if character != "-":
-                to_take[i] = True
+    # Take every column that is not a gap in at least one sequence
+    to_take = alignment.nonGapColumns()
 
     node = readNodeFile(node_file)
 
@@ -59,10 +57,10 @@ def extractAncestor(node_file,fasta_file,alternate_states=2):
     # PP we have looked at and place at the end.
     counter = 0
     for i in range(num_characters):
-        if to_take[i] == True:
+        if to_take[i]:
             output = node[i][:2*alternate_states]
             if len(output) != 2*alternate_states:
-                diff = (2*alternate_states-len(output))/2
+                diff = (2*alternate_states-len(output))//2
                 for j in range(diff):
                     output.extend(["NA","0.000"])
 
@@ -96,7 +94,7 @@ def main(argv=None):
 
     ancestor = extractAncestor(node_file,fasta_file,num_alternate_states)
 
-    print ancestor
+    print(ancestor)
 
 
 if __name__ == "__main__":
@@ -9,7 +9,9 @@ __author__ = "Michael J. Harms"
 __date__ = "091219"
 __usage__ = "not invoked from the command line"
 
-import string
+import string, os, sys, re, mmap, struct, multiprocessing
+
+import numpy as np
 
 class PhyloBaseError(Exception): 
     """
@@ -18,66 +20,555 @@ class PhyloBaseError(Exception):
 
     pass
 
+# Characters allowed in a sequence.  Sequences are upper-cased on input, so the
+# byte lookup table used for validation accepts either case.
+LEGAL_CHARACTERS = string.ascii_uppercase + "-?*"
+
+LEGAL_LOOKUP = np.zeros(256,dtype=bool)
+for c in LEGAL_CHARACTERS + LEGAL_CHARACTERS.lower():
+    LEGAL_LOOKUP[ord(c)] = True
+
+def _illegalPositions(data):
+    """
+    Return the positions in a bytes/uint8 array that hold illegal characters.
+    """
+
+    data = np.frombuffer(data,dtype=np.uint8) if isinstance(data,bytes) else data
+
+    return np.flatnonzero(np.logical_not(LEGAL_LOOKUP[data]))
+
+def _checkBatch(first_record,headers,sequences,problems):
+    """
+    Check a batch of sequences in one vectorized pass over their concatenated
+    bytes, appending a (record_number,header,positions,characters) tuple to
+    problems for every sequence with illegal characters.
+    """
+
+    encoded = [seq if isinstance(seq,bytes) else seq.encode("utf-8")
+               for seq in sequences]
+    data = b"".join(encoded)
+
+    bad = _illegalPositions(data)
+    if len(bad) == 0:
+        return
+
+    # Map positions in the concatenated batch back onto individual sequences
+    ends = np.cumsum([len(e) for e in encoded])
+    starts = ends - np.array([len(e) for e in encoded])
+    which = np.searchsorted(ends,bad,side="right")
+
+    records, first = np.unique(which,return_index=True)
+    for r, positions in zip(records,np.split(bad,first[1:])):
+        characters = sorted(set([encoded[r][p:p+1].decode("utf-8","replace")
+                                 for p in positions - starts[r]]))
+        problems.append((first_record + int(r),headers[r],
+                         positions - starts[r],"".join(characters)))
+
+def formatValidationReport(problems):
+    """
+    Turn a list of validation problems into a human-readable report.
+    """
+
+    out = ["%i sequence(s) contain illegal characters!\n\n" % len(problems)]
+    for record, header, positions, characters in problems:
+        out.append("%s (record %i): '%s' at position(s) %s\n" % \
+                   (header,record,characters,
+                    ",".join(["%i" % p for p in positions])))
+    out.append("\n")
+
+    return "".join(out)
+
+def validateRecords(records,strict=True,batch_size=16777216):
+    """
+    Check an iterable of (header,sequence) tuples for illegal characters.
+    Sequences are gathered into batches of roughly batch_size bytes and each
+    batch is checked with a single 256-entry lookup.  Returns a list of
+    (record_number,header,positions,characters) tuples, one for each bad
+    sequence.  If strict is True, raise a PhyloBaseError listing every problem
+    instead.
+    """
+
+    problems = []
+
+    first_record = 0
+    headers = []
+    sequences = []
+    batch_bytes = 0
+    for header, sequence in records:
+        headers.append(header)
+        sequences.append(sequence)
+        batch_bytes += len(sequence)
+
+        if batch_bytes >= batch_size:
+            _checkBatch(first_record,headers,sequences,problems)
+            first_record += len(headers)
+            headers = []
+            sequences = []
+            batch_bytes = 0
+
+    if len(headers) > 0:
+        _checkBatch(first_record,headers,sequences,problems)
+
+    if strict and len(problems) > 0:
+        raise PhyloBaseError(formatValidationReport(problems))
+
+    return problems
+
+def validateSequences(sequences,strict=True):
+    """
+    Check a list of Sequence objects for illegal characters.  See
+    validateRecords.
+    """
+
+    return validateRecords(((s.header,s.data) for s in sequences),strict)
+
+def validateFastaFile(fasta_file,strict=True):
+    """
+    Check every record in a fasta file for illegal characters in one streaming
+    pass.  See validateRecords.
+    """
+
+    return validateRecords(FastaFile.iterRecords(fasta_file),strict)
+
+def validateAlignment(alignment,strict=True):
+    """
+    Check an Alignment for illegal characters with a single lookup over its
+    residue matrix.  See validateRecords.
+    """
+
+    bad = np.logical_not(LEGAL_LOOKUP[alignment.matrix])
+    rows = np.flatnonzero(bad.any(axis=1))
+
+    problems = []
+    for r in rows:
+        positions = np.flatnonzero(bad[r])
+        characters = sorted(set([chr(c) for c in alignment.matrix[r,positions]]))
+        problems.append((int(r),alignment.headers[r],positions,
+                         "".join(characters)))
+
+    if strict and len(problems) > 0:
+        raise PhyloBaseError(formatValidationReport(problems))
+
+    return problems
+
+# Alphabets for packed sequence storage: (alphabet, bits per residue).  The
+# protein alphabet covers every legal character, so any valid sequence packs.
+PACKINGS = {"nucleotide":("ACGT",2),
+            "protein":(LEGAL_CHARACTERS,5)}
+
+def packResidues(data,packing):
+    """
+    Pack a bytes sequence into a bit-packed bytes object using the alphabet
+    named by packing ("nucleotide": 2 bits/residue, "protein": 5 bits/residue).
+    """
+
+    try:
+        alphabet, bits = PACKINGS[packing]
+    except KeyError:
+        err = "Packing '%s' not recognized.  Should be one of: %s\n" % \
+            (packing,", ".join(sorted(PACKINGS.keys())))
+        raise PhyloBaseError(err)
+
+    lookup = np.full(256,255,dtype=np.uint8)
+    for i, c in enumerate(alphabet):
+        lookup[ord(c)] = i
+
+    codes = lookup[np.frombuffer(data,dtype=np.uint8)]
+    if np.any(codes == 255):
+        bad = sorted(set([chr(c) for c in
+                          np.frombuffer(data,dtype=np.uint8)[codes == 255]]))
+        err = "Character(s) %s cannot be packed with the %s alphabet!\n" % \
+            (", ".join(bad),packing)
+        raise PhyloBaseError(err)
+
+    # Take the low bits of every code, lay them out end to end and pack
+    bit_matrix = np.unpackbits(codes[:,np.newaxis],axis=1)[:,8-bits:]
+
+    return np.packbits(bit_matrix.ravel()).tobytes()
+
+def unpackResidues(packed,length,packing):
+    """
+    Reverse packResidues, returning length residues as bytes.
+    """
+
+    alphabet, bits = PACKINGS[packing]
+
+    bit_matrix = np.unpackbits(np.frombuffer(packed,dtype=np.uint8))
+    bit_matrix = bit_matrix[:length*bits].reshape(length,bits)
+    codes = bit_matrix.dot(1 << np.arange(bits-1,-1,-1))
+
+    return np.frombuffer(alphabet.encode("ascii"),dtype=np.uint8)[codes].tobytes()
+
+
 class Sequence:
     """
-    A class to hold sequences.
+    A class to hold sequences.  Sequences are held as bytes in a slotted
+    object with an interned header, optionally bit-packed (see PACKINGS), to
+    keep the per-record cost low for very large sequence sets.
     """
 
-    def __init__(self,sequence,header="",strict=True):
+    __slots__ = ("header","_data","_length","_packing")
+
+    def __init__(self,sequence,header="",strict=True,packing=None):
         """
-        Create instance of sequence class.
+        Create instance of sequence class.  sequence may be a str or bytes.
+        If packing is "nucleotide" or "protein", the residues are stored
+        bit-packed and unpacked on access.
         """
    
         # Record sequence and header, making sure that leading/trailing 
         # whitespace is removed. 
-        self.header = header.strip()
-        self.sequence = sequence.strip().upper()
+        self.header = sys.intern(header.strip())
+
+        self._packing = None
+        self._setData(sequence)
 
         if strict:
             self.sanityCheck()
 
+        if packing is not None:
+            self.pack(packing)
+
+    def _setData(self,sequence):
+        """
+        Store a str or bytes sequence as upper-case bytes.
+        """
+
+        if isinstance(sequence,str):
+            sequence = sequence.encode("utf-8")
+
+        self._data = sequence.strip().upper()
+        self._length = len(self._data)
+        self._packing = None
+
+    @property
+    def data(self):
+        """
+        The sequence as (unpacked) bytes.
+        """
+
+        if self._packing is None:
+            return self._data
+
+        return unpackResidues(self._data,self._length,self._packing)
+
+    @property
+    def sequence(self):
+        """
+        The sequence as a str.
+        """
+
+        return self.data.decode("utf-8")
+
+    @sequence.setter
+    def sequence(self,sequence):
+
+        packing = self._packing
+        self._setData(sequence)
+        if packing is not None:
+            self.pack(packing)
+
+    @property
+    def packing(self):
+        """
+        Name of the packing in use (None if the sequence is not packed).
+        """
+
+        return self._packing
+
+    def pack(self,packing):
+        """
+        Store the sequence bit-packed with the alphabet named by packing.
+        """
+
+        data = self.data
+        self._data = packResidues(data,packing)
+        self._packing = packing
+
+    def unpack(self):
+        """
+        Store the sequence as plain bytes.
+        """
+
+        self._data = self.data
+        self._packing = None
+
+    def __len__(self):
+        """
+        Number of residues in the sequence.
+        """
+
+        return self._length
+
     def sanityCheck(self):
         """
         Make sure that the sequence is allowed.
         """
 
-        legal_characters = list(string.ascii_uppercase)
-        legal_characters.extend(["-","?","*"])
-
-        not_sane = [s for s in self.sequence if s not in legal_characters]
+        data = self.data
+        not_sane = _illegalPositions(data)
 
         if len(not_sane) > 0:
-            prob = ", ".join(dict([(k,[]) for k in not_sane]))
+            prob = ", ".join(sorted(set([data[p:p+1].decode("utf-8","replace")
+                                         for p in not_sane])))
             err = "Sequence %s contains illegal characters!\n\n%s\n\n" % \
-                (header,prob)
+                (self.header,prob)
             raise PhyloBaseError(err)
 
 
 class Alignment:
     """
-    Class to hold an alignment (as a set of Sequence objects).
+    Class to hold an alignment.  Residues are stored as a contiguous 
+    (num_seq x length) uint8 matrix with a header->row index, so columns, row
+    ranges and column masks can be handed to numpy without re-walking strings.
     """
 
-    def __init__(self,sequences):
+    def __init__(self,sequences=None,headers=None,matrix=None,annotations=None):
         """
+        Create an alignment from a list of Sequence objects or, alternatively,
+        from a list of headers and an existing (num_seq x length) uint8 matrix.
+        annotations is an optional dictionary of per-column annotation
+        strings (e.g. SS_cons/SA_cons rows), each as long as the alignment.
         """
 
-        self.sequences = sequences[:]
-    
-        # Make sure that everyone has the same length by using length as 
-        # dictionary keys.  Since dictionary keys must be unique, this will lead
-        # to a length-1 dictionary if all sequences have the same length.
-        lengths = [len(s) for s in sequences]
-        if len(dict([(l,[]) for l in lenghts])) != 1:
-            err = "All sequences do not have the same length!  Bad alignment!\n"
+        if sequences is not None:
+
+            # Make sure that everyone has the same length by using length as 
+            # dictionary keys.
+            lengths = dict([(len(s),[]) for s in sequences])
+            if len(lengths) > 1:
+                err = "All sequences do not have the same length!  Bad alignment!\n"
+                raise PhyloBaseError(err)
+
+            length = 0
+            if len(lengths) == 1:
+                length = list(lengths.keys())[0]
+
+            # Copy each sequence straight into its row of a preallocated
+            # matrix, avoiding any intermediate joined string
+            headers = [s.header for s in sequences]
+            matrix = np.empty((len(sequences),length),dtype=np.uint8)
+            for i, s in enumerate(sequences):
+                matrix[i] = np.frombuffer(s.data,dtype=np.uint8)
+
+        if headers is None or matrix is None:
+            err = "Alignment requires sequences or headers and a matrix.\n"
+            raise PhyloBaseError(err)
+
+        matrix = np.asarray(matrix)
+        if matrix.dtype != np.uint8 or matrix.ndim != 2:
+            err = "Alignment matrix must be a 2D uint8 array.\n"
+            raise PhyloBaseError(err)
+
+        if matrix.shape[0] != len(headers):
+            err = "Number of headers (%i) does not match number of rows (%i)!\n" \
+                % (len(headers),matrix.shape[0])
+            raise PhyloBaseError(err)
+
+        self.matrix = matrix
+        self.headers = list(headers)
+        self.header_index = dict([(h,i) for i, h in enumerate(self.headers)])
+
+        self.num_seq = matrix.shape[0]
+        self.length = matrix.shape[1]
+
+        self.annotations = {}
+        if annotations is not None:
+            for k in annotations.keys():
+                if len(annotations[k]) != self.length:
+                    err = "Annotation %s has length %i, but the alignment has %i columns!\n" % \
+                        (k,len(annotations[k]),self.length)
+                    raise PhyloBaseError(err)
+                self.annotations[k] = annotations[k]
+
+    def __len__(self):
+        """
+        Number of sequences in the alignment.
+        """
+
+        return self.num_seq
+
+    def _rowSelector(self,rows):
+        """
+        Convert a row selection (slice, header, list of headers, list of 
+        integers or boolean mask) into something numpy can index with.  Slices
+        are passed through untouched so they yield views.
+        """
+
+        if isinstance(rows,slice):
+            return rows
+
+        if isinstance(rows,str):
+            return [self.rowIndex(rows)]
+
+        rows = list(rows) if not isinstance(rows,np.ndarray) else rows
+        if len(rows) > 0 and isinstance(rows[0],str):
+            return np.array([self.rowIndex(r) for r in rows],dtype=np.intp)
+
+        return np.asarray(rows)
+
+    def rowIndex(self,header):
+        """
+        Return the row number of the sequence with header.
+        """
+
+        try:
+            return self.header_index[header]
+        except KeyError:
+            err = "Sequence %s is not in the alignment!\n" % header
             raise PhyloBaseError(err)
 
-        self.length = lengths[0]
+    def getRow(self,row):
+        """
+        Return a 1D view of a row, selected by header or row number.
+        """
+
+        if isinstance(row,str):
+            row = self.rowIndex(row)
+
+        return self.matrix[row]
+
+    def getColumn(self,column):
+        """
+        Return a 1D (strided) view of a column.
+        """
+
+        return self.matrix[:,column]
+
+    def subset(self,rows=None,columns=None):
+        """
+        Return a new Alignment holding a subset of rows and/or columns.  Rows
+        may be a slice, headers, row numbers or a boolean mask; columns may be
+        a slice, column numbers or a boolean mask.  Slices share memory with
+        this alignment; masks and index lists produce copies (numpy fancy
+        indexing semantics).
+        """
+
+        matrix = self.matrix
+        headers = self.headers
+
+        if rows is not None:
+            selector = self._rowSelector(rows)
+            matrix = matrix[selector]
+            if isinstance(selector,slice):
+                headers = headers[selector]
+            else:
+                headers = [headers[i] for i in np.arange(self.num_seq)[selector]]
+
+        annotations = self.annotations
+        if columns is not None:
+            if not isinstance(columns,slice):
+                columns = np.asarray(columns)
+            matrix = matrix[:,columns]
+
+            annotations = {}
+            for k in self.annotations.keys():
+                value = np.frombuffer(self.annotations[k].encode("ascii"),
+                                      dtype=np.uint8)
+                annotations[k] = value[columns].tobytes().decode("ascii")
+
+        return Alignment(headers=headers,matrix=matrix,annotations=annotations)
+
+    def getRows(self,rows):
+        """
+        Return a new Alignment with only the selected rows.
+        """
+
+        return self.subset(rows=rows)
+
+    def getColumns(self,columns):
+        """
+        Return a new Alignment with only the selected columns.
+        """
+
+        return self.subset(columns=columns)
+
+    def characterMask(self,characters):
+        """
+        Return a (num_seq x length) boolean matrix that is True wherever the
+        alignment holds one of characters.
+        """
+
+        lookup = np.zeros(256,dtype=bool)
+        for c in characters:
+            lookup[ord(c)] = True
+
+        return lookup[self.matrix]
+
+    def gapMask(self,gap_characters="-"):
+        """
+        Return a boolean matrix that is True for every gap.
+        """
+
+        return self.characterMask(gap_characters)
+
+    def nonGapColumns(self,gap_characters="-"):
+        """
+        Return a boolean array that is True for every column in which at least
+        one sequence has a non-gap character.
+        """
+
+        return np.logical_not(self.gapMask(gap_characters)).any(axis=0)
 
+    def getSequence(self,row):
+        """
+        Return a Sequence object for a row, selected by header or row number.
+        """
+
+        if isinstance(row,str):
+            row = self.rowIndex(row)
+
+        return Sequence(self.matrix[row].tobytes(),self.headers[row],
+                        strict=False)
+
+    def iterSequences(self):
+        """
+        Yield a Sequence object for every row in the alignment.
+        """
+
+        for i in range(self.num_seq):
+            yield self.getSequence(i)
+
+    def validate(self,strict=True):
+        """
+        Check the whole alignment for illegal characters.  See
+        validateAlignment.
+        """
+
+        return validateAlignment(self,strict)
+
+
+# Newick tokens: punctuation, ":length", 'quoted label', [comment] or a bare
+# label.  Comments match without capturing anything and are skipped.
+_NEWICK_TOKEN = re.compile(r"""\s*(?:([(),;])|:\s*([^\s(),;:\[\]]*)|'((?:[^']|'')*)'|\[[^\]]*\]|([^\s(),;:\[\]']+))""")
+
+# Labels containing any of these must be quoted on output
+_NEWICK_QUOTE = re.compile(r"[\s(),;:\[\]']")
+
+# Structural characters for the vectorized parser
+_NEWICK_STRUCTURE = np.zeros(256,dtype=bool)
+_NEWICK_STRUCTURE[[ord(c) for c in "(),"]] = True
+_NEWICK_WHITESPACE = np.zeros(256,dtype=bool)
+_NEWICK_WHITESPACE[[ord(c) for c in string.whitespace]] = True
+
+def _isFloat(value):
+    """
+    Whether a string can be converted to a float.
+    """
+
+    try:
+        float(value)
+    except ValueError:
+        return False
+
+    return True
 
 class NewickTree:
     """
-    Read and write Newick-style phylogenetic trees.
+    Read and write Newick-style phylogenetic trees.  The topology is held as
+    parent, first_child and next_sibling index arrays (-1 means none), with a
+    float64 branch_lengths array (nan where no length was given) and a labels
+    table with one entry (or None) per node.  Node 0 is the root.
     """
 
     def __init__(self,tree_file=None,tree_number=0):
@@ -85,56 +576,1461 @@ class NewickTree:
         Create an instance of NewickTree.
         """
   
+        self.parse(";")
+
         if tree_file != None:
             self.loadFile(tree_file,tree_number)
  
 
-    def loadFile(tree_file,tree_number=0):
+    def loadFile(self,tree_file,tree_number=0):
         """
-        Read a tree file.
+        Read tree number tree_number (counting from 0) out of a tree file.
+        Only that tree is parsed; see TreeFile.
         """ 
-        f = open(tree_file,'r')
-        lines = f.readlines()
-        f.close()
 
+        tree_file = TreeFile(tree_file)
+        tree_file.readTree(tree_number,self)
+        tree_file.close()
 
-class FastaFile:
-    """
-    Read and write fasta files.
-    """
+    def parse(self,newick):
+        """
+        Parse a Newick string.  Neither parser recurses, so arbitrarily deep or
+        large trees do not hit the recursion limit.  Plain trees go through a
+        vectorized parser; trees with quoted labels or [comments] go through a
+        tokenizer that walks the string with an explicit current-node pointer.
+        """
 
-    def __init__(self,fasta_file=None):
+        if "'" in newick or "[" in newick or not newick.isascii():
+            self._parseTokens(newick)
+        else:
+            self._parseArrays(newick)
+
+    def _setTree(self,parent,first_child,next_sibling,branch_lengths,labels):
+        """
+        Store the parsed tree arrays.
         """
-        Create an instance of FastaFile.
-        """           
 
-        if fasta_file != None:
-            self.loadFile(fasta_file)
+        self.parent = np.asarray(parent,dtype=np.int64)
+        self.first_child = np.asarray(first_child,dtype=np.int64)
+        self.next_sibling = np.asarray(next_sibling,dtype=np.int64)
+        self.branch_lengths = np.asarray(branch_lengths,dtype=np.float64)
+        self.labels = labels
+
+        self.num_nodes = len(self.parent)
+
+    def _parseArrays(self,newick):
+        """
+        Parse a Newick string without quotes or comments.  The structural
+        characters are located with numpy; each "(" or "," creates a node
+        whose parent is the most recent node one level shallower, which is
+        found for every node at once with a sorted search.
+        """
+
+        before, semicolon, after = newick.partition(";")
+        if semicolon == "":
+            err = "Newick string is incomplete (unbalanced parentheses or no ';')!\n"
+            raise PhyloBaseError(err)
+
+        data = np.frombuffer(before.encode("ascii"),dtype=np.uint8)
+        event_positions = np.flatnonzero(_NEWICK_STRUCTURE[data])
+        events = data[event_positions]
+        num_events = len(events)
+
+        opens = events == ord("(")
+        closes = events == ord(")")
+        commas = events == ord(",")
+
+        # Depth after each structural character
+        depth = np.cumsum(opens.astype(np.int64) - closes)
+        if num_events > 0:
+            if np.any(depth < 0):
+                err = "Unbalanced parentheses in Newick string!\n"
+                raise PhyloBaseError(err)
+            if depth[-1] != 0:
+                err = "Newick string is incomplete (unbalanced parentheses or no ';')!\n"
+                raise PhyloBaseError(err)
+            if np.any(commas & (depth == 0)):
+                err = "Unexpected ',' outside of parentheses!\n"
+                raise PhyloBaseError(err)
+
+        # Every "(" or "," creates a node; the root is node 0.  Nodes are keyed
+        # by (depth,event) so a search for (depth - 1,event) lands just past
+        # the currently open node one level up.
+        creates = opens | commas
+        create_events = np.flatnonzero(creates)
+        num_nodes = len(create_events) + 1
+
+        stride = num_events + 1
+        keys = np.zeros(num_nodes,dtype=np.int64)
+        keys[1:] = depth[create_events]*stride + create_events + 1
+        key_order = np.argsort(keys,kind="stable")
+        sorted_keys = keys[key_order]
+
+        parent = np.full(num_nodes,-1,dtype=np.int64)
+        search = (depth[create_events] - 1)*stride + create_events + 1
+        parent[1:] = key_order[np.searchsorted(sorted_keys,search) - 1]
+
+        # Text after "(" or "," belongs to the new node; text after ")" to
+        # the node that was just closed.
+        owner = np.full(num_events,-1,dtype=np.int64)
+        owner[create_events] = np.arange(1,num_nodes)
+        close_events = np.flatnonzero(closes)
+        search = depth[close_events]*stride + close_events + 1
+        owner[close_events] = key_order[np.searchsorted(sorted_keys,search) - 1]
+
+        # Link children in the order they were created
+        first_child = np.full(num_nodes,-1,dtype=np.int64)
+        next_sibling = np.full(num_nodes,-1,dtype=np.int64)
+        if num_nodes > 1:
+            kids = np.arange(1,num_nodes)
+            by_parent = np.lexsort((kids,parent[1:]))
+            kids = kids[by_parent]
+            kid_parents = parent[1:][by_parent]
+
+            first = np.ones(len(kids),dtype=bool)
+            first[1:] = kid_parents[1:] != kid_parents[:-1]
+            first_child[kid_parents[first]] = kids[first]
+            next_sibling[kids[:-1][~first[1:]]] = kids[1:][~first[1:]]
+
+        # Segment k is the text between structural characters k - 1 and k;
+        # its label runs up to a ":" (if any) and its branch length after it.
+        segment_starts = np.concatenate(([0],event_positions + 1))
+        segment_ends = np.concatenate((event_positions,[len(data)]))
+        segment_owners = np.concatenate(([0],owner))
+
+        colons = np.flatnonzero(data == ord(":"))
+        colon_segments = np.searchsorted(event_positions,colons)
+        if np.any(colon_segments[1:] == colon_segments[:-1]):
+            err = "Could not parse Newick string near position %i!\n" % \
+                colons[np.flatnonzero(colon_segments[1:] == colon_segments[:-1])[0]]
+            raise PhyloBaseError(err)
+
+        label_ends = segment_ends.copy()
+        label_ends[colon_segments] = colons
+
+        if segment_starts[0] != label_ends[0] and num_events > 0 and \
+           before[:label_ends[0]].strip() != "":
+            err = "Could not parse Newick string near position 0!\n"
+            raise PhyloBaseError(err)
+
+        # Labels: gather every non-empty label span (plus the character that
+        # ends it, overwritten with a separator) into one buffer and split it
+        spans = np.flatnonzero(label_ends > segment_starts)
+        span_lengths = label_ends[spans] - segment_starts[spans] + 1
+        span_offsets = np.cumsum(span_lengths) - span_lengths
+        gather = np.arange(span_lengths.sum()) - \
+                 np.repeat(span_offsets - segment_starts[spans],span_lengths)
+
+        gathered = np.concatenate((data,np.zeros(1,dtype=np.uint8)))[gather]
+        gathered[span_offsets + span_lengths - 1] = 1
+        found = gathered.tobytes().decode("ascii").split("\x01")[:-1]
+
+        if np.any(_NEWICK_WHITESPACE[data]):
+            found = [l.strip() for l in found]
+        found = np.array(found + [None],dtype=object)[:-1]
+        keep = found != ""
+        labels = np.full(num_nodes,None,dtype=object)
+        labels[segment_owners[spans][keep]] = found[keep]
+        labels = labels.tolist()
+
+        # Branch lengths: blank out everything but the length spans and let
+        # numpy convert the remaining numbers in one go
+        branch_lengths = np.full(num_nodes,np.nan)
+        if len(colons) > 0:
+            marks = np.zeros(len(data) + 1,dtype=np.int64)
+            marks[colons + 1] += 1
+            marks[segment_ends[colon_segments]] -= 1
+            in_length = np.cumsum(marks[:-1]) > 0
+
+            numbers = np.where(in_length,data,ord(" ")).astype(np.uint8)
+            numbers = numbers.tobytes().decode("ascii").split()
+
+            try:
+                if len(numbers) != len(colons):
+                    raise ValueError
+                values = np.array(numbers,dtype=np.float64)
+            except ValueError:
+                for a, b in zip(colons + 1,segment_ends[colon_segments]):
+                    if not _isFloat(before[a:b]):
+                        err = "Branch length '%s' is not a number!\n" % \
+                            before[a:b].strip()
+                        raise PhyloBaseError(err)
+
+            branch_lengths[segment_owners[colon_segments]] = values
+
+        self._setTree(parent,first_child,next_sibling,branch_lengths,labels)
+
+    def _parseTokens(self,newick):
+        """
+        Parse a Newick string token by token, keeping track of the current
+        node.  Handles quoted labels and [comments].
+        """
+
+        parent = [-1]
+        first_child = [-1]
+        next_sibling = [-1]
+        last_child = [-1]
+        branch_lengths = [np.nan]
+        labels = [None]
+
+        # Position of the ":" that gave each node its branch length
+        length_positions = {}
+
+        current = 0
+        finished = False
+        position = 0
+        for m in _NEWICK_TOKEN.finditer(newick):
+
+            # finditer silently skips anything it can't match; catch that
+            if m.start() != position and newick[position:m.start()].strip() != "":
+                err = "Could not parse Newick string near position %i!\n" % position
+                raise PhyloBaseError(err)
+            position = m.end()
+
+            punctuation, length, quoted, label = m.groups()
+
+            if punctuation == "(" or punctuation == ",":
+
+                # "(" opens the first child of the current node; "," opens a
+                # sibling of the current node.
+                if punctuation == "(":
+                    p = current
+                else:
+                    p = parent[current]
+                    if p == -1:
+                        err = "Unexpected ',' outside of parentheses!\n"
+                        raise PhyloBaseError(err)
+
+                new = len(parent)
+                parent.append(p)
+                first_child.append(-1)
+                next_sibling.append(-1)
+                last_child.append(-1)
+                branch_lengths.append(np.nan)
+                labels.append(None)
+
+                if last_child[p] == -1:
+                    first_child[p] = new
+                else:
+                    next_sibling[last_child[p]] = new
+                last_child[p] = new
+
+                current = new
+
+            elif punctuation == ")":
+                current = parent[current]
+                if current == -1:
+                    err = "Unbalanced parentheses in Newick string!\n"
+                    raise PhyloBaseError(err)
+
+            elif punctuation == ";":
+                finished = True
+                break
+
+            elif length is not None:
+
+                # A second ":" for the same node, as in "(A:1:2,B);"
+                if current in length_positions:
+                    err = "Could not parse Newick string near position %i!\n" % \
+                        length_positions[current]
+                    raise PhyloBaseError(err)
+                length_positions[current] = newick.index(":",m.start())
+
+                try:
+                    branch_lengths[current] = float(length)
+                except ValueError:
+                    err = "Branch length '%s' is not a number!\n" % length
+                    raise PhyloBaseError(err)
 
-    def loadFile(self,fasta_file):
+            elif quoted is not None or label is not None:
+                if quoted is not None:
+                    label = quoted.replace("''","'")
+
+                # Unquoted labels with spaces come through as several tokens
+                if labels[current] is None:
+                    labels[current] = label
+                else:
+                    labels[current] = "%s %s" % (labels[current],label)
+
+        if not finished or current != 0:
+            err = "Newick string is incomplete (unbalanced parentheses or no ';')!\n"
+            raise PhyloBaseError(err)
+
+        self._setTree(parent,first_child,next_sibling,branch_lengths,labels)
+
+    def isTip(self,node):
+        """
+        Whether node has no children.
+        """
+
+        return self.first_child[node] == -1
+
+    def getChildren(self,node):
+        """
+        Return a list of the children of node.
+        """
+
+        children = []
+        child = self.first_child[node]
+        while child != -1:
+            children.append(int(child))
+            child = self.next_sibling[child]
+
+        return children
+
+    def getTips(self):
         """
-        Load a fasta file into memory.
+        Return an array of tip node numbers.
         """
 
-        f = open(fasta_file,'r')
-        lines = f.readlines()
-        f.close()
+        return np.flatnonzero(self.first_child == -1)
 
-        # Remove trailing spaces/line endings and skip blank lines
-        lines = [l.strip() for l in lines if l.strip() != ""]
+    def getTipLabels(self):
+        """
+        Return the labels of all tips.
+        """
 
-        # Find all ">" entries
-        entries = [i for i, l in enumerate(lines) if l.startswith(">")]
-        num_seq = len(entries)
+        return [self.labels[i] for i in self.getTips()]
+
+    def preorder(self):
+        """
+        Return an array of node numbers in preorder (parents before children).
+        """
+
+        order = []
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(reversed(self.getChildren(node)))
+
+        return np.array(order,dtype=np.int64)
+
+    def postorder(self):
+        """
+        Return an array of node numbers in postorder (children before parents).
+        """
+
+        return self.preorder()[::-1]
+
+    def scaleBranchLengths(self,factor):
+        """
+        Multiply every branch length by factor.
+        """
+
+        self.branch_lengths *= factor
+
+    def _formatNode(self,node):
+        """
+        Return the label and branch length of a node as a Newick fragment.
+        """
+
+        out = ""
+        label = self.labels[node]
+        if label is not None:
+            if _NEWICK_QUOTE.search(label):
+                label = "'%s'" % label.replace("'","''")
+            out = label
+
+        if not np.isnan(self.branch_lengths[node]):
+            out = "%s:%r" % (out,float(self.branch_lengths[node]))
+
+        return out
+
+    def writeNewick(self):
+        """
+        Return the tree as a Newick string.
+        """
+
+        out = []
+
+        # Walk the tree with an explicit stack.  Each entry is a node and
+        # whether its children have already been written.
+        stack = [(0,False)]
+        while len(stack) > 0:
+            node, closing = stack.pop()
+
+            if closing:
+                out.append(")")
+                out.append(self._formatNode(node))
+                continue
+
+            # Not the first child of its parent, so needs a separator
+            if node != 0 and self.first_child[self.parent[node]] != node:
+                out.append(",")
+
+            children = self.getChildren(node)
+            if len(children) == 0:
+                out.append(self._formatNode(node))
+            else:
+                out.append("(")
+                stack.append((node,True))
+                stack.extend([(c,False) for c in reversed(children)])
+
+        out.append(";")
+
+        return "".join(out)
+
+    def __str__(self):
+        """
+        Newick representation of the tree.
+        """
+
+        return self.writeNewick()
+
+
+class TreeFile:
+    """
+    Lazy access to files holding many trees: plain Newick files with one or
+    more ";"-terminated trees, or NEXUS files with tree blocks (e.g. MrBayes
+    .t files, including their translate tables).  Tree boundaries are found
+    in a single scan and saved as byte offsets in a sidecar index
+    (tree_file.tidx); afterwards only the trees asked for are read and parsed.
+    """
+
+    # Read size used when scanning for tree boundaries
+    block_size = 16777216
+
+    def __init__(self,tree_file,index_file=None,rebuild=False):
+        """
+        Open tree_file, loading its index or building it if it does not
+        exist, is older than the tree file, or rebuild is True.
+        """
+
+        self.tree_file = tree_file
+        if index_file is None:
+            index_file = "%s.tidx" % tree_file
+        self.index_file = index_file
+
+        stale = True
+        if os.path.exists(index_file):
+            stale = os.path.getmtime(index_file) < os.path.getmtime(tree_file)
+
+        if rebuild or stale:
+            self.buildIndex()
+            self.writeIndex()
+        else:
+            self.readIndex()
+
+        self._file = open(tree_file,'rb')
+        self._readTranslate()
+
+    def _isNexus(self):
+        """
+        Whether the tree file starts with a #NEXUS line.
+        """
+
+        with open(self.tree_file,'rb') as f:
+            for line in f:
+                if line.strip() != b"":
+                    return line.strip().lower().startswith(b"#nexus")
+
+        return False
+
+    def buildIndex(self):
+        """
+        Scan the file once, recording the byte range of every tree.
+        """
+
+        if self._isNexus():
+            self._scanNexus()
+        else:
+            self._scanNewick()
+
+    def _scanNewick(self):
+        """
+        Record tree boundaries in a plain Newick file: every tree runs from
+        the end of the previous tree up to and including its ";".
+        """
+
+        ends = []
+        offset = 0
+        with open(self.tree_file,'rb') as f:
+            while True:
+                block = f.read(self.block_size)
+                if block == b"":
+                    break
+
+                found = np.flatnonzero(np.frombuffer(block,dtype=np.uint8) == ord(";"))
+                ends.append(found + offset + 1)
+                offset += len(block)
+
+        ends = np.concatenate(ends) if len(ends) > 0 else np.zeros(0,dtype=np.int64)
+
+        self.ends = ends.astype(np.int64)
+        self.starts = np.concatenate(([0],self.ends[:-1])).astype(np.int64)
+        self.translate_range = np.array([-1,-1],dtype=np.int64)
+
+    def _scanNexus(self):
+        """
+        Record tree boundaries in a NEXUS file.  A tree starts at the first
+        "(" after the "=" of a "tree name = ..." line and ends at the next
+        ";".  The byte range of any translate table is recorded too.
+        """
+
+        starts = []
+        ends = []
+        translate_range = [-1,-1]
+
+        # What the scanner is waiting for: a new statement, the end of a
+        # tree, or the end of the translate table
+        waiting_for = None
+
+        offset = 0
+        with open(self.tree_file,'rb') as f:
+            for line in f:
+
+                search_from = 0
+                if waiting_for is None:
+                    command = line.strip().lower()
+                    if command.startswith(b"tree ") or command.startswith(b"utree "):
+                        search_from = line.find(b"(",line.find(b"="))
+                        if search_from == -1:
+                            offset += len(line)
+                            continue
+                        starts.append(offset + search_from)
+                        waiting_for = "tree"
+                    elif command.startswith(b"translate"):
+                        search_from = line.lower().find(b"translate") + len(b"translate")
+                        translate_range[0] = offset + search_from
+                        waiting_for = "translate"
+
+                if waiting_for is not None:
+                    end = line.find(b";",search_from)
+                    if end != -1:
+                        if waiting_for == "tree":
+                            ends.append(offset + end + 1)
+                        else:
+                            translate_range[1] = offset + end
+                        waiting_for = None
+
+                offset += len(line)
+
+        if len(ends) != len(starts):
+            err = "Last tree in %s is not terminated by ';'!\n" % self.tree_file
+            raise PhyloBaseError(err)
+
+        self.starts = np.array(starts,dtype=np.int64)
+        self.ends = np.array(ends,dtype=np.int64)
+        self.translate_range = np.array(translate_range,dtype=np.int64)
+
+    def writeIndex(self):
+        """
+        Save the tree offsets to the sidecar index.  If the index cannot be
+        written (e.g. a read-only directory), carry on without it.
+        """
+
+        try:
+            with open(self.index_file,'wb') as f:
+                np.savez(f,starts=self.starts,ends=self.ends,
+                         translate_range=self.translate_range)
+        except (IOError,OSError):
+            pass
+
+    def readIndex(self):
+        """
+        Load tree offsets from the sidecar index.
+        """
+
+        with open(self.index_file,'rb') as f:
+            index = np.load(f)
+            self.starts = index["starts"]
+            self.ends = index["ends"]
+            self.translate_range = index["translate_range"]
+
+    def _readTranslate(self):
+        """
+        Read a NEXUS translate table ("key label, key label, ...") if there
+        is one.
+        """
+
+        self.translate = {}
+
+        start, end = [int(x) for x in self.translate_range]
+        if start == -1:
+            return
+
+        self._file.seek(start)
+        table = self._file.read(end - start).decode("utf-8")
+        for entry in table.split(","):
+            entry = entry.split(None,1)
+            if len(entry) == 2:
+                self.translate[entry[0]] = entry[1].strip().strip("'")
+
+    def close(self):
+        """
+        Close the tree file.
+        """
+
+        self._file.close()
+
+    def __len__(self):
+        """
+        Number of trees in the file.
+        """
+
+        return len(self.ends)
+
+    def getNewick(self,tree_number):
+        """
+        Return the Newick string of tree tree_number (counting from 0).
+        """
+
+        try:
+            start = int(self.starts[tree_number])
+            end = int(self.ends[tree_number])
+        except IndexError:
+            err = "Tree %i requested, but %s only has %i trees!\n" % \
+                (tree_number,self.tree_file,len(self))
+            raise PhyloBaseError(err)
+
+        self._file.seek(start)
+
+        return self._file.read(end - start).decode("utf-8").strip()
+
+    def readTree(self,tree_number,tree):
+        """
+        Parse tree tree_number into the NewickTree tree, applying any
+        translate table to the tip labels.
+        """
+
+        tree.parse(self.getNewick(tree_number))
+
+        if len(self.translate) > 0:
+            for i in tree.getTips():
+                tree.labels[i] = self.translate.get(tree.labels[i],tree.labels[i])
+
+        return tree
+
+    def getTree(self,tree_number):
+        """
+        Return tree tree_number as a NewickTree.
+        """
+
+        return self.readTree(tree_number,NewickTree())
+
+    def iterTrees(self,start=0,stop=None,step=1):
+        """
+        Yield NewickTree objects for trees start, start + step ... up to (but
+        not including) stop, with python slice semantics.  Use start to skip
+        burn-in and step to thin the sample.
+        """
+
+        for i in range(len(self))[start:stop:step]:
+            yield self.getTree(i)
+
+
+def _parseFastaLines(lines,raw_lines=False):
+    """
+    Walk an iterable of fasta file lines, yielding a (header,sequence) tuple
+    for every record.  Blank lines and anything before the first ">" are
+    skipped.  If raw_lines is True, sequence is the list of the record's
+    original (unstripped) lines rather than a single joined string.
+    """
+
+    header = None
+    sequence = []
+    for line in lines:
+
+        stripped = line.strip()
+        if stripped == "":
+            continue
+
+        # New record; emit the previous one
+        if stripped.startswith(">"):
+            if header is not None:
+                if raw_lines:
+                    yield header, sequence
+                else:
+                    yield header, "".join(sequence)
+
+            header = stripped[1:].strip()
+            sequence = []
+
+        elif header is not None:
+            if raw_lines:
+                sequence.append(line)
+            else:
+                sequence.append(stripped)
+
+    # Emit the last record
+    if header is not None:
+        if raw_lines:
+            yield header, sequence
+        else:
+            yield header, "".join(sequence)
+
+
+def fastaChunks(fasta_file,num_chunks,search_size=65536):
+    """
+    Split a fasta file into about num_chunks (start,end) byte ranges, each
+    starting at the beginning of a ">" line so records never straddle chunks.
+    """
+
+    size = os.path.getsize(fasta_file)
+
+    boundaries = [0]
+    with open(fasta_file,'rb') as f:
+        for i in range(1,num_chunks):
+
+            # Look forward from the target for the next "\n>"
+            target = max(size*i//num_chunks - 1,boundaries[-1])
+            f.seek(target)
+            carry = b""
+            position = target
+            boundary = size
+            while True:
+                block = f.read(search_size)
+                if block == b"":
+                    break
+
+                found = (carry + block).find(b"\n>")
+                if found != -1:
+                    boundary = position - len(carry) + found + 1
+                    break
+
+                position += len(block)
+                carry = block[-1:]
+
+            if boundary > boundaries[-1] and boundary < size:
+                boundaries.append(boundary)
+
+    boundaries.append(size)
+
+    return list(zip(boundaries[:-1],boundaries[1:]))
+
+# Largest byte range parallelChunks hands to one worker, so the records a
+# worker holds at once stay bounded however big the file is
+CHUNK_BYTES = 33554432
+
+def parallelChunks(fasta_file,num_processes,chunks_per_process=4,
+                   chunk_bytes=CHUNK_BYTES):
+    """
+    Split a fasta file into byte ranges for a pool of num_processes workers:
+    at least chunks_per_process ranges per process, and enough that each
+    range is about chunk_bytes or less (a range can run past chunk_bytes only
+    to finish a record).
+    """
+
+    size = os.path.getsize(fasta_file)
+    num_chunks = max(num_processes*chunks_per_process,size//chunk_bytes + 1)
+
+    return fastaChunks(fasta_file,num_chunks)
+
+def iterFastaChunk(fasta_file,start,end,raw_lines=False):
+    """
+    Yield (header,sequence) tuples for the records in the byte range
+    start:end of a fasta file, as returned by fastaChunks or parallelChunks.
+    """
+
+    with open(fasta_file,'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    for record in _parseFastaLines(data.decode("utf-8").split("\n"),raw_lines):
+        yield record
+
+def _parseFastaChunk(args):
+    """
+    Parse the records in one byte range of a fasta file.  Run in worker
+    processes by FastaFile.iterRecordsParallel.
+    """
+
+    fasta_file, start, end = args
+
+    return list(iterFastaChunk(fasta_file,start,end))
+
+
+class FastaFile:
+    """
+    Read and write fasta files.
+    """
+
+    # Read buffer for streaming through fasta files
+    buffer_size = 1048576
+
+    def __init__(self,fasta_file=None,strict=True,num_processes=1):
+        """
+        Create an instance of FastaFile.
+        """           
+
+        if fasta_file != None:
+            self.loadFile(fasta_file,strict,num_processes)
+
+    @staticmethod
+    def iterRecords(fasta_file,raw_lines=False):
+        """
+        Yield (header,sequence) tuples from a fasta file one record at a time,
+        reading through a buffered handle so memory use does not depend on the
+        size of the file.  The header has ">" and flanking whitespace removed;
+        sequence lines are stripped and joined.  If raw_lines is True, the
+        sequence is instead returned as a list of the original lines.
+        """
+
+        with open(fasta_file,'r',buffering=FastaFile.buffer_size) as f:
+            for record in _parseFastaLines(f,raw_lines):
+                yield record
+
+    @staticmethod
+    def iterRecordsParallel(fasta_file,num_processes=None,chunks_per_process=4):
+        """
+        Yield the same (header,sequence) tuples as iterRecords, in the same
+        order, but parse the file in a pool of num_processes processes (all
+        cores if None).  The file is split into byte ranges aligned to ">"
+        lines (see parallelChunks); each worker parses whole chunks and results
+        are merged back in file order.
+        """
+
+        if num_processes is None:
+            num_processes = multiprocessing.cpu_count()
+
+        chunks = parallelChunks(fasta_file,num_processes,chunks_per_process)
+        jobs = [(fasta_file,start,end) for start, end in chunks]
+
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            for records in pool.imap(_parseFastaChunk,jobs):
+                for record in records:
+                    yield record
+        finally:
+            pool.terminate()
+
+    def loadFile(self,fasta_file,strict=True,num_processes=1):
+        """
+        Load a fasta file into memory.  If strict, all sequences are checked
+        for illegal characters in a single pass once loaded.  If
+        num_processes is not 1, the file is parsed in parallel (see
+        iterRecordsParallel).
+        """
+
+        if num_processes == 1:
+            records = self.iterRecords(fasta_file)
+        else:
+            records = self.iterRecordsParallel(fasta_file,num_processes)
+
+        self.sequences = [Sequence(sequence,header,strict=False)
+                          for header, sequence in records]
+
+        if strict:
+            validateSequences(self.sequences)
+
+
+class FastaIndex:
+    """
+    A samtools faidx-style index of a fasta file.  For each record it stores
+    the header, sequence length, byte offset of the first residue, residues per
+    line and bytes per line (including the line ending).  The index is written
+    next to the fasta file as fasta_file.fai with one tab-delimited line per
+    record.  Unlike samtools, the full header (everything after ">") is used
+    as the record name.
+    """
+
+    def __init__(self,fasta_file,index_file=None,rebuild=False):
+        """
+        Load the index for fasta_file, (re)building it if it does not exist,
+        is older than the fasta file, or rebuild is True.
+        """
+
+        self.fasta_file = fasta_file
+        if index_file is None:
+            index_file = "%s.fai" % fasta_file
+        self.index_file = index_file
+
+        stale = True
+        if os.path.exists(index_file):
+            stale = os.path.getmtime(index_file) < os.path.getmtime(fasta_file)
+
+        if rebuild or stale:
+            self.buildIndex()
+            self.writeIndex()
+        else:
+            self.readIndex()
+
+    def _setEntries(self,entries):
+        """
+        Store a list of (name,length,offset,line_bases,line_width) entries as
+        parallel arrays and build the name lookup.
+        """
+
+        self.names = [e[0] for e in entries]
+        columns = np.array([e[1:] for e in entries],dtype=np.int64)
+        columns = columns.reshape(len(entries),4)
+
+        self.lengths = columns[:,0]
+        self.offsets = columns[:,1]
+        self.line_bases = columns[:,2]
+        self.line_widths = columns[:,3]
+
+        self.name_index = {}
+        for i, n in enumerate(self.names):
+            if n in self.name_index:
+                err = "Sequence %s occurs more than once in %s!\n" % \
+                    (n,self.fasta_file)
+                raise PhyloBaseError(err)
+            self.name_index[n] = i
+
+    def buildIndex(self):
+        """
+        Scan the fasta file once, recording the position and line layout of
+        every record.  Every sequence line of a record except the last must
+        have the same length for the offsets to be computable.
+        """
+
+        entries = []
+        current = None
+        short_line = False
+
+        offset = 0
+        with open(self.fasta_file,'rb',buffering=FastaFile.buffer_size) as f:
+            for line in f:
+
+                line_width = len(line)
+                if line.startswith(b">"):
+                    if current is not None:
+                        entries.append(current)
+
+                    name = line[1:].strip().decode("utf-8")
+                    current = [name,0,offset + line_width,0,0]
+                    short_line = False
+
+                elif current is not None:
+
+                    bases = len(line.rstrip(b"\r\n"))
+                    if bases == 0:
+                        short_line = True
+                    else:
+                        if current[3] == 0:
+                            current[3] = bases
+                            current[4] = line_width
+                        elif short_line or bases > current[3] or \
+                             (bases == current[3] and line_width != current[4]):
+                            err = "Record %s in %s has uneven line lengths and " % \
+                                (current[0],self.fasta_file)
+                            err += "cannot be indexed!\n"
+                            raise PhyloBaseError(err)
+
+                        if bases < current[3]:
+                            short_line = True
+
+                        current[1] += bases
+
+                offset += line_width
+
+        if current is not None:
+            entries.append(current)
+
+        self._setEntries(entries)
+
+    def writeIndex(self):
+        """
+        Write the index out as a tab-delimited .fai file.
+        """
+
+        with open(self.index_file,'w') as f:
+            for i, n in enumerate(self.names):
+                f.write("%s\t%i\t%i\t%i\t%i\n" % (n,self.lengths[i],
+                                                  self.offsets[i],
+                                                  self.line_bases[i],
+                                                  self.line_widths[i]))
+
+    def readIndex(self):
+        """
+        Read an existing .fai file.
+        """
+
+        entries = []
+        with open(self.index_file,'r') as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+
+                col = line.rstrip("\r\n").split("\t")
+                if len(col) != 5:
+                    err = "Mangled index file %s!\n" % self.index_file
+                    raise PhyloBaseError(err)
+
+                entries.append([col[0]] + [int(c) for c in col[1:]])
+
+        self._setEntries(entries)
+
+    def __len__(self):
+        """
+        Number of records in the index.
+        """
+
+        return len(self.names)
+
+    def __contains__(self,name):
+        """
+        Whether a record with this name is in the index.
+        """
+
+        return name in self.name_index
+
+    def recordNumber(self,name):
+        """
+        Return the position of the record called name in the file.
+        """
+
+        try:
+            return self.name_index[name]
+        except KeyError:
+            err = "Sequence %s is not in %s!\n" % (name,self.fasta_file)
+            raise PhyloBaseError(err)
+
+
+class IndexedFastaFile:
+    """
+    Random access to the records of a fasta file.  The file is memory-mapped
+    and a FastaIndex is used to jump straight to any record or subsequence
+    without reading the rest of the file.
+    """
+
+    def __init__(self,fasta_file,index_file=None):
+        """
+        Open fasta_file, loading (or building) its index.
+        """
+
+        self.fasta_file = fasta_file
+        self.index = FastaIndex(fasta_file,index_file)
+
+        self._file = open(fasta_file,'rb')
+        if os.path.getsize(fasta_file) > 0:
+            self._map = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+
+    def __len__(self):
+        """
+        Number of records in the file.
+        """
+
+        return len(self.index)
+
+    def __contains__(self,name):
+        """
+        Whether a record with this name is in the file.
+        """
+
+        return name in self.index
+
+    def close(self):
+        """
+        Release the memory map and file handle.
+        """
+
+        if isinstance(self._map,mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def _fetch(self,record,start,end):
+        """
+        Return residues start to end (0-based, end exclusive) of record number
+        record as bytes.
+        """
+
+        length = self.index.lengths[record]
+        if start < 0 or end > length or start > end:
+            err = "Range %i-%i is outside of sequence %s (length %i)!\n" % \
+                (start,end,self.index.names[record],length)
+            raise PhyloBaseError(err)
+
+        if start == end:
+            return b""
+
+        offset = int(self.index.offsets[record])
+        line_bases = int(self.index.line_bases[record])
+        line_width = int(self.index.line_widths[record])
+
+        first = offset + (start//line_bases)*line_width + start % line_bases
+        last = offset + ((end - 1)//line_bases)*line_width + \
+                        (end - 1) % line_bases + 1
+
+        return self._map[first:last].translate(None,b"\r\n")
+
+    def getRecord(self,record):
+        """
+        Return (header,sequence) for record number record.
+        """
+
+        name = self.index.names[record]
+        sequence = self._fetch(record,0,int(self.index.lengths[record]))
+
+        return name, sequence.decode("ascii")
+
+    def getSequence(self,name):
+        """
+        Return the full sequence of the record called name.
+        """
+
+        return self.getRecord(self.index.recordNumber(name))[1]
+
+    def getSubsequence(self,name,start,end):
+        """
+        Return residues start to end (0-based, end exclusive) of the record
+        called name.
+        """
+
+        record = self.index.recordNumber(name)
+
+        return self._fetch(record,start,end).decode("ascii")
+
+    def iterRecords(self,names):
+        """
+        Yield (header,sequence) for each name in names that is in the file.
+        Names not in the file are skipped.
+        """
+
+        for n in names:
+            if n in self.index:
+                yield self.getRecord(self.index.name_index[n])
+
+
+# Binary alignment container.  A fixed-size little-endian header is followed by
+# the (num_seq x length) uint8 residue matrix starting on a page boundary, then
+# a block of newline-separated headers and a block of tab-delimited
+# "name\tvalue" column annotations.
+BINARY_MAGIC = b"PHYLOALN"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<8sIIQQQQQQQ")
+BINARY_MATRIX_OFFSET = 4096
+
+class BinaryAlignmentWriter:
+    """
+    Stream an alignment into the binary container one row at a time.  Rows
+    are written straight to disk; only headers are held until close().
+    """
+
+    def __init__(self,out_file):
+        """
+        Open out_file for writing.
+        """
+
+        self.out_file = out_file
+        self.headers = []
+        self.length = None
+
+        self._file = open(out_file,'wb')
+        self._file.write(b"\x00"*BINARY_MATRIX_OFFSET)
+
+    def addRow(self,header,data):
+        """
+        Append one sequence (str or bytes) to the alignment.
+        """
+
+        if isinstance(data,str):
+            data = data.encode("ascii")
+        data = data.upper()
+
+        if self.length is None:
+            self.length = len(data)
+        elif len(data) != self.length:
+            err = "Sequence %s has length %i, but the alignment has %i columns!\n" % \
+                (header,len(data),self.length)
+            self._file.close()
+            raise PhyloBaseError(err)
+
+        self.headers.append(header)
+        self._file.write(data)
+
+    def close(self,annotations=None):
+        """
+        Write the header, name and annotation blocks and close the file.
+        """
+
+        if self.length is None:
+            self.length = 0
+        if annotations is None:
+            annotations = {}
+
+        for k in annotations.keys():
+            if len(annotations[k]) != self.length:
+                err = "Annotation %s has length %i, but the alignment has %i columns!\n" % \
+                    (k,len(annotations[k]),self.length)
+                self._file.close()
+                raise PhyloBaseError(err)
+
+        header_block = "\n".join(self.headers).encode("utf-8")
+        annotation_block = "".join(["%s\t%s\n" % (k,annotations[k])
+                                    for k in annotations.keys()]).encode("utf-8")
+
+        header_offset = BINARY_MATRIX_OFFSET + len(self.headers)*self.length
+        annotation_offset = header_offset + len(header_block)
+
+        self._file.write(header_block)
+        self._file.write(annotation_block)
+
+        self._file.seek(0)
+        self._file.write(BINARY_HEADER.pack(BINARY_MAGIC,BINARY_VERSION,0,
+                                            len(self.headers),self.length,
+                                            BINARY_MATRIX_OFFSET,
+                                            header_offset,len(header_block),
+                                            annotation_offset,
+                                            len(annotation_block)))
+        self._file.close()
+
+def writeBinaryAlignment(alignment,out_file):
+    """
+    Write an Alignment to the binary container.
+    """
+
+    writer = BinaryAlignmentWriter(out_file)
+    for i in range(alignment.num_seq):
+        writer.addRow(alignment.headers[i],alignment.matrix[i].tobytes())
+    writer.close(alignment.annotations)
+
+def loadBinaryAlignment(binary_file):
+    """
+    Open a binary alignment.  The residue matrix is a read-only memory map, so
+    opening is fast regardless of size and concurrent readers share the page
+    cache.
+    """
+
+    with open(binary_file,'rb') as f:
+        header = f.read(BINARY_HEADER.size)
+        if len(header) != BINARY_HEADER.size or \
+           header[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            err = "%s is not a binary alignment file!\n" % binary_file
+            raise PhyloBaseError(err)
+
+        magic, version, reserved, num_seq, length, matrix_offset, \
+            header_offset, header_bytes, annotation_offset, \
+            annotation_bytes = BINARY_HEADER.unpack(header)
+
+        if version != BINARY_VERSION:
+            err = "%s has unsupported binary alignment version %i!\n" % \
+                (binary_file,version)
+            raise PhyloBaseError(err)
+
+        f.seek(header_offset)
+        headers = f.read(header_bytes).decode("utf-8").split("\n")
+        if num_seq == 0:
+            headers = []
+
+        f.seek(annotation_offset)
+        annotations = {}
+        for line in f.read(annotation_bytes).decode("utf-8").split("\n"):
+            if line != "":
+                k, v = line.split("\t",1)
+                annotations[k] = v
+
+    if num_seq*length > 0:
+        matrix = np.memmap(binary_file,dtype=np.uint8,mode='r',
+                           offset=matrix_offset,shape=(num_seq,length))
+    else:
+        matrix = np.zeros((num_seq,length),dtype=np.uint8)
+
+    return Alignment(headers=headers,matrix=matrix,annotations=annotations)
+
+def iterPhylipRecords(phylip_file,annotations=None):
+    """
+    Yield (header,sequence) tuples from a sequential phylip file, one record
+    at a time.  Records may be "name sequence" on one line or a name followed
+    by sequence lines.  Stockholm-style "#=GR name value" lines are collected
+    into the annotations dictionary, if one is given; other "#" lines are
+    skipped.
+    """
+
+    with open(phylip_file,'r',buffering=FastaFile.buffer_size) as f:
+
+        # First non-blank line has the number of sequences and columns
+        length = None
+        for line in f:
+            if line.strip() != "":
+                try:
+                    num_seq, length = [int(c) for c in line.split()[:2]]
+                except ValueError:
+                    err = "First line of %s must have sequence and column counts!\n" % \
+                        phylip_file
+                    raise PhyloBaseError(err)
+                break
+
+        if length is None:
+            return
+
+        name = None
+        sequence = []
+        sequence_length = 0
+        for line in f:
+
+            stripped = line.strip()
+            if stripped == "":
+                continue
+
+            if stripped.startswith("#"):
+                col = stripped.split()
+                if annotations is not None and col[0] == "#=GR" and len(col) >= 3:
+                    annotations[col[1]] = col[2]
+                continue
+
+            if name is None:
+                col = stripped.split(None,1)
+                name = col[0]
+                sequence = []
+                sequence_length = 0
+                if len(col) == 1:
+                    continue
+                stripped = col[1]
+
+            residues = "".join(stripped.split())
+            sequence.append(residues)
+            sequence_length += len(residues)
+
+            if sequence_length >= length:
+                if sequence_length > length:
+                    err = "Sequence %s is longer than %i columns!\n" % (name,length)
+                    raise PhyloBaseError(err)
+
+                yield name, "".join(sequence)
+                name = None
+
+        if name is not None:
+            err = "Sequence %s is shorter than %i columns!\n" % (name,length)
+            raise PhyloBaseError(err)
+
+def fastaToBinary(fasta_file,out_file,annotations=None):
+    """
+    Stream a fasta alignment into the binary container.
+    """
+
+    writer = BinaryAlignmentWriter(out_file)
+    for header, sequence in FastaFile.iterRecords(fasta_file):
+        writer.addRow(header,sequence)
+    writer.close(annotations)
+
+def phylipToBinary(phylip_file,out_file):
+    """
+    Stream a sequential phylip alignment into the binary container, keeping
+    any "#=GR" column annotations (e.g. SS_cons/SA_cons).
+    """
+
+    annotations = {}
+    writer = BinaryAlignmentWriter(out_file)
+    for header, sequence in iterPhylipRecords(phylip_file,annotations):
+        writer.addRow(header,sequence)
+    writer.close(annotations)
+
+def binaryToFasta(binary_file,out_file):
+    """
+    Stream a binary alignment out as a fasta file.
+    """
+
+    alignment = loadBinaryAlignment(binary_file)
+    with open(out_file,'w',buffering=FastaFile.buffer_size) as f:
+        for i in range(alignment.num_seq):
+            f.write(">%s\n%s\n" % (alignment.headers[i],
+                                  alignment.matrix[i].tobytes().decode("ascii")))
+
+def phylipSafeNames(names):
+    """
+    Replace each run of whitespace in names with "_", so they read back as a
+    single phylip name token.  Raises an error if two names become the same.
+    """
+
+    safe = [re.sub(r"\s+","_",n.strip()) for n in names]
+
+    seen = {}
+    for n, s in zip(names,safe):
+        seen.setdefault(s,[]).append(n)
+
+    collisions = sorted([s for s in seen if len(seen[s]) > 1])
+    if len(collisions) > 0:
+        err = "Some names are the same once whitespace is replaced by _!\n"
+        for s in collisions:
+            err += "%s: %s\n" % (s,", ".join(seen[s]))
+        raise PhyloBaseError(err)
+
+    return safe
+
+def binaryToPhylip(binary_file,out_file):
+    """
+    Stream a binary alignment out as a sequential ("name sequence") phylip
+    file, with any column annotations written as "#=GR" lines.  Whitespace in
+    headers and annotation names becomes "_" (see phylipSafeNames) so the
+    file reads back with iterPhylipRecords.
+    """
+
+    alignment = loadBinaryAlignment(binary_file)
+
+    names = phylipSafeNames(alignment.headers)
+    keys = list(alignment.annotations.keys())
+    safe_keys = phylipSafeNames(keys)
+    for k in keys:
+        if len(alignment.annotations[k].split()) != 1:
+            err = "Annotation %s cannot be written to phylip: its value " % k
+            err += "is empty or contains whitespace!\n"
+            raise PhyloBaseError(err)
+
+    with open(out_file,'w',buffering=FastaFile.buffer_size) as f:
+        f.write("%i %i\n" % (alignment.num_seq,alignment.length))
+        for i in range(alignment.num_seq):
+            f.write("%s  %s\n" % (names[i],
+                                 alignment.matrix[i].tobytes().decode("ascii")))
+        for k, safe_k in zip(keys,safe_keys):
+            f.write("#=GR %s %s\n" % (safe_k,alignment.annotations[k]))
+
+def buildKeyRegex(keys):
+    """
+    Compile a set of literal keys into a single regular expression shaped
+    like a trie (e.g. "XX0001" and "XX0002" become "XX000[12]").  Each
+    position in the text then costs one walk down the trie, whatever the
+    number of keys.  Children are tried before a key ends, so the longest key
+    wins when keys overlap.
+    """
+
+    trie = {}
+    for k in keys:
+        if k == "":
+            err = "Keys may not be empty!\n"
+            raise PhyloBaseError(err)
+        node = trie
+        for c in k:
+            node = node.setdefault(c,{})
+        node[""] = {}
+
+    def buildNode(node):
+
+        ends_here = "" in node
+        branches = [re.escape(c) + buildNode(node[c])
+                    for c in sorted(node.keys()) if c != ""]
+
+        if len(branches) == 0:
+            return ""
+
+        if len(branches) == 1 and not ends_here:
+            return branches[0]
+
+        if len(branches) > 1 and max([len(b) for b in branches]) == 1:
+            pattern = "[%s]" % "".join(branches)
+        else:
+            pattern = "(?:%s)" % "|".join(branches)
+
+        if ends_here:
+            pattern += "?"
+
+        return pattern
+
+    return re.compile(buildNode(trie))
+
+def buildKeyFinder(keys):
+    """
+    Return a function that takes a string and returns the set of keys that
+    occur anywhere in it, including keys that overlap or sit inside longer
+    keys.  The trie regex from buildKeyRegex is run as a lookahead at every
+    position, which gives the longest key starting there; every shorter key
+    starting at the same position is one of its prefixes.
+    """
 
-        # Grab the header names, tossing ">" and stripping spaces
-        headers = [lines[entries[i]][1:].strip() for i in range(num_seq)]
-       
-        # Grab the actual sequences for each entry
-        entries.append(-1)
-        sequences = ["".join(lines[entries[i]+1:entries[i+1]])
-                     for i in range(num_seq)] 
-        self.sequences = [Sequence(sequences[i],headers[i])
-                          for i in range(num_seq)]
+    key_set = set(keys)
+    lookahead = re.compile("(?=(%s))" % buildKeyRegex(key_set).pattern)
 
+    def findKeys(text):
+        found = set()
+        for m in lookahead.finditer(text):
+            longest = m.group(1)
+            for j in range(1,len(longest) + 1):
+                if longest[:j] in key_set:
+                    found.add(longest[:j])
+        return found
 
+    return findKeys
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __description__ = \
 """
 Resample posterior from .dat file directly, taking into account the 'interesting'
@@ -133,4 +133,4 @@ if __name__ == "__main__":
     # If invoked from command line, print output to stdout
  
     out = main()
-    print "".join(out)
+    print("".join(out))
@@ -0,0 +1,5 @@
+import os, sys
+
+# The scripts live at the top of the repository rather than in a package
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO_DIR)
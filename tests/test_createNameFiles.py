@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+import createNameFiles, editNames, nameRegistry
+
+RECORDS = [("sp|P1|A_HUMAN","ACDE"),
+           ("sp|P2|B_MOUSE","ACDF"),
+           ("sp|P1|A_HUMAN","ACDE")]
+
+def writeFasta(path,records):
+
+    with open(path,'w') as f:
+        for header, sequence in records:
+            f.write(">%s\n%s\n" % (header,sequence))
+
+@pytest.mark.parametrize("batch_size",[10,2])
+def test_repeated_record_gets_one_name(tmp_path,batch_size):
+
+    fasta_file = str(tmp_path / "in.fasta")
+    writeFasta(fasta_file,RECORDS)
+    file_root = str(tmp_path / "in")
+
+    registry = nameRegistry.NameRegistry(str(tmp_path / "reg.db"))
+    createNameFiles.createMasterFile(fasta_file,file_root,registry=registry,
+                                     batch_size=batch_size)
+    assert len(registry) == 2
+
+    names = editNames.readMasterFile("%s_name.txt" % file_root,use_cache=False)
+    assert names.column("internal_name") == ["XX00000001","XX00000002"]
+
+    # Running again reuses the registered names
+    createNameFiles.createMasterFile(fasta_file,file_root,registry=registry,
+                                     batch_size=batch_size)
+    registry.close()
+
+    again = editNames.readMasterFile("%s_name.txt" % file_root,use_cache=False)
+    assert again.column("internal_name") == ["XX00000001","XX00000002"]
+
+    with open("%s_name.fasta" % file_root) as f:
+        assert f.read().count(">") == 2
@@ -0,0 +1,22 @@
+import fastaSubset
+
+def test_patterns_are_literal_by_default():
+
+    matches = fastaSubset.buildMatcher(["XP_000001.1"])
+    assert matches("XP_000001.1 protein")
+    assert not matches("XP_000001X1 protein")
+
+    matches = fastaSubset.buildMatcher(["XP_000001.1"],regex=True)
+    assert matches("XP_000001X1 protein")
+
+def test_group_matcher_finds_overlapping_patterns():
+
+    patterns = ["P1","P12","XP_","Q9"]
+    groups = ["g1","g2","g3","g1"]
+
+    for regex in (False,True):
+        matches = fastaSubset.buildGroupMatcher(patterns,groups,regex=regex)
+        assert matches("P12 c") == set(["g1","g2"])
+        assert matches("XP_000001.1 a") == set(["g3"])
+        assert matches("Q9 d") == set(["g1"])
+        assert matches("R1 e") == set()
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import phyloBase
+
+VALID = ["(A,B);",
+         "(A:1,B:2.5);",
+         "((A:0.1,B:0.2)0.95:0.3,(C,D)E,F:1e-3)root;",
+         "(A B,C);",
+         " ( A : 1 , ( B , C ) : 2 ) ;",
+         "((((A))));",
+         "A;",
+         ";"]
+
+INVALID = ["(A:1:2,B);",
+           "((A:1,B)C:2:3,D);",
+           "(A,B:x);",
+           "(A,B));",
+           "((A,B);",
+           "A,B;",
+           "(A,B)"]
+
+def parseWith(method,newick):
+
+    tree = phyloBase.NewickTree()
+    getattr(tree,method)(newick)
+
+    return tree
+
+@pytest.mark.parametrize("newick",VALID)
+def test_parsers_agree(newick):
+
+    arrays = parseWith("_parseArrays",newick)
+    tokens = parseWith("_parseTokens",newick)
+
+    assert np.array_equal(arrays.parent,tokens.parent)
+    assert np.array_equal(arrays.first_child,tokens.first_child)
+    assert np.array_equal(arrays.next_sibling,tokens.next_sibling)
+    assert np.array_equal(arrays.branch_lengths,tokens.branch_lengths,
+                          equal_nan=True)
+    assert arrays.labels == tokens.labels
+
+@pytest.mark.parametrize("newick",INVALID)
+def test_parsers_reject(newick):
+
+    for method in ("_parseArrays","_parseTokens"):
+        with pytest.raises(phyloBase.PhyloBaseError):
+            parseWith(method,newick)
+
+def test_multiple_branch_lengths_same_error():
+
+    messages = []
+    for method in ("_parseArrays","_parseTokens"):
+        with pytest.raises(phyloBase.PhyloBaseError) as e:
+            parseWith(method,"(A:1:2,B);")
+        messages.append(str(e.value))
+
+    assert messages[0] == messages[1]